@@ -25,6 +25,7 @@ from typing import Dict, List, Any, Optional
 
 # Import existing utilities from t# Import existing utilities from the current system
 from utils.general_utils import make_directory, save_json
+from utils.llm_utils import ClientPool, chat_completion
 from utils.logger_utils import CustomLogger
 
 # External dependencies (same as current system)
@@ -52,12 +53,18 @@ class AVMReportGenerator:
         """
         self.logger = logger or CustomLogger("AVMReportGenerator", "AVM")
         
-        # Initialize Azure OpenAI client (same as existing system)
-        self.client = AzureOpenAI(
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01"),
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-        )
+        # Initialize Azure OpenAI client (same as existing system), balanced
+        # over several deployments when AZURE_OPENAI_DEPLOYMENTS_CONFIG is set
+        deployments_config = os.getenv("AZURE_OPENAI_DEPLOYMENTS_CONFIG")
+        if deployments_config:
+            self.client = ClientPool.from_config(deployments_config)
+        else:
+            self.client = AzureOpenAI(
+                api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+                api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01"),
+                azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+                max_retries=0  # chat_completion retries the requests
+            )
         
         self.logger.info("AVM Report Generator initialized")
     
@@ -82,7 +89,10 @@ class AVMReportGenerator:
             self.logger.info(f"Generating AVM data with seed: {random_seed}")
             
             # Call Azure OpenAI (same pattern as existing system)
-            response = self.client.chat.completions.create(
+            response = chat_completion(
+                self.client,
+                self.logger,
+                "AVM data",
                 model=os.getenv("AZURE_OPENAI_GPT4O_MINI_DEPLOYMENT", "gpt-4o-mini"),
                 response_format={"type": "json_object"},
                 temperature=0.9,  # Higher temperature for more variety
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the PDF processing stages of the synthetic data pipeline.
+
+Example:
+    python benchmark.py --stage fill --input_pdf "data/1040-ScheduleC/1040-ScheduleC.pdf" --samples 30
+    python benchmark.py --stage render --input_pdf "data/1040-ScheduleC/1040-ScheduleC.pdf"
+    python benchmark.py --stage fieldnames --input_pdf "data/1040-ScheduleC/1040-ScheduleC.pdf"
+    python benchmark.py --stage labels --fields 1000
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import fitz
+import numpy as np
+from pdfrw import PdfReader, PdfWriter, PdfDict, PdfName
+
+from utils.label_utils import PageTextIndex, _caption_label, infer_local_labels
+from utils.logger_utils import CustomLogger
+from utils.pdf_utils import (
+    PdfTemplate,
+    analyze_fieldname_images,
+    extract_pdf_fields,
+    fill_pdf_fields,
+    fill_pdf_fields_batch,
+    load_pdf_template,
+    load_fieldname_images,
+    _render_page,
+)
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Benchmark PDF pipeline stages")
+    parser.add_argument(
+        "--stage",
+        type=str,
+        default="fill",
+        choices=["fill", "render", "fieldnames", "labels"],
+        help="Pipeline stage to benchmark",
+    )
+    parser.add_argument(
+        "--input_pdf",
+        type=str,
+        default="data/1040-ScheduleC/1040-ScheduleC.pdf",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=30,
+        help="Number of samples (variants) to fill",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=5,
+        help="Number of times each page is rendered (render) or checked (fieldnames)",
+    )
+    parser.add_argument(
+        "--fields",
+        type=int,
+        default=1000,
+        help="Number of fields of the generated form in the labels stage",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def build_sample_data(widget_index, sample_idx):
+    """
+    Build fill data for every text field and button of the PDF, keyed the same
+    way generate_synthetic_data keys its output (fully qualified field names).
+    """
+    data = {}
+    for full_name, entry in widget_index.items():
+        if entry["field_type"] == PdfName.Tx:
+            value = f"Sample {sample_idx} {full_name.split('.')[-1]}"
+        elif entry["field_type"] == PdfName.Btn and entry["states"]:
+            value = "/" + entry["states"][sample_idx % len(entry["states"])]
+        else:
+            continue
+        data[full_name] = {
+            "field_name": full_name,
+            "field_type": entry["field_type"],
+            "field_value": value,
+        }
+    return data
+
+
+def legacy_fill_pdf_fields(input_pdf, output_pdf_path, data):
+    """
+    Reference implementation of the previous fill path: parse the template
+    from scratch for every sample.
+    """
+    field_map = {
+        info["field_name"].split(".")[-1]: {
+            "type": info["field_type"],
+            "value": info["field_value"],
+        }
+        for info in data.values()
+    }
+    template = PdfReader(input_pdf)
+    for page in template.pages:
+        for annotation in page.Annots or []:
+            if annotation.Subtype == PdfName.Widget and annotation.T:
+                field_name = annotation.T.to_unicode().strip("()")
+                if field_name in field_map:
+                    entry = field_map[field_name]
+                    if entry["type"] == "/Tx":
+                        annotation.update(PdfDict(V=str(entry["value"]), AP=None))
+                    elif entry["type"] == "/Btn":
+                        data_value = entry["value"].lstrip("/")
+                        annotation.update(
+                            PdfDict(V=PdfName(data_value), AS=PdfName(data_value))
+                        )
+    PdfWriter().write(output_pdf_path, template)
+
+
+def report(name, elapsed, count):
+    print(f"{name:<32} {count:>5} fills  {elapsed:8.3f}s  {count / elapsed:8.2f} fills/s")
+
+
+def benchmark_fill(args, logger):
+    input_pdf = os.path.abspath(args.input_pdf)
+    widget_index = PdfTemplate(input_pdf).widget_index
+    samples = [build_sample_data(widget_index, idx) for idx in range(1, args.samples + 1)]
+    print(f"{len(samples[0])} fields per sample")
+    output_directory = tempfile.mkdtemp(prefix="benchmark_fill_")
+    try:
+        start = time.perf_counter()
+        for idx, data in enumerate(samples, 1):
+            legacy_fill_pdf_fields(
+                input_pdf, os.path.join(output_directory, f"legacy_{idx}.pdf"), data
+            )
+        report("before (parse per sample)", time.perf_counter() - start, len(samples))
+
+        start = time.perf_counter()
+        load_pdf_template(input_pdf)
+        parse_time = time.perf_counter() - start
+        # fill_pdf_fields prints a line per sample; keep the benchmark output readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            for idx, data in enumerate(samples, 1):
+                fill_pdf_fields(
+                    input_pdf=input_pdf,
+                    output_pdf_path=os.path.join(output_directory, f"cached_{idx}.pdf"),
+                    data=data,
+                    data_flag=f"Benchmark sample {idx}",
+                    logger=logger,
+                )
+        report("after (parsed template cache)", time.perf_counter() - start, len(samples))
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            timings = fill_pdf_fields_batch(
+                input_pdf=input_pdf,
+                variants=[
+                    (os.path.join(output_directory, f"batch_{idx}.pdf"), data)
+                    for idx, data in enumerate(samples, 1)
+                ],
+                data_flag="Benchmark batch",
+                logger=logger,
+            )
+        report("after (fill_pdf_fields_batch)", time.perf_counter() - start, len(samples))
+        fill_seconds = sum(t["fill_seconds"] for t in timings)
+        write_seconds = sum(t["write_seconds"] for t in timings)
+        print(f"one-time template parse: {parse_time:.3f}s")
+        print(
+            f"batch per variant: fill {fill_seconds / len(timings) * 1000:.2f}ms, "
+            f"write {write_seconds / len(timings) * 1000:.2f}ms"
+        )
+    finally:
+        shutil.rmtree(output_directory, ignore_errors=True)
+
+
+def legacy_render_page(page):
+    """
+    Reference implementation of the previous encode path: copy the samples into
+    NumPy, make a BGR copy with OpenCV and encode with OpenCV.
+    """
+    pix = page.get_pixmap(matrix=fitz.Matrix(300 / 72, 300 / 72))
+    image = np.frombuffer(pix.samples, dtype=np.uint8).reshape(
+        pix.height, pix.width, pix.n
+    )
+    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    _, encoded = cv2.imencode(".jpg", image)
+    return encoded.tobytes()
+
+
+def measure_render(name, render, page, repeats):
+    """
+    Time render(page) and record the peak Python-side allocation (pixmap sample
+    copies, NumPy arrays and encoded output) with tracemalloc.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        size = len(render(page))
+    elapsed = (time.perf_counter() - start) / repeats
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<24} {elapsed * 1000:8.1f}ms/page  peak {peak / 2**20:7.1f}MiB  output {size / 1024:7.1f}KiB")
+
+
+def benchmark_render(args):
+    doc = fitz.open(os.path.abspath(args.input_pdf))
+    page = doc[0]
+    width, height = page.rect.width / 72, page.rect.height / 72
+    print(f"page 1: {width:.2f}in x {height:.2f}in at 300 DPI")
+    if cv2 is not None:
+        measure_render("before (OpenCV jpg)", legacy_render_page, page, args.repeats)
+    else:
+        print("before (OpenCV jpg)      skipped, OpenCV is not installed")
+    measure_render("after (jpg)", lambda p: _render_page(p, 300, "jpg", 95), page, args.repeats)
+    measure_render("after (png)", lambda p: _render_page(p, 300, "png"), page, args.repeats)
+    measure_render("after (webp)", lambda p: _render_page(p, 300, "webp", 80), page, args.repeats)
+    measure_render("after (jpg, 150 DPI)", lambda p: _render_page(p, 150, "jpg", 85), page, args.repeats)
+    doc.close()
+
+
+def benchmark_fieldnames(args, logger):
+    input_pdf = os.path.abspath(args.input_pdf)
+    output_directory = tempfile.mkdtemp(prefix="benchmark_fieldnames_")
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            image_paths, _, _ = load_fieldname_images(
+                input_pdf, output_directory, os.path.basename(input_pdf), logger
+            )
+        for _ in range(args.repeats):
+            analysis = analyze_fieldname_images(image_paths, input_pdf=input_pdf)
+        for page in analysis["pages"]:
+            size = os.path.getsize(os.path.join(os.path.dirname(image_paths[0]), page["image"]))
+            print(
+                f"{page['image']:<12} {page['milliseconds']:6.1f}ms  ink {page['ink_density']:6.2%}  "
+                f"{page['fields_visible']:>4}/{page['fields_total']:<4} names visible  "
+                f"usable {str(page['usable']):<5}  (file size check: {'pass' if size >= 10000 else 'fail'})"
+            )
+        hidden = sum(not field["visible"] for field in analysis["fields"].values())
+        print(f"{len(analysis['fields'])} fields, {hidden} without a visible name")
+    finally:
+        shutil.rmtree(output_directory, ignore_errors=True)
+
+
+def build_captioned_form(path, field_count, rows_per_page=50):
+    """
+    Write a form with field_count fields: text fields with a printed caption to
+    their left and, every fifth row, a check box captioned to its right.
+    """
+    doc = fitz.open()
+    for idx in range(field_count):
+        if idx % rows_per_page == 0:
+            page = doc.new_page()
+        y = 40 + (idx % rows_per_page) * 14.5
+        widget = fitz.Widget()
+        widget.field_name = f"topmostSubform[0].Page{doc.page_count}[0].f_{idx}[0]"
+        if idx % 5 == 4:
+            page.insert_text((62, y + 9), f"Check if item {idx} applies", fontsize=8)
+            widget.field_type = fitz.PDF_WIDGET_TYPE_CHECKBOX
+            widget.rect = fitz.Rect(40, y + 1, 50, y + 11)
+        else:
+            page.insert_text((40, y + 9), f"{idx} Amount of item {idx} ........", fontsize=8)
+            widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+            widget.rect = fitz.Rect(250, y, 450, y + 12)
+        page.add_widget(widget)
+    doc.save(path)
+    doc.close()
+
+
+class LinearWordScan(PageTextIndex):
+    """
+    Reference for the labels stage: answer every query by scanning all words
+    of the page.
+    """
+
+    def query(self, rect):
+        x0, y0, x1, y1 = rect
+        return [
+            word
+            for word in self.words
+            if word[0] <= x1 and word[2] >= x0 and word[1] <= y1 and word[3] >= y0
+        ]
+
+
+def benchmark_labels(args, logger):
+    output_directory = tempfile.mkdtemp(prefix="benchmark_labels_")
+    try:
+        pdf_path = os.path.join(output_directory, "captioned_form.pdf")
+        build_captioned_form(pdf_path, args.fields)
+        with contextlib.redirect_stdout(io.StringIO()):
+            extract_pdf_fields(pdf_path, os.path.join(output_directory, "mappings.json"), logger)
+        with open(os.path.join(output_directory, "mappings.json"), "r", encoding="utf-8") as json_file:
+            field_mappings = json.load(json_file)
+        fields = [
+            (info["widgets"][0], info["field_type"] == "/Btn") for info in field_mappings.values()
+        ]
+
+        doc = fitz.open(pdf_path)
+        start = time.perf_counter()
+        words = [page.get_text("words") for page in doc]
+        extract_time = time.perf_counter() - start
+        print(f"{len(fields)} fields, {sum(len(w) for w in words)} words on {doc.page_count} pages")
+        print(f"word extraction (get_text)       {extract_time * 1000:8.1f}ms")
+
+        for name, index_class in (("grid index", PageTextIndex), ("linear scan", LinearWordScan)):
+            start = time.perf_counter()
+            indexes = [index_class(page_words) for page_words in words]
+            build_time = time.perf_counter() - start
+            start = time.perf_counter()
+            labels = [
+                _caption_label(indexes[widget["page_index"]], widget["rect"], is_button)
+                for widget, is_button in fields
+            ]
+            query_time = time.perf_counter() - start
+            found = sum(label is not None for label, _ in labels)
+            print(
+                f"{name:<14} build {build_time * 1000:8.2f}ms  query {query_time * 1000:8.2f}ms "
+                f"({query_time / len(fields) * 1e6:6.1f}us/field)  {found} captions"
+            )
+        doc.close()
+
+        start = time.perf_counter()
+        candidates = infer_local_labels(pdf_path, field_mappings, logger)
+        print(f"infer_local_labels end to end   {(time.perf_counter() - start) * 1000:8.1f}ms, {len(candidates)} labels")
+    finally:
+        shutil.rmtree(output_directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    args = get_args()
+    logger = CustomLogger(logger_name="Benchmark", log_prefix="Benchmark")
+    if args.stage == "fill":
+        benchmark_fill(args, logger)
+    elif args.stage == "render":
+        benchmark_render(args)
+    elif args.stage == "fieldnames":
+        benchmark_fieldnames(args, logger)
+    elif args.stage == "labels":
+        benchmark_labels(args, logger)
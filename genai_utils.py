@@ -2,8 +2,11 @@ import json
 import os
 import re
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from .general_utils import save_json
+from .image_utils import prepare_image_blocks
+from .llm_utils import chat_completion, hedged_chat_completion, is_backend_error
 
 
 def clean_response(response):
@@ -49,9 +52,40 @@ def clean_response(response):
 
 
 def generate_human_readable_labels(
-    client, image_data, document_type, human_readable_prompt, output_path, logger, field_mappings_json=None
+    client,
+    image_data,
+    document_type,
+    human_readable_prompt,
+    output_path,
+    logger,
+    field_mappings_json=None,
+    local_labels=None,
+    label_priors=None,
 ):
+    """
+    Map every AcroForm field to a human readable label with the vision model.
+
+    local_labels ({field_name: label}, see label_utils) are kept as they are:
+    those fields are left out of the prompt, and the model is not called at
+    all when every field already has a label. label_priors ({field_name:
+    caption}) are the less certain captions found next to fields; the ones for
+    fields in the prompt are added to it as hints.
+    """
     try:
+        local_labels = local_labels or {}
+        remaining_mappings = None
+        if local_labels and field_mappings_json:
+            remaining_mappings = {
+                field_name: info
+                for field_name, info in json.loads(field_mappings_json).items()
+                if field_name not in local_labels
+            }
+            logger.info(
+                f"{len(local_labels)} labels were inferred locally, "
+                f"asking the model for {len(remaining_mappings)} fields"
+            )
+            field_mappings_json = json.dumps(remaining_mappings, indent=4)
+
         system_prompt = """
         You are a document understanding expert. 
         Your task is to analyze {document_type} PDFs and 
@@ -70,40 +104,56 @@ def generate_human_readable_labels(
         """
         system_prompt = system_prompt.format(document_type=document_type)
 
-        image_blocks = [
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/jpeg;base64,{image_data[image_name]}"
-                },
-            }
-            for image_name in image_data.keys()
-        ]
-
         # Add field mappings as structured data
         field_mappings_text = ""
         if field_mappings_json:
             field_mappings_text = f"\n\n### AcroForm Field Mappings JSON:\n```json\n{field_mappings_json}\n```"
 
+            prompt_fields = json.loads(field_mappings_json)
+            hints = {
+                field_name: caption
+                for field_name, caption in (label_priors or {}).items()
+                if field_name in prompt_fields
+            }
+            if hints:
+                field_mappings_text += (
+                    "\n\n### Printed text found next to some of these fields "
+                    "(hints only, confirm them against the images):\n"
+                    f"```json\n{json.dumps(hints, indent=4)}\n```"
+                )
+
         message_data = [
             {"type": "text", "text": human_readable_prompt + field_mappings_text}
-        ] + image_blocks
+        ]
 
-        response = client.chat.completions.create(
-            model=os.getenv("AZURE_OPENAI_GPT4O_MODEL_DEPLOYMENT", "gpt-4o"),
-            response_format={"type": "json_object"},
-            temperature=0.1,
-            max_tokens=12000,
-            messages=[
+        if remaining_mappings == {}:
+            logger.info("Every field was labelled locally, skipping the model call")
+            response = {}
+        else:
+            image_blocks, image_tokens = prepare_image_blocks(
+                image_data, logger, "human readable labels"
+            )
+            messages = [
                 {"role": "system", "content": system_prompt},
                 {
                     "role": "user",
-                    "content": message_data,
+                    "content": message_data + image_blocks,
                 },
-            ],
-        )
-        response = clean_response(response=response.choices[0].message.content)
-        response = json.loads(response)
+            ]
+            response = chat_completion(
+                client,
+                logger,
+                "human readable labels",
+                image_tokens=image_tokens,
+                cache=True,
+                model=os.getenv("AZURE_OPENAI_GPT4O_MODEL_DEPLOYMENT", "gpt-4o"),
+                response_format={"type": "json_object"},
+                temperature=0.1,
+                max_tokens=12000,
+                messages=messages,
+            )
+            response = clean_response(response=response.choices[0].message.content)
+            response = json.loads(response)
 
         # --- Post-process: map short field names to full field mapping keys ---
         # Load field mappings from the prompt (should be passed in or loaded here)
@@ -143,6 +193,14 @@ def generate_human_readable_labels(
                             remapped[suffix_to_full[response_suffix]] = v
                             logger.info(f"Fuzzy matched {k} -> {suffix_to_full[response_suffix]}")
         
+        if local_labels:
+            # Keep the field order of the mappings where they are available
+            remapped = {
+                field_name: local_labels.get(field_name, remapped.get(field_name))
+                for field_name in (field_mappings or local_labels)
+                if field_name in local_labels or field_name in remapped
+            }
+
         logger.info(f"Final mapping: {len(remapped)} fields mapped successfully")
 
         print("Human readable labels have been generated successfully!")
@@ -264,6 +322,100 @@ def generate_synthetic_data(
         logger.error("{}".format(error))
         raise
 
+def extract_persona_fields_from_json(output_json):
+    # Heuristic: treat any field with values that look like name, ssn, address, etc. as persona fields
+    persona = {}
+    for label, info in output_json.items():
+        # label: human-readable label; info: {field_name, field_type, field_value}
+        l = label.lower()
+        v = info["field_value"]
+        if any(k in l for k in ["name", "ssn", "social security", "address", "city", "state", "zip", "employer", "dob", "date of birth", "policy", "property", "wages", "salary", "income", "ein", "phone"]):
+            persona[label] = v
+    return persona
+
+
+# Chunk requests of one sample in flight at once, and the extra attempts a
+# failed chunk gets before it is left out
+CHUNK_CONCURRENCY = 4
+CHUNK_RETRIES = 2
+
+_PERSONA_SECTION = re.compile(
+    r"\n## (?:BORROWER PERSONA|CURRENT PERSONA CONTEXT)\n.*?(?=\n## |\Z)", re.DOTALL
+)
+
+
+def _persona_header(data_generation_prompt, chunk_output=None):
+    """
+    Persona text shared by every chunk prompt: the persona sections of the
+    full prompt, or, when it has none, the identity fields generated for the
+    first chunk.
+    """
+    sections = _PERSONA_SECTION.findall(data_generation_prompt)
+    if sections:
+        return "".join(sections)
+    persona = extract_persona_fields_from_json(chunk_output or {})
+    if not persona:
+        return ""
+    return (
+        "\n## SHARED PERSONA\n"
+        "Other parts of this form were already filled for this persona. Use these exact "
+        "values for every field that asks for the same person, business or address:\n"
+        f"{json.dumps(persona, indent=2)}"
+    )
+
+
+def _generate_chunk(
+    client,
+    document_type,
+    chunk_idx,
+    chunk_count,
+    chunk_field_mappings,
+    chunk_human_readable,
+    persona_header,
+    data_flag,
+    logger,
+):
+    """
+    Generate one chunk, retrying it on its own up to CHUNK_RETRIES times
+    when its response is unusable. Model backend errors were already retried
+    by chat_completion and are raised at once.
+    """
+    chunk_prompt = f"""
+Generate synthetic data for {document_type} fields (chunk {chunk_idx}/{chunk_count}).
+
+Field mappings for this chunk:
+{json.dumps(chunk_field_mappings, indent=2)}
+
+Human readable labels for this chunk:
+{json.dumps(chunk_human_readable, indent=2)}
+
+Generate realistic, consistent data for these {len(chunk_field_mappings)} fields only.
+Ensure data is appropriate for the document type and field labels.
+Return as a JSON object with field names as keys and values as strings.
+{persona_header}
+            """
+    for attempt in range(CHUNK_RETRIES + 1):
+        try:
+            chunk_response = generate_synthetic_data_single(
+                client=client,
+                document_type=f"{document_type} (chunk {chunk_idx})",
+                data_generation_prompt=chunk_prompt,
+                field_mappings_json=json.dumps(chunk_field_mappings),
+                human_readable_labels=json.dumps(chunk_human_readable),
+                data_flag=f"{data_flag} - Chunk {chunk_idx}",
+                logger=logger,
+                hedge_key="synthetic data chunk",
+            )
+            logger.info(f"Chunk {chunk_idx} completed: {len(chunk_response)} fields processed")
+            return chunk_response
+        except Exception as error:
+            if is_backend_error(error) or attempt == CHUNK_RETRIES:
+                raise
+            logger.warning(
+                f"Chunk {chunk_idx} failed (attempt {attempt + 1}/{CHUNK_RETRIES + 1}), retrying: {error}"
+            )
+
+
 def generate_synthetic_data_chunked(
     client,
     document_type,
@@ -273,7 +425,17 @@ def generate_synthetic_data_chunked(
     data_flag,
     logger,
 ):
-    """Process large forms by breaking them into chunks and combining results"""
+    """
+    Process large forms by breaking them into chunks and combining results.
+
+    Chunks are requested CHUNK_CONCURRENCY at a time, all with the same persona
+    header; without a persona in the prompt the first chunk is generated on
+    its own and its identity fields become that header. Results are merged in
+    chunk order, so a later chunk wins a shared label no matter which request
+    finished first. If any chunk fails, so does the sample, with the model
+    backend error of a failed chunk when there is one so that the sample
+    can be requeued; a sample is never returned with chunks missing.
+    """
     try:
         field_mappings = json.loads(field_mappings_json)
         human_readable = json.loads(human_readable_labels)
@@ -287,47 +449,56 @@ def generate_synthetic_data_chunked(
         chunks = [field_keys[i:i + chunk_size] for i in range(0, len(field_keys), chunk_size)]
         
         logger.info(f"Processing {len(field_keys)} fields in {len(chunks)} chunks of {chunk_size} fields each")
-        
-        combined_response = {}
-        
-        for chunk_idx, chunk_fields in enumerate(chunks, 1):
-            logger.info(f"Processing chunk {chunk_idx}/{len(chunks)} with {len(chunk_fields)} fields")
-            
+
+        def run_chunk(chunk_idx, persona_header):
+            chunk_fields = chunks[chunk_idx - 1]
             # Create a subset of field mappings and human readable labels for this chunk
-            chunk_field_mappings = {k: field_mappings[k] for k in chunk_fields}
-            chunk_human_readable = {k: v for k, v in human_readable.items() if k in chunk_fields}
-            
-            # Create a focused prompt for this chunk
-            chunk_prompt = f"""
-Generate synthetic data for {document_type} fields (chunk {chunk_idx}/{len(chunks)}).
+            return _generate_chunk(
+                client,
+                document_type,
+                chunk_idx,
+                len(chunks),
+                {k: field_mappings[k] for k in chunk_fields},
+                {k: v for k, v in human_readable.items() if k in chunk_fields},
+                persona_header,
+                data_flag,
+                logger,
+            )
 
-Field mappings for this chunk:
-{json.dumps(chunk_field_mappings, indent=2)}
+        chunk_results = {}
+        persona_header = _persona_header(data_generation_prompt)
+        if not persona_header:
+            # Settle the identity with the first chunk before the others run
+            chunk_results[1] = run_chunk(1, "")
+            persona_header = _persona_header(data_generation_prompt, chunk_results[1])
 
-Human readable labels for this chunk:
-{json.dumps(chunk_human_readable, indent=2)}
+        pending = [chunk_idx for chunk_idx in range(1, len(chunks) + 1) if chunk_idx not in chunk_results]
+        with ThreadPoolExecutor(max_workers=max(1, min(CHUNK_CONCURRENCY, len(pending) or 1))) as executor:
+            futures = {
+                chunk_idx: executor.submit(run_chunk, chunk_idx, persona_header)
+                for chunk_idx in pending
+            }
+            for chunk_idx, future in futures.items():
+                try:
+                    chunk_results[chunk_idx] = future.result()
+                except Exception as error:
+                    chunk_results[chunk_idx] = error
 
-Generate realistic, consistent data for these {len(chunk_fields)} fields only.
-Ensure data is appropriate for the document type and field labels.
-Return as a JSON object with field names as keys and values as strings.
-            """
-            
-            # Process this chunk
-            chunk_response = generate_synthetic_data_single(
-                client=client,
-                document_type=f"{document_type} (chunk {chunk_idx})",
-                data_generation_prompt=chunk_prompt,
-                field_mappings_json=json.dumps(chunk_field_mappings),
-                human_readable_labels=json.dumps(chunk_human_readable),
-                data_flag=f"{data_flag} - Chunk {chunk_idx}",
-                logger=logger
-            )
-            
+        failed_chunks = [
+            chunk_idx for chunk_idx in range(1, len(chunks) + 1)
+            if isinstance(chunk_results[chunk_idx], Exception)
+        ]
+        for chunk_idx in failed_chunks:
+            logger.error(f"Chunk {chunk_idx} of {data_flag} failed: {chunk_results[chunk_idx]}")
+        if failed_chunks:
+            errors = [chunk_results[chunk_idx] for chunk_idx in failed_chunks]
+            raise next((error for error in errors if is_backend_error(error)), errors[0])
+
+        combined_response = {}
+        for chunk_idx in range(1, len(chunks) + 1):
             # Merge the chunk response into the combined response
-            for label, data in chunk_response.items():
+            for label, data in chunk_results[chunk_idx].items():
                 combined_response[label] = data
-            
-            logger.info(f"Chunk {chunk_idx} completed: {len(chunk_response)} fields processed")
         
         logger.info(f"Chunked processing completed: {len(combined_response)} total fields processed")
         return combined_response
@@ -344,6 +515,7 @@ def generate_synthetic_data_single(
     human_readable_labels,
     data_flag,
     logger,
+    hedge_key="synthetic data",
 ):
     try:
         random_seed = uuid.uuid4().int % 1_000_000
@@ -352,7 +524,11 @@ def generate_synthetic_data_single(
             + f"\n\n### VARIABILITY NOTE\nRandomization seed: {random_seed}"
         )
 
-        response = client.chat.completions.create(
+        response = hedged_chat_completion(
+            client,
+            logger,
+            data_flag,
+            hedge_key,
             model=os.getenv("AZURE_OPENAI_GPT4O_MINI_DEPLOYMENT", "gpt-4o-mini"),
             response_format={"type": "json_object"},
             temperature=1.0,
@@ -1,13 +1,506 @@
 import base64
+import functools
+import math
 import os
+import re
+import threading
+from collections import OrderedDict
+
+import fitz
+import numpy as np
+
+from .pdf_utils import encode_pixmap
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+VISION_TOKEN_BUDGET = None
+VISION_IMAGE_FORMAT = "jpg"
+VISION_IMAGE_QUALITY = 85
+
+# Encoded image payloads shared by every LLM call in the process: base64 file
+# contents, pixel sizes and prepared image URLs, least recently used first
+_PAYLOAD_CACHE = OrderedDict()
+_PAYLOAD_CACHE_LOCK = threading.Lock()
+_PAYLOAD_CACHE_STATS = {"bytes": 0, "hits": 0, "misses": 0, "evictions": 0}
+PAYLOAD_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def configure_payload_cache(max_bytes=None):
+    """
+    Set the size of the shared image payload cache in bytes of base64 text
+    (default: 256 MiB); 0 disables it. Shrinking it evicts entries right away.
+    """
+    global PAYLOAD_CACHE_MAX_BYTES
+    with _PAYLOAD_CACHE_LOCK:
+        PAYLOAD_CACHE_MAX_BYTES = 256 * 1024 * 1024 if max_bytes is None else max(0, max_bytes)
+        _evict_payloads()
+
+
+def payload_cache_stats():
+    """
+    Return {"entries", "bytes", "hits", "misses", "evictions"} of the shared
+    image payload cache.
+    """
+    with _PAYLOAD_CACHE_LOCK:
+        return {"entries": len(_PAYLOAD_CACHE), **_PAYLOAD_CACHE_STATS}
+
+
+def _payload_size(key, value):
+    # Keys made of base64 strings keep them alive, so they count as well
+    return sum(len(part) for part in (*key, value) if isinstance(part, str)) or 64
+
+
+def _evict_payloads():
+    while _PAYLOAD_CACHE and _PAYLOAD_CACHE_STATS["bytes"] > PAYLOAD_CACHE_MAX_BYTES:
+        key, value = _PAYLOAD_CACHE.popitem(last=False)
+        _PAYLOAD_CACHE_STATS["bytes"] -= _payload_size(key, value)
+        _PAYLOAD_CACHE_STATS["evictions"] += 1
+
+
+def _cached_payload(key, build):
+    """
+    Return the cached value for key, calling build() to create it on a miss.
+    build runs outside the lock, so two threads may build the same entry once.
+    """
+    with _PAYLOAD_CACHE_LOCK:
+        if key in _PAYLOAD_CACHE:
+            _PAYLOAD_CACHE.move_to_end(key)
+            _PAYLOAD_CACHE_STATS["hits"] += 1
+            return _PAYLOAD_CACHE[key]
+        _PAYLOAD_CACHE_STATS["misses"] += 1
+    value = build()
+    size = _payload_size(key, value)
+    with _PAYLOAD_CACHE_LOCK:
+        if size <= PAYLOAD_CACHE_MAX_BYTES and key not in _PAYLOAD_CACHE:
+            _PAYLOAD_CACHE[key] = value
+            _PAYLOAD_CACHE_STATS["bytes"] += size
+            _evict_payloads()
+    return value
+
+
+def _read_base64(img_path):
+    with open(img_path, "rb") as img_file:
+        return base64.b64encode(img_file.read()).decode("utf-8")
+
 
 def encode_images_to_base64(image_paths):
     """
     Given a list of image file paths, return a dict {filename: base64_string}
+
+    Encodings are kept in the shared payload cache, keyed by the file's path,
+    size and modification time, so static images are read only once per run.
     """
     image_data = {}
     for img_path in image_paths:
-        with open(img_path, "rb") as img_file:
-            b64 = base64.b64encode(img_file.read()).decode("utf-8")
-            image_data[os.path.basename(img_path)] = b64
+        img_path = os.path.abspath(img_path)
+        stat = os.stat(img_path)
+        image_data[os.path.basename(img_path)] = _cached_payload(
+            ("file", img_path, stat.st_mtime_ns, stat.st_size),
+            lambda img_path=img_path: _read_base64(img_path),
+        )
     return image_data
+
+
+def _image_size(b64):
+    def build():
+        pix = fitz.Pixmap(base64.b64decode(b64))
+        return pix.width, pix.height
+
+    return _cached_payload(("size", b64), build)
+
+
+def _prepared_image_url(b64, width, height, detail):
+    """
+    data: URL of the base64 image b64 resized to width x height and encoded
+    as configured for vision requests, from the shared payload cache.
+    """
+    image_format = VISION_IMAGE_FORMAT.lower().lstrip(".")
+    mime_type = {"jpg": "jpeg", "jpeg": "jpeg"}.get(image_format, image_format)
+
+    def build():
+        pix = fitz.Pixmap(base64.b64decode(b64))
+        if pix.alpha or pix.n != 3:
+            pix = fitz.Pixmap(fitz.csRGB, pix, 0)
+        if (width, height) != (pix.width, pix.height):
+            pix = fitz.Pixmap(pix, width, height, None)
+        encoded = base64.b64encode(
+            encode_pixmap(pix, image_format, VISION_IMAGE_QUALITY)
+        ).decode("utf-8")
+        return f"data:image/{mime_type};base64,{encoded}"
+
+    return _cached_payload(
+        ("url", b64, width, height, detail, image_format, VISION_IMAGE_QUALITY), build
+    )
+
+
+def _vision_scale(width, height):
+    """
+    Factor by which gpt-4o class vision models shrink an image at high detail:
+    fit it into 2048x2048, then scale its shortest side down to 768.
+    """
+    scale = min(1.0, 2048 / max(width, height))
+    return scale * min(1.0, 768 / (min(width, height) * scale))
+
+
+def estimate_image_tokens(width, height, detail="high"):
+    """
+    Estimate the prompt tokens of one image for gpt-4o class vision models: 85
+    tokens at low detail; at high detail 85 plus 170 for every 512px tile of
+    the image after _vision_scale.
+    """
+    if detail == "low":
+        return 85
+    scale = _vision_scale(width, height)
+    return 85 + 170 * math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+
+
+def _tile_breakpoints(width, height):
+    """
+    Scale factors (<= 1) of a width x height image at which its 512px tile
+    count at high detail changes.
+    """
+    return {
+        512 * tiles / side
+        for side in (width, height)
+        for tiles in range(1, math.ceil(side / 512) + 1)
+        if 512 * tiles / side <= 1
+    }
+
+
+def _scaled_tokens(width, height, factor):
+    # The small epsilon keeps a side that lands exactly on a tile edge in that tile
+    return 85 + 170 * math.ceil(width * factor / 512 - 1e-9) * math.ceil(height * factor / 512 - 1e-9)
+
+
+def _plan_image_sizes(sizes, token_budget):
+    """
+    Choose the pixel size and detail level of every image so that their
+    estimated tokens fit into token_budget.
+
+    Every image is first reduced to the resolution the model would work at
+    anyway (_vision_scale). Over budget, all images are shrunk by the largest
+    common factor that fits, in whole-tile steps; if even one tile each is
+    too much, the largest images are sent at low detail (512px, 85 tokens).
+
+    Returns:
+        [(width, height, detail, tokens), ...] in the order of sizes
+    """
+    vision_sizes = [
+        (width * _vision_scale(width, height), height * _vision_scale(width, height))
+        for width, height in sizes
+    ]
+    plan = [
+        (max(1, round(width)), max(1, round(height)), "high", _scaled_tokens(width, height, 1.0))
+        for width, height in vision_sizes
+    ]
+    if token_budget is None or sum(tokens for *_, tokens in plan) <= token_budget:
+        return plan
+
+    factors = sorted(
+        set.union(*(_tile_breakpoints(width, height) for width, height in vision_sizes)),
+        reverse=True,
+    )
+    for factor in factors:
+        tokens = [_scaled_tokens(width, height, factor) for width, height in vision_sizes]
+        if sum(tokens) <= token_budget:
+            return [
+                (max(1, round(width * factor)), max(1, round(height * factor)), "high", cost)
+                for (width, height), cost in zip(vision_sizes, tokens)
+            ]
+
+    # One tile each is still over budget: trade the largest images for low detail
+    plan = []
+    for width, height in vision_sizes:
+        factor = min(1.0, 512 / max(width, height))
+        plan.append([max(1, round(width * factor)), max(1, round(height * factor)), "high", 255])
+    total = 255 * len(plan)
+    for index in sorted(range(len(plan)), key=lambda i: -vision_sizes[i][0] * vision_sizes[i][1]):
+        if total <= token_budget:
+            break
+        plan[index][2:] = ["low", 85]
+        total -= 170
+    return [tuple(entry) for entry in plan]
+
+
+def configure_vision_images(token_budget=None, image_format="jpg", quality=85):
+    """
+    Set how images are prepared for every vision request in the process.
+
+    Args:
+        token_budget: Image tokens allowed per request (None: no limit, images
+            are still reduced to the resolution the model works at)
+        image_format: "jpg", "webp" or "png"
+        quality: JPEG/WebP quality of the images sent
+    """
+    global VISION_TOKEN_BUDGET, VISION_IMAGE_FORMAT, VISION_IMAGE_QUALITY
+    VISION_TOKEN_BUDGET = token_budget
+    VISION_IMAGE_FORMAT = image_format
+    VISION_IMAGE_QUALITY = quality
+
+
+def prepare_image_blocks(image_data, logger, data_flag, token_budget=None, detail=None):
+    """
+    Turn {image_name: base64} images into chat completion image blocks that fit
+    the image token budget of one request (see _plan_image_sizes).
+
+    Pixels beyond what the model would look at are never sent: each image is
+    resized to its planned size and re-encoded in the configured format, and
+    its detail level is set explicitly. detail="low" sends every image at low
+    detail (512px, 85 tokens) regardless of the budget. Prepared images come
+    from the shared payload cache, so template images sent again by later
+    requests are not decoded or encoded again.
+
+    Returns:
+        (image_blocks, estimated_image_tokens)
+    """
+    token_budget = VISION_TOKEN_BUDGET if token_budget is None else token_budget
+    images = list(image_data.values())
+    sizes = [_image_size(b64) for b64 in images]
+    if detail == "low":
+        plan = [
+            (
+                max(1, round(width * min(1.0, 512 / max(width, height)))),
+                max(1, round(height * min(1.0, 512 / max(width, height)))),
+                "low",
+                85,
+            )
+            for width, height in sizes
+        ]
+    else:
+        plan = _plan_image_sizes(sizes, token_budget)
+
+    image_blocks = [
+        {
+            "type": "image_url",
+            "image_url": {"url": _prepared_image_url(b64, width, height, detail), "detail": detail},
+        }
+        for b64, (width, height, detail, _) in zip(images, plan)
+    ]
+    source_tokens = sum(estimate_image_tokens(width, height) for width, height in sizes)
+
+    estimated_tokens = sum(tokens for *_, tokens in plan)
+    low_detail = sum(1 for _, _, detail, _ in plan if detail == "low")
+    logger.info(
+        f"Prepared {len(image_blocks)} images for {data_flag}: about {estimated_tokens} image tokens"
+        + (f" (budget {token_budget})" if token_budget is not None else "")
+        + (f", {source_tokens - estimated_tokens} fewer than as rendered" if source_tokens > estimated_tokens else "")
+        + (f", {low_detail} at low detail" if low_detail else "")
+    )
+    if token_budget is not None and estimated_tokens > token_budget:
+        logger.warning(
+            f"{len(image_blocks)} images for {data_flag} need {estimated_tokens} tokens even at low "
+            f"detail, over the budget of {token_budget}"
+        )
+    return image_blocks, estimated_tokens
+
+
+def estimate_text_tokens(text):
+    """
+    Count the tokens of text with tiktoken's o200k_base encoding (gpt-4o), or
+    estimate them at four characters per token when tiktoken is not installed.
+    """
+    encoding = _token_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / 4)
+
+
+@functools.lru_cache(maxsize=1)
+def _token_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # The encoding is downloaded on first use and may be unavailable offline
+        return None
+
+
+def estimate_prompt_tokens(messages, image_tokens=0):
+    """
+    Estimate the prompt tokens of chat messages whose images were estimated
+    separately at image_tokens; each message adds a few tokens of framing.
+    """
+    tokens = 3
+    for message in messages:
+        tokens += 4
+        content = message["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        tokens += sum(
+            estimate_text_tokens(block["text"]) for block in content if block.get("type") == "text"
+        )
+    return tokens + image_tokens
+
+
+def log_prompt_tokens(response, estimated_tokens, logger, data_flag):
+    """
+    Log the estimated prompt tokens of a request next to the count the API
+    reported for it.
+    """
+    usage = getattr(response, "usage", None)
+    if not usage:
+        logger.info(f"Prompt tokens for {data_flag}: estimated {estimated_tokens}, actual not reported")
+        return
+    actual = usage.prompt_tokens
+    logger.info(
+        f"Prompt tokens for {data_flag}: estimated {estimated_tokens}, actual {actual} "
+        f"({actual - estimated_tokens:+d}), completion {usage.completion_tokens}"
+    )
+
+
+def _image_page_number(image_name):
+    """
+    Page number of a rendered page image: "page_3.png" and "Page3.jpg" are page 3.
+    """
+    match = re.search(r"(\d+)\D*$", image_name)
+    return int(match.group(1)) if match else None
+
+
+def filter_images_by_page(image_data, page_numbers):
+    """
+    Keep the {image_name: base64} page images whose page number is in
+    page_numbers; images without a page number in their name are kept.
+    """
+    return {
+        image_name: b64
+        for image_name, b64 in image_data.items()
+        if _image_page_number(image_name) in page_numbers or _image_page_number(image_name) is None
+    }
+
+
+def field_rects_by_page(field_mappings, field_names):
+    """
+    Collect the widget rectangles of field_names from geometry-rich field
+    mappings (pdf_utils.extract_pdf_fields) as {page_number: [rect, ...]}.
+    """
+    rects = {}
+    for field_name in field_names:
+        for widget in field_mappings.get(field_name, {}).get("widgets", []):
+            rects.setdefault(widget["page_index"] + 1, []).append(widget["rect"])
+    return rects
+
+
+def _merge_bands(bands, gap):
+    merged = []
+    for start, stop in sorted(bands):
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return merged
+
+
+def crop_field_regions(
+    image_data,
+    field_rects,
+    page_sizes,
+    logger,
+    data_flag,
+    margin=36,
+    quality=90,
+):
+    """
+    Cut rendered page images down to the regions around the fields in question.
+
+    Each page keeps full-width horizontal bands covering its fields' rows plus
+    margin points above and below, so line numbers and the captions left of a
+    field stay visible; bands closer than margin are merged. The bands of a
+    page are stacked into one image, separated by a grey rule, and scaled to
+    the resolution the model would have seen the whole page at, so text is
+    exactly as legible as before. Pages without any field are dropped, and a
+    page is sent whole when its crop would not cost fewer image tokens.
+
+    Args:
+        image_data: {image_name: base64} page images; the page number is taken
+            from the name ("page_2.png", "Page2.jpg")
+        field_rects: {page_number: [[x0, y0, x1, y1], ...]} in points with a
+            top left origin (see field_rects_by_page)
+        page_sizes: [(width, height), ...] of the PDF pages in points
+
+    Returns:
+        ({image_name: base64} of the images to send, report) where report
+        holds image and estimated token counts before and after
+    """
+    cropped = {}
+    report = {
+        "images_before": len(image_data),
+        "images_after": 0,
+        "pages_skipped": 0,
+        "tokens_before": 0,
+        "tokens_after": 0,
+    }
+    for image_name, b64 in image_data.items():
+        page_number = _image_page_number(image_name)
+        width, height = _image_size(b64)
+        page_tokens = estimate_image_tokens(width, height)
+        report["tokens_before"] += page_tokens
+
+        if page_number is None or page_number > len(page_sizes):
+            cropped[image_name] = b64
+            report["tokens_after"] += page_tokens
+            continue
+        rects = field_rects.get(page_number)
+        if not rects:
+            report["pages_skipped"] += 1
+            continue
+
+        page_height = page_sizes[page_number - 1][1]
+        pixel_scale = height / page_height
+        bands = _merge_bands(
+            [(max(0, rect[1] - margin), min(page_height, rect[3] + margin)) for rect in rects],
+            margin,
+        )
+        rows = [
+            (int(start * pixel_scale), min(height, math.ceil(stop * pixel_scale)))
+            for start, stop in bands
+        ]
+        separator = max(2, int(4 * pixel_scale))
+        crop_height = sum(bottom - top for top, bottom in rows) + separator * (len(rows) - 1)
+        vision_scale = _vision_scale(width, height)
+        crop_width = max(1, round(width * vision_scale))
+        crop_height_scaled = max(1, round(crop_height * vision_scale))
+        crop_tokens = estimate_image_tokens(crop_width, crop_height_scaled)
+        if crop_tokens >= page_tokens:
+            cropped[image_name] = b64
+            report["tokens_after"] += page_tokens
+            continue
+
+        stem, extension = os.path.splitext(image_name)
+        image_format = extension.lstrip(".") or "png"
+
+        def build():
+            pix = fitz.Pixmap(base64.b64decode(b64))
+            if pix.alpha or pix.n != 3:
+                pix = fitz.Pixmap(fitz.csRGB, pix, 0)
+            pixels = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.stride)
+            pixels = pixels[:, : pix.width * 3]
+            rule = np.full((separator, pix.width * 3), 160, dtype=np.uint8)
+            parts = []
+            for top, bottom in rows:
+                if parts:
+                    parts.append(rule)
+                parts.append(pixels[top:bottom])
+            stacked = np.ascontiguousarray(np.concatenate(parts))
+            crop_pix = fitz.Pixmap(fitz.csRGB, pix.width, crop_height, stacked.tobytes(), 0)
+            if vision_scale < 1:
+                crop_pix = fitz.Pixmap(crop_pix, crop_width, crop_height_scaled, None)
+            return base64.b64encode(encode_pixmap(crop_pix, image_format, quality)).decode("utf-8")
+
+        # Template images are cropped to the same rows on every attempt
+        cropped[f"{stem}_fields{extension}"] = _cached_payload(
+            ("crop", b64, tuple(rows), crop_width, crop_height_scaled, image_format, quality), build
+        )
+        report["tokens_after"] += crop_tokens
+
+    report["images_after"] = len(cropped)
+    report["tokens_saved"] = report["tokens_before"] - report["tokens_after"]
+    logger.info(
+        f"Field region crops for {data_flag}: {report['images_before']} -> {report['images_after']} images, "
+        f"{report['pages_skipped']} pages without fields skipped, about {report['tokens_before']} -> "
+        f"{report['tokens_after']} image tokens ({report['tokens_saved']} saved)"
+    )
+    return cropped, report
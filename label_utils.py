@@ -0,0 +1,354 @@
+import re
+
+import fitz
+
+from .general_utils import save_json
+
+
+# Confidence of a label taken from a field's /TU tooltip and of printed captions
+# found on the same line right next to the field, above it, or further away.
+# Only adjacent captions that pass the checks of _caption_label reach the
+# minimum confidence; other adjacent captions are left to the model.
+TOOLTIP_CONFIDENCE = 0.9
+TRUNCATED_TOOLTIP_CONFIDENCE = 0.75
+ADJACENT_CAPTION_CONFIDENCE = 0.8
+UNCHECKED_CAPTION_CONFIDENCE = 0.6
+DISTANT_CAPTION_CONFIDENCE = 0.5
+
+# Labels below this confidence are left to the vision model
+DEFAULT_MIN_CONFIDENCE = 0.7
+
+# Widest space between two words of one caption, and most words a caption has;
+# wider gaps separate columns, longer runs are instructions rather than captions
+CAPTION_WORD_GAP = 10
+MAX_CAPTION_WORDS = 8
+
+MAX_LABEL_LENGTH = 100
+
+# Tooltips that some form designers leave in place and that say nothing about the field
+_GENERIC_TOOLTIPS = {
+    "text",
+    "text field",
+    "textfield",
+    "field",
+    "check box",
+    "checkbox",
+    "radio button",
+    "button",
+    "combo box",
+    "list box",
+    "enter text",
+}
+
+
+def _clean_label(text):
+    """
+    Collapse whitespace and drop leader dots, dollar signs and trailing
+    punctuation from tooltip or caption text.
+    """
+    text = re.sub(r"\.{2,}|…+", " ", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.strip(" .:;,$").strip()
+
+
+def _tooltip_label(tooltip, field_name):
+    """
+    Turn a /TU tooltip into a label and its confidence, or (None, 0.0) if the
+    tooltip is empty or generic. IRS tooltips often read like
+    "Line 1. Gross receipts or sales. Caution: ...", so the first sentence is
+    kept, extended while it is too short to stand alone ("Line 1").
+    """
+    text = re.sub(r"\s+", " ", tooltip or "").strip()
+    if not text:
+        return None, 0.0
+    sentences = re.split(r"(?<=[.:;])\s+", text)
+    label = sentences[0]
+    for sentence in sentences[1:]:
+        if len(_clean_label(label)) >= 12:
+            break
+        label = f"{label} {sentence}"
+    label = _clean_label(label)
+    short_name = field_name.split(".")[-1]
+    if len(label) < 3 or label.lower() in _GENERIC_TOOLTIPS or label == short_name:
+        return None, 0.0
+    if len(label) > MAX_LABEL_LENGTH:
+        label = label[:MAX_LABEL_LENGTH].rsplit(" ", 1)[0]
+        return label, TRUNCATED_TOOLTIP_CONFIDENCE
+    return label, TOOLTIP_CONFIDENCE
+
+
+class PageTextIndex:
+    """
+    Uniform grid over the words of one page (PyMuPDF get_text("words") tuples
+    of x0, y0, x1, y1, text, block, line, word) so that the words near a
+    widget are found by looking at a few grid cells instead of every word on
+    the page.
+    """
+
+    def __init__(self, words, cell_size=48):
+        self.words = words
+        self.cell_size = cell_size
+        self.cells = {}
+        self.lines = {}
+        for idx, word in enumerate(words):
+            for cell in self._cells(word[:4]):
+                self.cells.setdefault(cell, []).append(idx)
+            self.lines.setdefault((word[5], word[6]), []).append(word)
+
+    @classmethod
+    def from_page(cls, page, cell_size=48):
+        return cls(page.get_text("words"), cell_size)
+
+    def _cells(self, rect):
+        x0, y0, x1, y1 = rect
+        size = self.cell_size
+        for col in range(int(x0 // size), int(x1 // size) + 1):
+            for row in range(int(y0 // size), int(y1 // size) + 1):
+                yield col, row
+
+    def query(self, rect):
+        """
+        Return the words whose bounding box intersects rect, in reading order.
+        """
+        x0, y0, x1, y1 = rect
+        found = set()
+        for cell in self._cells(rect):
+            found.update(self.cells.get(cell, ()))
+        return [
+            self.words[idx]
+            for idx in sorted(found)
+            if self.words[idx][0] <= x1
+            and self.words[idx][2] >= x0
+            and self.words[idx][1] <= y1
+            and self.words[idx][3] >= y0
+        ]
+
+    def caption_words(self, line_key, anchor, leftward, bound, max_word_gap=CAPTION_WORD_GAP):
+        """
+        Return the run of words of one text line that starts at the anchor
+        word and extends to the left (or right) while the space to the next
+        word is at most max_word_gap and the words stay clear of bound, the
+        facing edge of the neighbouring widget.
+        """
+        line = sorted(self.lines.get(line_key, ()), key=lambda word: word[0])
+        position = line.index(anchor)
+        step = -1 if leftward else 1
+        run = [anchor]
+        position += step
+        while 0 <= position < len(line):
+            word = line[position]
+            gap = run[-1][0] - word[2] if leftward else word[0] - run[-1][2]
+            beyond = word[0] < bound - 0.5 if leftward else word[2] > bound + 0.5
+            if gap > max_word_gap or beyond:
+                break
+            run.append(word)
+            position += step
+        return run[::-1] if leftward else run
+
+    def line_text(self, line_key, start, stop):
+        """
+        Join the words of one text line whose x-range lies within [start, stop].
+        """
+        return " ".join(
+            word[4]
+            for word in self.lines.get(line_key, ())
+            if word[0] >= start - 0.5 and word[2] <= stop + 0.5
+        )
+
+
+def _caption_confidence(words, gap, max_adjacent_gap):
+    """
+    Confidence of a same-line caption: adjacent captions are checked to be
+    short enough to be a caption rather than a sentence of instructions.
+    """
+    if gap > max_adjacent_gap:
+        return DISTANT_CAPTION_CONFIDENCE
+    if len(words) > MAX_CAPTION_WORDS:
+        return UNCHECKED_CAPTION_CONFIDENCE
+    return ADJACENT_CAPTION_CONFIDENCE
+
+
+def _caption_label(index, rect, is_button, max_gap=150, max_above=12, widget_rects=()):
+    """
+    Find the printed caption of a widget with the page's PageTextIndex.
+
+    Text fields are captioned by the words on the same line to their left,
+    check boxes and radio buttons by the words to their right. A caption ends
+    at a wide space between words or at the neighbouring widget in
+    widget_rects, so the caption of the previous column on a row is not
+    merged in. Without either, the line right above the widget is used.
+
+    Returns:
+        (label, confidence) or (None, 0.0)
+    """
+    x0, y0, x1, y1 = rect
+    middle = (y0 + y1) / 2
+    row = [other for other in widget_rects if other[1] <= middle <= other[3]]
+
+    if is_button:
+        bound = min([other[0] for other in row if other[0] >= x1 - 1 and other[2] > x1 + 1], default=float("inf"))
+        right = [
+            word
+            for word in index.query((x1 - 1, middle - 2, x1 + max_gap, middle + 2))
+            if word[1] - 2 <= middle <= word[3] + 2
+            and x1 - 1 <= word[0] <= x1 + max_gap
+            and word[2] <= bound + 0.5
+        ]
+        if right:
+            nearest = min(right, key=lambda word: word[0])
+            words = index.caption_words((nearest[5], nearest[6]), nearest, False, bound)
+            label = _clean_label(" ".join(word[4] for word in words))
+            if label:
+                return label, _caption_confidence(words, nearest[0] - x1, 12)
+    else:
+        bound = max([other[2] for other in row if other[2] <= x0 + 1 and other[0] < x0 - 1], default=float("-inf"))
+        left = [
+            word
+            for word in index.query((x0 - max_gap, middle - 2, x0 + 1, middle + 2))
+            if word[1] - 2 <= middle <= word[3] + 2
+            and x0 - max_gap <= word[2] <= x0 + 1
+            and word[0] >= bound - 0.5
+        ]
+        if left:
+            nearest = max(left, key=lambda word: word[2])
+            words = index.caption_words((nearest[5], nearest[6]), nearest, True, bound)
+            label = _clean_label(" ".join(word[4] for word in words))
+            if label:
+                return label, _caption_confidence(words, x0 - nearest[2], 36)
+
+    above = [
+        word
+        for word in index.query((x0, y0 - max_above, x1, y0 + 1))
+        if y0 - max_above <= word[3] <= y0 + 1 and word[0] < x1 and word[2] > x0
+    ]
+    if above:
+        nearest = max(above, key=lambda word: word[3])
+        label = index.line_text((nearest[5], nearest[6]), x0 - max_gap, x1 + max_gap)
+        if label:
+            return _clean_label(label), DISTANT_CAPTION_CONFIDENCE
+    return None, 0.0
+
+
+def infer_local_labels(pdf_path, field_mappings, logger):
+    """
+    Infer a human readable label for every field of field_mappings (as written
+    by pdf_utils.extract_pdf_fields, with widget geometry) without the model:
+    from the field's /TU tooltip first, and otherwise from the caption printed
+    next to its first widget, looked up in a PageTextIndex per page.
+
+    Returns:
+        {field_name: {"label", "source", "confidence", "page_number"}} for the
+        fields a label was found for; source is "tooltip" or "caption"
+    """
+    try:
+        candidates = {}
+        page_indexes = {}
+        with fitz.open(pdf_path) as doc:
+            # Every widget rect per page in the unrotated coordinates of the
+            # words; widget rects are on the rendered page
+            page_widgets = {}
+            for info in field_mappings.values():
+                for widget in info.get("widgets") or []:
+                    page = doc[widget["page_index"]]
+                    page_widgets.setdefault(widget["page_index"], []).append(
+                        tuple(fitz.Rect(widget["rect"]) * page.derotation_matrix)
+                    )
+            for field_name, info in field_mappings.items():
+                if not info.get("field_type"):
+                    continue
+                label, confidence = _tooltip_label(info.get("tooltip"), field_name)
+                source = "tooltip"
+                widgets = info.get("widgets") or []
+                page_index = widgets[0]["page_index"] if widgets else None
+                if label is None and widgets:
+                    page = doc[page_index]
+                    if page_index not in page_indexes:
+                        page_indexes[page_index] = PageTextIndex.from_page(page)
+                    rect = fitz.Rect(widgets[0]["rect"]) * page.derotation_matrix
+                    label, confidence = _caption_label(
+                        page_indexes[page_index],
+                        tuple(rect),
+                        is_button=info["field_type"] == "/Btn",
+                        widget_rects=page_widgets[page_index],
+                    )
+                    source = "caption"
+                if label:
+                    candidates[field_name] = {
+                        "label": label,
+                        "source": source,
+                        "confidence": confidence,
+                        "page_number": page_index + 1 if page_index is not None else None,
+                    }
+        logger.info(
+            f"Local label candidates found for {len(candidates)} of {len(field_mappings)} fields"
+        )
+        return candidates
+    except Exception as error:
+        print("Error while inferring local labels!")
+        print("{}".format(error))
+        logger.error("Error while inferring local labels!")
+        logger.error("{}".format(error))
+        raise
+
+
+def confident_labels(candidates, min_confidence=DEFAULT_MIN_CONFIDENCE):
+    """
+    Return {field_name: label} for the candidates at or above min_confidence.
+
+    Labels become the keys of the generated data, so they must be unique. A
+    label repeated on different pages (e.g. "Name shown on return") gets the
+    page number appended; a label repeated on the same page is not confident
+    for any of its fields, and those fields go to the model.
+    """
+    groups = {}
+    for field_name, candidate in candidates.items():
+        if candidate["confidence"] >= min_confidence:
+            groups.setdefault(candidate["label"].lower(), []).append(field_name)
+
+    labels = {}
+    for field_names in groups.values():
+        if len(field_names) == 1:
+            labels[field_names[0]] = candidates[field_names[0]]["label"]
+            continue
+        pages = [candidates[field_name]["page_number"] for field_name in field_names]
+        if None in pages or len(set(pages)) < len(pages):
+            continue
+        for field_name, page_number in zip(field_names, pages):
+            labels[field_name] = f"{candidates[field_name]['label']} (Page {page_number})"
+    return {field_name: labels[field_name] for field_name in candidates if field_name in labels}
+
+
+def save_local_label_report(
+    candidates, local_labels, field_mappings, document_type, output_path, logger
+):
+    """
+    Save the local label candidates and how many model labels they avoided.
+    """
+    total_fields = len([info for info in field_mappings.values() if info.get("field_type")])
+    by_source = {}
+    for field_name in local_labels:
+        source = candidates[field_name]["source"]
+        by_source[source] = by_source.get(source, 0) + 1
+    report = {
+        "document_type": document_type,
+        "total_fields": total_fields,
+        "local_labels": len(local_labels),
+        "local_labels_by_source": by_source,
+        "sent_to_model": total_fields - len(local_labels),
+        "llm_labels_avoided_percent": round(100 * len(local_labels) / total_fields, 1)
+        if total_fields
+        else 0.0,
+        "candidates": candidates,
+    }
+    logger.info(
+        f"Local labels for {document_type}: {report['local_labels']}/{total_fields} fields "
+        f"({report['llm_labels_avoided_percent']}%) labelled without the model, "
+        f"{report['sent_to_model']} sent to the model"
+    )
+    save_json(
+        data=report,
+        json_path=output_path,
+        data_flag="Local label report",
+        logger=logger,
+    )
+    return report
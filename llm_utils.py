@@ -0,0 +1,1333 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import openai
+from openai import AsyncAzureOpenAI, AzureOpenAI
+from openai.types.chat import ChatCompletion
+
+from .image_utils import estimate_prompt_tokens, log_prompt_tokens
+
+
+def create_client(deployments_config=None):
+    """
+    Create the Azure OpenAI client from the AZURE_OPENAI_* environment variables.
+    Its own retries are off; chat_completion retries per the retry policies.
+
+    Args:
+        deployments_config: JSON file of several deployments to balance the
+            requests over (default: AZURE_OPENAI_DEPLOYMENTS_CONFIG); a
+            ClientPool is returned then (see ClientPool.from_config)
+    """
+    deployments_config = deployments_config or os.getenv("AZURE_OPENAI_DEPLOYMENTS_CONFIG")
+    if deployments_config:
+        return ClientPool.from_config(deployments_config)
+    return AzureOpenAI(
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
+        api_key=os.getenv("AZURE_OPENAI_API_KEY", ""),
+        api_version=os.getenv("AZURE_OPENAI_API_VERSION", ""),
+        max_retries=0,
+    )
+
+
+def create_async_client():
+    """
+    Create the asyncio Azure OpenAI client from the AZURE_OPENAI_* environment
+    variables, with its own retries off like create_client.
+    """
+    return AsyncAzureOpenAI(
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
+        api_key=os.getenv("AZURE_OPENAI_API_KEY", ""),
+        api_version=os.getenv("AZURE_OPENAI_API_VERSION", ""),
+        max_retries=0,
+    )
+
+
+class TokenBucket:
+    """
+    Bucket refilled continuously at per_minute / 60 units per second, holding
+    at most burst_seconds worth of them. Its level may go negative when a
+    request is reconciled to more than it was charged; later requests then
+    wait longer.
+    """
+
+    def __init__(self, per_minute, burst_seconds=10):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """
+        Seconds until amount can be taken; a request larger than the bucket
+        only waits for a full bucket.
+        """
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= amount
+
+    def give(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RequestScheduler:
+    """
+    Admit chat completion requests per deployment within its requests per
+    minute (RPM) and tokens per minute (TPM) quotas.
+
+    A request is charged its estimated prompt tokens plus max_tokens before it
+    is sent, and blocks until both buckets of its deployment can pay for it.
+    Once the response arrives the charge is corrected to response.usage, so
+    the unused share of max_tokens goes back to the other requests. Requests
+    are thereby spread to the quota's sustained rate instead of being sent at
+    once and answered with 429s. Bursts are capped at ten seconds of quota,
+    the shortest window Azure OpenAI enforces its per minute limits over.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, limits=None):
+        """
+        Args:
+            requests_per_minute: RPM quota of every deployment (None: unlimited)
+            tokens_per_minute: TPM quota of every deployment (None: unlimited)
+            limits: {deployment: (rpm, tpm)} overriding those per deployment
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.limits = limits or {}
+        self._buckets = {}
+        self._paused_until = {}
+        self._condition = threading.Condition()
+        self.stats = {"requests": 0, "waits": 0, "wait_seconds": 0.0, "tokens_charged": 0, "tokens_used": 0}
+
+    def _deployment_buckets(self, deployment):
+        if deployment not in self._buckets:
+            rpm, tpm = self.limits.get(deployment, (self.requests_per_minute, self.tokens_per_minute))
+            self._buckets[deployment] = (
+                TokenBucket(rpm) if rpm else None,
+                TokenBucket(tpm) if tpm else None,
+            )
+        return self._buckets[deployment]
+
+    def set_limits(self, deployment, requests_per_minute, tokens_per_minute):
+        """
+        Give deployment its own quotas, unless its buckets already exist.
+        """
+        with self._condition:
+            if deployment not in self._buckets:
+                self.limits[deployment] = (requests_per_minute, tokens_per_minute)
+
+    def headroom(self, deployment, tokens):
+        """
+        Return (requests of tokens deployment could admit right away, seconds
+        until the next one would be); unlimited quotas admit any number.
+        """
+        with self._condition:
+            request_bucket, token_bucket = self._deployment_buckets(deployment)
+            now = time.monotonic()
+            wait = max(
+                self._paused_until.get(deployment, 0.0) - now,
+                request_bucket.wait_time(1, now) if request_bucket else 0.0,
+                token_bucket.wait_time(tokens, now) if token_bucket else 0.0,
+            )
+            if wait > 0:
+                return 0.0, wait
+            return min(
+                request_bucket.level if request_bucket else float("inf"),
+                token_bucket.level / max(1, tokens) if token_bucket else float("inf"),
+            ), 0.0
+
+    def acquire(self, deployment, tokens):
+        """
+        Block until deployment has quota for one request of tokens, charge it
+        and return the seconds waited.
+        """
+        started = time.monotonic()
+        with self._condition:
+            request_bucket, token_bucket = self._deployment_buckets(deployment)
+            while True:
+                now = time.monotonic()
+                wait = max(
+                    self._paused_until.get(deployment, 0.0) - now,
+                    request_bucket.wait_time(1, now) if request_bucket else 0.0,
+                    token_bucket.wait_time(tokens, now) if token_bucket else 0.0,
+                )
+                if wait <= 0:
+                    break
+                self._condition.wait(wait)
+            if request_bucket:
+                request_bucket.take(1)
+            if token_bucket:
+                token_bucket.take(tokens)
+            waited = time.monotonic() - started
+            self.stats["requests"] += 1
+            self.stats["tokens_charged"] += tokens
+            if waited > 0.001:
+                self.stats["waits"] += 1
+                self.stats["wait_seconds"] += waited
+        return waited
+
+    def pause(self, deployment, seconds):
+        """
+        Admit no requests for deployment during the next seconds, e.g. after
+        it answered with a 429.
+        """
+        with self._condition:
+            self._paused_until[deployment] = max(
+                self._paused_until.get(deployment, 0.0), time.monotonic() + seconds
+            )
+
+    def reconcile(self, deployment, charged, used):
+        """
+        Correct a request's charge of charged tokens to the used tokens the
+        API reported.
+        """
+        with self._condition:
+            _, token_bucket = self._deployment_buckets(deployment)
+            self.stats["tokens_used"] += used
+            if token_bucket:
+                if used < charged:
+                    token_bucket.give(charged - used)
+                else:
+                    token_bucket.take(used - charged)
+            self._condition.notify_all()
+
+
+_SCHEDULER = RequestScheduler()
+
+
+def configure_scheduler(requests_per_minute=None, tokens_per_minute=None, limits=None):
+    """
+    Set the RPM/TPM quotas every chat_completion call is scheduled against
+    (see RequestScheduler); without any, requests are sent right away.
+    """
+    global _SCHEDULER
+    _SCHEDULER = RequestScheduler(requests_per_minute, tokens_per_minute, limits)
+
+
+def scheduler_stats():
+    """
+    Return {"requests", "waits", "wait_seconds", "tokens_charged",
+    "tokens_used"} of the request scheduler.
+    """
+    with _SCHEDULER._condition:
+        return dict(_SCHEDULER.stats)
+
+
+class RetryPolicy:
+    """
+    How often and how long to retry one class of errors: exponential backoff
+    from base_delay capped at max_delay, with full jitter (a uniform draw
+    between zero and the backoff), and never sooner than the Retry-After the
+    service asked for.
+    """
+
+    def __init__(self, max_retries, base_delay, max_delay):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, retry, retry_after=None):
+        """
+        Seconds to wait before retry number retry (0 for the first retry).
+        """
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+        return max(backoff, retry_after or 0.0)
+
+
+# Error classes that are retried; anything else (bad requests, auth, content
+# filter) is raised right away
+DEFAULT_RETRY_POLICIES = {
+    "rate_limit": RetryPolicy(max_retries=6, base_delay=2.0, max_delay=60.0),
+    "timeout": RetryPolicy(max_retries=3, base_delay=1.0, max_delay=20.0),
+    "connection": RetryPolicy(max_retries=3, base_delay=1.0, max_delay=20.0),
+    "server": RetryPolicy(max_retries=3, base_delay=1.0, max_delay=30.0),
+}
+_RETRY_POLICIES = dict(DEFAULT_RETRY_POLICIES)
+_RETRY_STATS_LOCK = threading.Lock()
+_RETRY_STATS = {"calls": 0, "retried_calls": 0, "failed_calls": 0, "retries": {}, "backoff_seconds": 0.0}
+
+
+def configure_retries(max_retries=None, policies=None):
+    """
+    Set the retry policies of chat_completion.
+
+    Args:
+        max_retries: Retries of every error class, keeping their delays
+            (None keeps the defaults, 0 disables retrying)
+        policies: {error_class: RetryPolicy} replacing single classes
+    """
+    global _RETRY_POLICIES
+    _RETRY_POLICIES = {
+        error_class: policy if max_retries is None else RetryPolicy(max_retries, policy.base_delay, policy.max_delay)
+        for error_class, policy in DEFAULT_RETRY_POLICIES.items()
+    }
+    _RETRY_POLICIES.update(policies or {})
+
+
+def retry_stats():
+    """
+    Return {"calls", "retried_calls", "failed_calls", "retries":
+    {error_class: count}, "backoff_seconds"} of all chat_completion calls.
+    """
+    with _RETRY_STATS_LOCK:
+        return {**_RETRY_STATS, "retries": dict(_RETRY_STATS["retries"])}
+
+
+def _error_class(error):
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    if isinstance(error, openai.InternalServerError):
+        return "server"
+    return None
+
+
+# Errors that count against a pool member's health; throttling does not, it
+# only pauses the member's quota. A wrong key, deployment name or endpoint
+# of one member is failed over to the others right away.
+_UNHEALTHY_ERRORS = {"timeout", "connection", "server"}
+_MISCONFIGURED_ERRORS = (openai.AuthenticationError, openai.PermissionDeniedError, openai.NotFoundError)
+
+
+def _retry_after(error):
+    """
+    Seconds the service asked to wait in the error's retry-after-ms or
+    Retry-After header, if any.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        # HTTP dates are not used by Azure OpenAI
+        return None
+    return None
+
+
+class CircuitOpenError(Exception):
+    """Raised for a request the circuit breaker held back longer than its max_wait."""
+
+
+class CircuitBreaker:
+    """
+    Stop dispatching model requests while the backend keeps failing.
+
+    Closed, it counts the outcomes of the last window requests; once
+    min_requests are known and error_threshold of them failed with timeouts,
+    connection or server errors, it opens. Open, it holds every request back
+    for open_seconds and then lets a single probe through (half open): a
+    successful probe closes it, a failed one opens it again for twice as
+    long, up to max_open_seconds. A request held back for more than max_wait
+    raises CircuitOpenError instead.
+    """
+
+    def __init__(
+        self,
+        error_threshold=0.5,
+        window=20,
+        min_requests=10,
+        open_seconds=30.0,
+        max_open_seconds=300.0,
+        max_wait=900.0,
+    ):
+        self.error_threshold = error_threshold
+        self.min_requests = min_requests
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.max_wait = max_wait
+        self.state = "closed"
+        self.outcomes = deque(maxlen=window)
+        self.opened_until = 0.0
+        self.next_open_seconds = open_seconds
+        self.probing = False
+        self.condition = threading.Condition()
+        self.stats = {"opened": 0, "probes": 0, "held_requests": 0, "held_seconds": 0.0}
+
+    def _open(self, logger, reason):
+        self.state = "open"
+        self.opened_until = time.monotonic() + self.next_open_seconds
+        self.stats["opened"] += 1
+        logger.warning(f"Circuit breaker opened ({reason}), holding model requests for {self.next_open_seconds:g}s")
+        self.next_open_seconds = min(self.max_open_seconds, self.next_open_seconds * 2)
+
+    def before_request(self, logger, data_flag):
+        """
+        Block until a request may be sent; return whether it is the probe.
+        """
+        started = time.monotonic()
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.state == "open" and now >= self.opened_until:
+                    self.state = "half_open"
+                if self.state == "closed":
+                    probe = False
+                    break
+                if self.state == "half_open" and not self.probing:
+                    self.probing = True
+                    self.stats["probes"] += 1
+                    logger.info(f"Circuit breaker half open, probing with the {data_flag} request")
+                    probe = True
+                    break
+                if _cancel_requested():
+                    raise RequestCancelled(f"{data_flag} request was cancelled")
+                remaining = self.max_wait - (now - started)
+                if remaining <= 0:
+                    raise CircuitOpenError(
+                        f"{data_flag} request held back by the open circuit breaker for {self.max_wait:g}s"
+                    )
+                until_half_open = self.opened_until - now if self.state == "open" else remaining
+                # Wake up now and then to notice cancelled hedges
+                self.condition.wait(min(until_half_open, remaining, 1.0))
+            held = time.monotonic() - started
+            if held > 0.001:
+                self.stats["held_requests"] += 1
+                self.stats["held_seconds"] += held
+        return probe
+
+    def record(self, probe, failed, logger):
+        """
+        Record the outcome of a request: failed is True for a backend error,
+        False for any answer, None when there is none (a cancelled hedge).
+        """
+        with self.condition:
+            if probe:
+                self.probing = False
+                if failed:
+                    self._open(logger, "probe failed")
+                elif failed is not None:
+                    self.state = "closed"
+                    self.outcomes.clear()
+                    self.next_open_seconds = self.open_seconds
+                    logger.info("Circuit breaker closed, the probe succeeded")
+                self.condition.notify_all()
+                return
+            # Outcomes of requests sent before the circuit opened are stale
+            if self.state != "closed" or failed is None:
+                return
+            self.outcomes.append(failed)
+            failures = sum(self.outcomes)
+            if (
+                failed
+                and len(self.outcomes) >= self.min_requests
+                and failures >= self.error_threshold * len(self.outcomes)
+            ):
+                self._open(logger, f"{failures} of the last {len(self.outcomes)} requests failed")
+
+
+_BREAKER = CircuitBreaker()
+
+
+def configure_circuit_breaker(enabled=True, **kwargs):
+    """
+    Set up the circuit breaker every chat_completion call passes through
+    (see CircuitBreaker for kwargs), or turn it off.
+    """
+    global _BREAKER
+    _BREAKER = CircuitBreaker(**kwargs) if enabled else None
+
+
+def circuit_breaker_stats():
+    """
+    Return {"state", "opened", "probes", "held_requests", "held_seconds"} of
+    the circuit breaker, or None when it is off.
+    """
+    if _BREAKER is None:
+        return None
+    with _BREAKER.condition:
+        return {"state": _BREAKER.state, **_BREAKER.stats}
+
+
+def is_backend_error(error):
+    """
+    Whether error is the model backend failing (timeouts, connection,
+    server and throttling errors, or an open circuit) rather than the
+    request itself, so the work it interrupted is worth retrying later.
+    """
+    return isinstance(error, CircuitOpenError) or _error_class(error) is not None
+
+
+# Bump whenever the cached response format changes so that older entries
+# are no longer served
+RESPONSE_CACHE_VERSION = 1
+
+
+class ResponseCache:
+    """
+    On-disk cache of chat completion responses, keyed by a SHA-256 hash of
+    the request: model, parameters and messages, images included as their
+    base64 data. Entries are one JSON file each below directory; past
+    ttl_seconds they are no longer served, and once the files exceed
+    max_bytes the least recently used ones are deleted.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, ttl_seconds=7 * 24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        # {key: [size, last used]}, read from the directory on first use
+        self._entries = None
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "expired": 0, "evictions": 0, "tokens_saved": 0}
+
+    def key(self, request):
+        payload = json.dumps(
+            {"version": RESPONSE_CACHE_VERSION, "request": request}, sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _index(self):
+        if self._entries is None:
+            self._entries = {}
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    if name.endswith(".json"):
+                        stat = os.stat(os.path.join(root, name))
+                        self._entries[name[:-5]] = [stat.st_size, stat.st_mtime]
+        return self._entries
+
+    def _remove(self, key):
+        self._index().pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def get(self, key):
+        """
+        Return the cached ChatCompletion for key, or None.
+        """
+        with self.lock:
+            path = self._path(key)
+            try:
+                with open(path, "r", encoding="utf-8") as cache_file:
+                    entry = json.load(cache_file)
+                response = ChatCompletion.model_validate(entry["response"])
+            except (OSError, ValueError, KeyError):
+                # Missing, or unreadable after an interrupted write
+                self._remove(key)
+                self.stats["misses"] += 1
+                return None
+            if time.time() - entry.get("created", 0) > self.ttl_seconds:
+                self._remove(key)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            now = time.time()
+            os.utime(path, (now, now))
+            self._index().setdefault(key, [os.path.getsize(path), now])[1] = now
+            self.stats["hits"] += 1
+            if response.usage:
+                self.stats["tokens_saved"] += response.usage.total_tokens
+            return response
+
+    def put(self, key, response):
+        """
+        Store response for key, then evict down to max_bytes.
+        """
+        data = json.dumps({"created": time.time(), "response": response.model_dump(mode="json")})
+        with self.lock:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "w", encoding="utf-8") as cache_file:
+                cache_file.write(data)
+            os.replace(temporary_path, path)
+            entries = self._index()
+            entries[key] = [len(data), time.time()]
+            self.stats["stores"] += 1
+            total = sum(size for size, _ in entries.values())
+            for old_key, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+                if total <= self.max_bytes:
+                    break
+                self._remove(old_key)
+                total -= size
+                self.stats["evictions"] += 1
+
+
+_RESPONSE_CACHE = None
+
+
+def configure_response_cache(directory=None, max_bytes=512 * 1024 * 1024, ttl_seconds=7 * 24 * 3600):
+    """
+    Cache the responses of chat_completion calls made with cache=True below
+    directory (see ResponseCache); None or max_bytes 0 turns the cache off.
+    """
+    global _RESPONSE_CACHE
+    _RESPONSE_CACHE = ResponseCache(directory, max_bytes, ttl_seconds) if directory and max_bytes else None
+
+
+def response_cache_stats():
+    """
+    Return {"hits", "misses", "stores", "expired", "evictions",
+    "tokens_saved"} of the response cache, or None when it is off.
+    """
+    if _RESPONSE_CACHE is None:
+        return None
+    with _RESPONSE_CACHE.lock:
+        return dict(_RESPONSE_CACHE.stats)
+
+
+def _cached_response(kwargs, logger, data_flag):
+    """
+    Return (cache key, cached response or None) for a request, or (None,
+    None) while the response cache is off.
+    """
+    response_cache = _RESPONSE_CACHE
+    if response_cache is None:
+        return None, None
+    cache_key = response_cache.key(kwargs)
+    response = response_cache.get(cache_key)
+    if response is not None:
+        saved = response.usage.total_tokens if response.usage else 0
+        logger.info(f"{data_flag} response served from the response cache, {saved} tokens saved")
+    return cache_key, response
+
+
+def _cache_response(cache_key, response, kwargs):
+    """
+    Store a complete response; truncated or, for JSON requests, unparsable
+    ones are left out.
+    """
+    response_cache = _RESPONSE_CACHE
+    if cache_key is None or response_cache is None or not isinstance(response, ChatCompletion):
+        return
+    if not response.choices or response.choices[0].finish_reason != "stop":
+        return
+    if (kwargs.get("response_format") or {}).get("type") == "json_object" and not _json_content(response):
+        return
+    response_cache.put(cache_key, response)
+
+def chat_completion(client, logger, data_flag, image_tokens=0, cache=False, **kwargs):
+    """
+    Send client.chat.completions.create(**kwargs) through the request
+    scheduler, retrying it per the retry policies, and log its estimated and
+    actual prompt tokens.
+
+    Every attempt is charged to the scheduler. A 429 also holds back the
+    deployment's other requests until its Retry-After has passed, so they
+    do not run into the same throttling.
+
+    Every attempt also passes the circuit breaker, which holds it back while
+    the backend keeps failing.
+
+    With a ClientPool as client, every attempt goes to the member the pool
+    selects, with model mapped to that member's deployment, and its outcome
+    is reported back to the pool.
+
+    Args:
+        image_tokens: Estimated tokens of the images in the messages (see
+            image_utils.prepare_image_blocks)
+        cache: Serve the response from the response cache, and store it
+            there, for deterministic requests (see configure_response_cache)
+    """
+    cache_key, response = _cached_response(kwargs, logger, data_flag) if cache else (None, None)
+    if response is not None:
+        return response
+    pool = client if isinstance(client, ClientPool) else None
+    deployment = kwargs.get("model", "")
+    request_client, request_kwargs = client, kwargs
+    failovers = 0
+    estimated_tokens = estimate_prompt_tokens(kwargs["messages"], image_tokens)
+    charged = estimated_tokens + kwargs.get("max_tokens", 0)
+    retries = {}
+    backoff_seconds = 0.0
+
+    while True:
+        if _cancel_requested():
+            raise RequestCancelled(f"{data_flag} request was cancelled")
+        breaker = _BREAKER
+        probe = breaker.before_request(logger, data_flag) if breaker is not None else False
+        if pool is not None:
+            try:
+                member = pool.select(kwargs["model"], charged, _SCHEDULER)
+            except ValueError:
+                if breaker is not None:
+                    breaker.record(probe, None, logger)
+                raise
+            deployment = member.quota_key(kwargs["model"])
+            request_client = pool.clients[member.name]
+            request_kwargs = {**kwargs, "model": member.deployment(kwargs["model"])}
+        waited = _SCHEDULER.acquire(deployment, charged)
+        if waited > 0.001:
+            logger.info(f"Waited {waited:.2f}s for {deployment} quota before the {data_flag} request")
+        try:
+            response = request_client.chat.completions.create(**request_kwargs)
+            if pool is not None:
+                pool.report(member, False, logger)
+            if breaker is not None:
+                breaker.record(probe, False, logger)
+            break
+        except RequestCancelled:
+            _SCHEDULER.reconcile(deployment, charged, estimated_tokens)
+            if breaker is not None:
+                breaker.record(probe, None, logger)
+            raise
+        except Exception as error:
+            error_class = _error_class(error)
+            if breaker is not None:
+                breaker.record(probe, error_class in _UNHEALTHY_ERRORS, logger)
+            # A throttled request used nothing; any other failure is assumed to have used its prompt
+            _SCHEDULER.reconcile(deployment, charged, 0 if error_class == "rate_limit" else estimated_tokens)
+            if pool is not None:
+                misconfigured = isinstance(error, _MISCONFIGURED_ERRORS)
+                pool.report(member, misconfigured or error_class in _UNHEALTHY_ERRORS, logger)
+                if misconfigured and failovers < len(pool.members) - 1:
+                    failovers += 1
+                    logger.warning(
+                        f"{data_flag} request failed on deployment {member.name} "
+                        f"({error.__class__.__name__}), failing over"
+                    )
+                    continue
+            policy = _RETRY_POLICIES.get(error_class)
+            retry = retries.get(error_class, 0)
+            if policy is None or retry >= policy.max_retries:
+                _record_retries(retries, backoff_seconds, failed=True)
+                if retries:
+                    logger.error(
+                        f"{data_flag} request failed after {sum(retries.values())} retries {retries}: {error}"
+                    )
+                raise
+            retry_after = _retry_after(error)
+            delay = policy.delay(retry, retry_after)
+            if error_class == "rate_limit":
+                _SCHEDULER.pause(deployment, delay)
+                if pool is not None:
+                    # Only wait while no other member has quota left either
+                    delay = min(delay, pool.wait_time(kwargs["model"], charged, _SCHEDULER))
+            retries[error_class] = retry + 1
+            backoff_seconds += delay
+            logger.warning(
+                f"{data_flag} request hit {error_class} ({error.__class__.__name__}), retry "
+                f"{retry + 1}/{policy.max_retries} in {delay:.1f}s"
+                + (f" (Retry-After {retry_after:g}s)" if retry_after else "")
+                + (f" on another deployment than {member.name}" if pool is not None and delay == 0 else "")
+            )
+            cancel_event = getattr(_ATTEMPT, "cancel_event", None)
+            if cancel_event is not None:
+                cancel_event.wait(delay)
+            else:
+                time.sleep(delay)
+
+    usage = getattr(response, "usage", None)
+    _SCHEDULER.reconcile(deployment, charged, usage.total_tokens if usage else estimated_tokens)
+    _record_retries(retries, backoff_seconds, failed=False)
+    if retries:
+        logger.info(f"{data_flag} request succeeded after retries {retries}, {backoff_seconds:.1f}s backing off")
+    log_prompt_tokens(response, estimated_tokens, logger, data_flag)
+    _cache_response(cache_key, response, kwargs)
+    return response
+
+
+def _record_retries(retries, backoff_seconds, failed):
+    with _RETRY_STATS_LOCK:
+        _RETRY_STATS["calls"] += 1
+        _RETRY_STATS["failed_calls"] += failed
+        if retries:
+            _RETRY_STATS["retried_calls"] += 1
+            _RETRY_STATS["backoff_seconds"] += backoff_seconds
+            for error_class, count in retries.items():
+                _RETRY_STATS["retries"][error_class] = _RETRY_STATS["retries"].get(error_class, 0) + count
+
+
+class RequestCancelled(Exception):
+    """Raised in a request attempt that lost its hedge race and was cancelled."""
+
+
+# Cancel event of the request attempt running on the current thread, if any
+_ATTEMPT = threading.local()
+
+
+def _cancel_requested():
+    cancel_event = getattr(_ATTEMPT, "cancel_event", None)
+    return cancel_event is not None and cancel_event.is_set()
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+class HedgePolicy:
+    """
+    When and how often to hedge: a request still running after the
+    percentile latency of the last window requests of its kind gets one
+    duplicate, once min_samples latencies are known and as long as hedges
+    stay within max_hedge_ratio of the requests.
+    """
+
+    def __init__(self, max_hedge_ratio=0.1, percentile=95, window=100, min_samples=20):
+        self.max_hedge_ratio = max_hedge_ratio
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        # {hedge_key: {"latencies", "calls", "hedges", "hedge_wins", "observed",
+        # "unhedged", "aborted_primaries"}}
+        self.requests = {}
+
+    def _entry(self, hedge_key):
+        if hedge_key not in self.requests:
+            self.requests[hedge_key] = {
+                "latencies": deque(maxlen=self.window),
+                "calls": 0,
+                "hedges": 0,
+                "hedge_wins": 0,
+                # Latency of every call, and of its first request, i.e. without hedging
+                "observed": deque(maxlen=1000),
+                "unhedged": deque(maxlen=1000),
+                # First requests aborted after their hedge won, whose unhedged
+                # latency is only known to be at least the time they ran
+                "aborted_primaries": 0,
+            }
+        return self.requests[hedge_key]
+
+    def threshold(self, hedge_key):
+        """
+        Seconds after which a request of hedge_key is hedged, or None while
+        too few latencies are known.
+        """
+        with self.lock:
+            entry = self._entry(hedge_key)
+            entry["calls"] += 1
+            if len(entry["latencies"]) < self.min_samples:
+                return None
+            return _percentile(entry["latencies"], self.percentile)
+
+    def allow_hedge(self, hedge_key):
+        with self.lock:
+            entry = self._entry(hedge_key)
+            if entry["hedges"] + 1 > self.max_hedge_ratio * entry["calls"]:
+                return False
+            entry["hedges"] += 1
+            return True
+
+    def record(self, hedge_key, latency, hedge_won):
+        """
+        Record a call that took latency seconds. When its hedge won, the
+        latency of its first request is recorded by record_unhedged once
+        that request ends.
+        """
+        with self.lock:
+            entry = self._entry(hedge_key)
+            entry["latencies"].append(latency)
+            entry["observed"].append(latency)
+            if not hedge_won:
+                entry["unhedged"].append(latency)
+            entry["hedge_wins"] += hedge_won
+
+    def record_unhedged(self, hedge_key, latency, aborted):
+        """
+        Record the latency of a first request that lost to its hedge; aborted
+        requests count with the time they ran until they were aborted.
+        """
+        with self.lock:
+            entry = self._entry(hedge_key)
+            entry["unhedged"].append(latency)
+            entry["aborted_primaries"] += aborted
+
+    def stats(self):
+        with self.lock:
+            summary = {}
+            for hedge_key, entry in self.requests.items():
+                observed_p99 = _percentile(entry["observed"], 99)
+                unhedged_p99 = _percentile(entry["unhedged"], 99)
+                summary[hedge_key] = {
+                    "calls": entry["calls"],
+                    "hedges": entry["hedges"],
+                    "hedge_wins": entry["hedge_wins"],
+                    "p50_seconds": round(_percentile(entry["observed"], 50), 3),
+                    "p95_seconds": round(_percentile(entry["observed"], 95), 3),
+                    "p99_seconds": round(observed_p99, 3),
+                    # Against the latencies of the first requests; a lower
+                    # bound when any of them were aborted
+                    "p99_reduction_seconds": round(unhedged_p99 - observed_p99, 3),
+                    "aborted_primaries": entry["aborted_primaries"],
+                }
+            return summary
+
+
+_HEDGE_POLICY = None
+# First requests and hedges run on executors of their own, so hedges never
+# queue behind the slow first requests they are meant to overtake
+_PRIMARY_EXECUTOR = None
+_HEDGE_EXECUTOR = None
+
+
+def configure_hedging(
+    enabled=False, max_hedge_ratio=0.1, percentile=95, window=100, min_samples=20, max_in_flight=32
+):
+    """
+    Turn hedging of hedged_chat_completion calls on or off (see HedgePolicy).
+
+    Args:
+        max_in_flight: Most hedged calls the process makes at once, e.g. the
+            concurrent variants times the chunks each requests at once
+    """
+    global _HEDGE_POLICY, _PRIMARY_EXECUTOR, _HEDGE_EXECUTOR
+    for executor in (_PRIMARY_EXECUTOR, _HEDGE_EXECUTOR):
+        if executor is not None:
+            executor.shutdown(wait=False)
+    _PRIMARY_EXECUTOR = _HEDGE_EXECUTOR = None
+    _HEDGE_POLICY = None
+    if enabled:
+        _PRIMARY_EXECUTOR = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="primary-request")
+        _HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="hedged-request")
+        _HEDGE_POLICY = HedgePolicy(max_hedge_ratio, percentile, window, min_samples)
+
+
+def hedging_stats():
+    """
+    Return {hedge_key: {"calls", "hedges", "hedge_wins", "p50_seconds",
+    "p95_seconds", "p99_seconds", "p99_reduction_seconds",
+    "aborted_primaries"}} of the hedged calls, or {} with hedging off. The
+    reduction is the p99 latency of the first requests minus the p99
+    observed; first requests aborted after losing count with the time they
+    ran, so with aborted_primaries it is a lower bound.
+    """
+    return _HEDGE_POLICY.stats() if _HEDGE_POLICY else {}
+
+
+def _json_content(response):
+    try:
+        json.loads(response.choices[0].message.content)
+        return True
+    except (TypeError, ValueError, AttributeError, IndexError):
+        return False
+
+
+def hedged_chat_completion(client, logger, data_flag, hedge_key, is_valid=_json_content, image_tokens=0, cache=False, **kwargs):
+    """
+    chat_completion that sends a duplicate request when the first one runs
+    longer than usual for hedge_key (see configure_hedging); without hedging
+    it is chat_completion.
+
+    The first response is_valid accepts wins and the other request is
+    cancelled: requests through a LoopBoundClient are aborted, a blocking
+    client's request finishes in the background and is ignored. When
+    neither response is valid the first one is returned; when both fail the
+    first request's error is raised. With cache, a valid response is served
+    from and stored in the response cache.
+    """
+    policy = _HEDGE_POLICY
+    if policy is None:
+        return chat_completion(client, logger, data_flag, image_tokens, cache, **kwargs)
+
+    cache_key, response = _cached_response(kwargs, logger, data_flag) if cache else (None, None)
+    if response is not None:
+        return response
+
+    threshold = policy.threshold(hedge_key)
+    started = time.monotonic()
+
+    # End time of each request, by its data flag
+    finished = {}
+
+    def attempt(cancel_event, attempt_flag):
+        _ATTEMPT.cancel_event = cancel_event
+        try:
+            return chat_completion(client, logger, attempt_flag, image_tokens, **kwargs)
+        finally:
+            _ATTEMPT.cancel_event = None
+            finished[attempt_flag] = time.monotonic()
+
+    cancel_event = threading.Event()
+    attempts = [(cancel_event, _PRIMARY_EXECUTOR.submit(attempt, cancel_event, data_flag))]
+    hedge_sent = False
+    fallback = None
+    errors = []
+    pending = {attempts[0][1]}
+    while pending:
+        timeout = None
+        if not hedge_sent and threshold is not None:
+            timeout = max(0.0, threshold - (time.monotonic() - started))
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            hedge_sent = True
+            if policy.allow_hedge(hedge_key):
+                logger.info(
+                    f"{data_flag} request passed the p{policy.percentile} latency of {threshold:.1f}s, "
+                    "sending a hedged duplicate"
+                )
+                cancel_event = threading.Event()
+                hedge = _HEDGE_EXECUTOR.submit(attempt, cancel_event, f"{data_flag} (hedge)")
+                attempts.append((cancel_event, hedge))
+                pending.add(hedge)
+            continue
+        for future in done:
+            if future.exception() is not None:
+                errors.append(future.exception())
+                continue
+            response = future.result()
+            if is_valid(response):
+                latency = time.monotonic() - started
+                hedge_won = future is not attempts[0][1]
+                if hedge_won:
+                    logger.info(f"Hedged duplicate of {data_flag} won after {latency:.1f}s")
+                    # The first request's own latency, once it answers or is aborted
+                    attempts[0][1].add_done_callback(
+                        lambda primary: policy.record_unhedged(
+                            hedge_key,
+                            finished[data_flag] - started,
+                            isinstance(primary.exception(), RequestCancelled),
+                        )
+                    )
+                policy.record(hedge_key, latency, hedge_won)
+                for cancel_event, other in attempts:
+                    if other is not future:
+                        cancel_event.set()
+                _cache_response(cache_key, response, kwargs)
+                return response
+            fallback = fallback or response
+
+    if fallback is not None:
+        policy.record(hedge_key, time.monotonic() - started, False)
+        return fallback
+    primary_error = attempts[0][1].exception()
+    raise primary_error or errors[0]
+
+
+class _LoopBoundCompletions:
+    def __init__(self, async_client, loop):
+        self._async_client = async_client
+        self._loop = loop
+
+    def create(self, **kwargs):
+        future = asyncio.run_coroutine_threadsafe(
+            self._async_client.chat.completions.create(**kwargs), self._loop
+        )
+        cancel_event = getattr(_ATTEMPT, "cancel_event", None)
+        if cancel_event is None:
+            return future.result()
+        # A hedged attempt aborts its request as soon as the other one wins
+        while True:
+            try:
+                return future.result(timeout=0.05)
+            except FutureTimeoutError:
+                if cancel_event.is_set():
+                    future.cancel()
+                    raise RequestCancelled("request was cancelled")
+
+
+class _LoopBoundChat:
+    def __init__(self, completions):
+        self.completions = completions
+
+
+class LoopBoundClient:
+    """
+    Blocking client.chat.completions.create over an AsyncAzureOpenAI client
+    whose requests run on an event loop in another thread.
+
+    The generation and validation helpers take a client and call it
+    synchronously; given this one from worker threads, the requests of every
+    worker share the loop and its connection pool and wait concurrently
+    instead of holding a connection each.
+    """
+
+    def __init__(self, async_client, loop):
+        self.async_client = async_client
+        self.chat = _LoopBoundChat(_LoopBoundCompletions(async_client, loop))
+
+
+class PoolMember:
+    """
+    One Azure OpenAI resource of a ClientPool with its quota and health.
+
+    Config keys: name, endpoint, api_key (or api_key_env naming the variable
+    holding it), api_version, models ({requested model: deployment name};
+    without it every model is served under its own name),
+    requests_per_minute and tokens_per_minute.
+    """
+
+    def __init__(self, config):
+        self.name = config["name"]
+        self.endpoint = config["endpoint"]
+        self.api_key = config.get("api_key") or os.getenv(config.get("api_key_env", "AZURE_OPENAI_API_KEY"), "")
+        self.api_version = config.get("api_version") or os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01")
+        self.models = config.get("models")
+        self.requests_per_minute = config.get("requests_per_minute")
+        self.tokens_per_minute = config.get("tokens_per_minute")
+        # Recent outcomes, True for a failure, and the end of the current ejection
+        self.outcomes = deque(maxlen=20)
+        self.ejected_until = 0.0
+        self.stats = {"requests": 0, "errors": 0, "ejections": 0}
+
+    def serves(self, model):
+        return self.models is None or model in self.models
+
+    def deployment(self, model):
+        return model if self.models is None else self.models[model]
+
+    def quota_key(self, model):
+        """Scheduler key of this member's deployment of model."""
+        return f"{self.name}/{self.deployment(model)}"
+
+    def error_rate(self):
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def client_kwargs(self):
+        return {
+            "azure_endpoint": self.endpoint,
+            "api_key": self.api_key,
+            "api_version": self.api_version,
+            "max_retries": 0,
+        }
+
+
+class ClientPool:
+    """
+    Several Azure OpenAI deployments (resources or regions) used as one
+    client by chat_completion.
+
+    Each request goes to a member serving its model, drawn at random with
+    weights of the requests the member's remaining quota in the request
+    scheduler admits times its recent success rate, so load follows free
+    capacity and moves away from failing endpoints. A member that fails three requests in a row, or
+    half of its last ten or more, is ejected for cooldown seconds; the
+    retries of its requests go to the other members.
+    """
+
+    def __init__(self, members, cooldown=30.0, clients=None, lock=None):
+        if not members:
+            raise ValueError("A client pool needs at least one deployment")
+        self.members = members
+        self.cooldown = cooldown
+        # Guards the members' health, shared with the views from bind_loop
+        self.lock = lock or threading.Lock()
+        self.clients = clients or {member.name: AzureOpenAI(**member.client_kwargs()) for member in members}
+
+    @classmethod
+    def from_config(cls, config_path):
+        """
+        Load a pool from a JSON file of the form {"cooldown_seconds": 30,
+        "deployments": [PoolMember config, ...]}.
+        """
+        with open(config_path, "r", encoding="utf-8") as config_file:
+            config = json.load(config_file)
+        return cls(
+            [PoolMember(member) for member in config["deployments"]],
+            cooldown=config.get("cooldown_seconds", 30.0),
+        )
+
+    def bind_loop(self, loop):
+        """
+        Return a view of this pool, sharing its members' health and the lock
+        guarding it, whose requests run on loop with asyncio clients (see
+        LoopBoundClient).
+        """
+        return ClientPool(
+            self.members,
+            self.cooldown,
+            {
+                member.name: LoopBoundClient(AsyncAzureOpenAI(**member.client_kwargs()), loop)
+                for member in self.members
+            },
+            self.lock,
+        )
+
+    async def aclose(self):
+        for client in self.clients.values():
+            if isinstance(client, LoopBoundClient):
+                await client.async_client.close()
+
+    def select(self, model, tokens, scheduler):
+        """
+        Pick the member for a request of model charged tokens; when every
+        member is ejected or out of quota, the one available soonest.
+        """
+        candidates = [member for member in self.members if member.serves(model)]
+        if not candidates:
+            raise ValueError(f"No deployment in the client pool serves {model}")
+        now = time.monotonic()
+        with self.lock:
+            healthy = [member for member in candidates if member.ejected_until <= now]
+        headrooms = []
+        for member in healthy:
+            scheduler.set_limits(
+                member.quota_key(model), member.requests_per_minute, member.tokens_per_minute
+            )
+            headrooms.append(scheduler.headroom(member.quota_key(model), tokens)[0])
+        # Members without quotas weigh as much as the roomiest one with quotas
+        finite = [headroom for headroom in headrooms if headroom != float("inf")]
+        roomiest = max(finite, default=1.0) or 1.0
+        # A member keeps a little traffic after errors so it can recover
+        weights = [
+            min(headroom, roomiest) * max(0.05, 1.0 - member.error_rate())
+            for member, headroom in zip(healthy, headrooms)
+        ]
+        if healthy and sum(weights) > 0:
+            return random.choices(healthy, weights=weights)[0]
+        if healthy:
+            return min(healthy, key=lambda member: scheduler.headroom(member.quota_key(model), tokens)[1])
+        return min(candidates, key=lambda member: member.ejected_until)
+
+    def wait_time(self, model, tokens, scheduler):
+        """
+        Seconds until some member serving model is neither ejected nor out of
+        quota for a request of tokens.
+        """
+        now = time.monotonic()
+        with self.lock:
+            ejections = {
+                member.name: max(0.0, member.ejected_until - now)
+                for member in self.members
+                if member.serves(model)
+            }
+        waits = []
+        for member in self.members:
+            if member.name in ejections:
+                scheduler.set_limits(
+                    member.quota_key(model), member.requests_per_minute, member.tokens_per_minute
+                )
+                waits.append(max(ejections[member.name], scheduler.headroom(member.quota_key(model), tokens)[1]))
+        return min(waits, default=0.0)
+
+    def report(self, member, failed, logger=None):
+        """
+        Record the outcome of a request to member, ejecting it when it keeps
+        failing.
+        """
+        with self.lock:
+            member.stats["requests"] += 1
+            member.stats["errors"] += failed
+            member.outcomes.append(failed)
+            recent = list(member.outcomes)
+            if failed and (
+                recent[-3:] == [True, True, True]
+                or (len(recent) >= 10 and sum(recent) * 2 >= len(recent))
+            ):
+                member.ejected_until = time.monotonic() + self.cooldown
+                member.outcomes.clear()
+                member.stats["ejections"] += 1
+                if logger is not None:
+                    logger.warning(
+                        f"Ejecting deployment {member.name} from the client pool for {self.cooldown:g}s"
+                    )
+
+    def stats(self):
+        """
+        Return {member name: {"requests", "errors", "ejections", "ejected"}}.
+        """
+        now = time.monotonic()
+        with self.lock:
+            return {
+                member.name: {**member.stats, "ejected": member.ejected_until > now}
+                for member in self.members
+            }
+
+
+async def _run_concurrently_async(task, items, concurrency, async_client):
+    loop = asyncio.get_running_loop()
+    if isinstance(async_client, ClientPool):
+        client = async_client.bind_loop(loop)
+    else:
+        client = LoopBoundClient(async_client, loop)
+    semaphore = asyncio.Semaphore(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        async def run(item):
+            async with semaphore:
+                return await loop.run_in_executor(executor, task, item, client)
+
+        try:
+            return await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
+        finally:
+            if isinstance(client, ClientPool):
+                await client.aclose()
+            else:
+                await async_client.close()
+
+
+def run_concurrently(task, items, concurrency, logger, async_client=None, raise_errors=True):
+    """
+    Run task(item, client) for every item, at most concurrency at a time, and
+    return their results in the order of items.
+
+    Each task runs in a worker thread with a LoopBoundClient, so its model
+    calls overlap with the CPU work (filling, rendering) and the model calls
+    of the other tasks. Every task runs to completion; if any of them failed,
+    the first error is raised afterwards, or with raise_errors=False returned
+    in place of the result of its item.
+
+    Args:
+        task: Function of (item, client)
+        items: Items to run task for
+        concurrency: Tasks in flight at once
+        async_client: AsyncAzureOpenAI client (default: create_async_client()),
+            closed when all tasks are done, or a ClientPool whose members get
+            asyncio clients for the run
+        raise_errors: Raise the first error instead of returning it
+    """
+    items = list(items)
+    results = asyncio.run(
+        _run_concurrently_async(
+            task, items, max(1, concurrency), async_client or create_async_client()
+        )
+    )
+    if not raise_errors:
+        return results
+    errors = [(item, result) for item, result in zip(items, results) if isinstance(result, BaseException)]
+    for item, error in errors:
+        logger.error(f"Error while processing {item}: {error}")
+    if errors:
+        raise errors[0][1]
+    return results
+
+
+def run_with_requeue(run, items, max_requeues, logger, name="item"):
+    """
+    Run run(items), which returns the result or the error of each item in
+    order, and put the items failed by the model backend back at the end of
+    the queue up to max_requeues times each, by when the circuit breaker has
+    usually closed again. Only those items run again; the ones that completed
+    are never repeated.
+
+    Returns:
+        tuple: ([(item, error)] of the items that failed for good, number of requeues)
+    """
+    pending = list(items)
+    requeues = {item: 0 for item in pending}
+    failed = []
+    requeued = 0
+    while pending:
+        retry = []
+        for item, result in zip(pending, run(pending)):
+            if not isinstance(result, BaseException):
+                continue
+            if is_backend_error(result) and requeues[item] < max_requeues:
+                requeues[item] += 1
+                requeued += 1
+                retry.append(item)
+                logger.warning(f"Re-queued {name} {item} after a model backend failure: {result}")
+            else:
+                failed.append((item, result))
+        pending = retry
+    return failed, requeued
@@ -4,13 +4,41 @@ import json
 import os
 import pytz
 import shutil
+import threading
 import uuid
 
 from dotenv import load_dotenv, find_dotenv
-from openai import AzureOpenAI
 
-from utils.genai_utils import generate_human_readable_labels, generate_synthetic_data
-from utils.image_utils import encode_images_to_base64
+from utils.genai_utils import (
+    CHUNK_CONCURRENCY,
+    extract_persona_fields_from_json,
+    generate_human_readable_labels,
+    generate_synthetic_data,
+)
+from utils.image_utils import (
+    configure_payload_cache,
+    configure_vision_images,
+    crop_field_regions,
+    field_rects_by_page,
+    payload_cache_stats,
+)
+from utils.label_utils import confident_labels, infer_local_labels, save_local_label_report
+from utils.llm_utils import (
+    ClientPool,
+    circuit_breaker_stats,
+    configure_circuit_breaker,
+    configure_hedging,
+    configure_response_cache,
+    configure_retries,
+    configure_scheduler,
+    create_client,
+    hedging_stats,
+    response_cache_stats,
+    retry_stats,
+    run_concurrently,
+    run_with_requeue,
+    scheduler_stats,
+)
 from utils.validation_utils import validate_filled_pdf_mapping
 from utils.validation_reporter import ValidationReporter
 from utils.general_utils import (
@@ -21,23 +49,17 @@ from utils.general_utils import (
 from utils.logger_utils import CustomLogger
 from utils.pdf_utils import (
     extract_pdf_fields,
+    has_field_geometry,
+    prompt_field_mappings,
     fill_pdf_fields,
+    fill_pdf_fields_to_bytes,
+    configure_render_pool,
+    pdf_page_sizes,
     pdf_to_images,
     pdf_to_base64,
-    fill_pdf_fields_with_names_and_render_images,
+    load_fieldname_images,
 )
 
-def extract_persona_fields_from_json(output_json):
-    # Heuristic: treat any field with values that look like name, ssn, address, etc. as persona fields
-    persona = {}
-    for label, info in output_json.items():
-        # label: human-readable label; info: {field_name, field_type, field_value}
-        l = label.lower()
-        v = info["field_value"]
-        if any(k in l for k in ["name", "ssn", "social security", "address", "city", "state", "zip", "employer", "dob", "date of birth", "policy", "property", "wages", "salary", "income", "ein", "phone"]):
-            persona[label] = v
-    return persona
-
 def merge_persona(persona, new_persona):
     # New fields from new_persona are added to persona
     for k, v in new_persona.items():
@@ -85,6 +107,168 @@ def get_args():
         default=8,
         help="Font size for field names in fieldname images (default: 8)"
     )
+    parser.add_argument(
+        "--in_memory",
+        action="store_true",
+        default=False,
+        help="Fill, validate and render filled PDFs in memory; only the final PDFs and images are written to disk"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Variants generated at once with the asyncio client; 1 generates them one after another (default: 1)"
+    )
+    parser.add_argument(
+        "--requests_per_minute",
+        type=int,
+        default=None,
+        help="RPM quota of each Azure OpenAI deployment; requests are spread to stay within it (default: unlimited)"
+    )
+    parser.add_argument(
+        "--tokens_per_minute",
+        type=int,
+        default=None,
+        help="TPM quota of each Azure OpenAI deployment; requests are spread to stay within it (default: unlimited)"
+    )
+    parser.add_argument(
+        "--deployments_config",
+        type=str,
+        default=None,
+        help="JSON file of several Azure OpenAI deployments to balance the model requests over, "
+             "each with its own quotas (default: AZURE_OPENAI_DEPLOYMENTS_CONFIG, else the single AZURE_OPENAI_ENDPOINT)"
+    )
+    parser.add_argument(
+        "--llm_max_retries",
+        type=int,
+        default=None,
+        help="Retries of a throttled, timed out or failed model request (default: 6 for 429s, 3 otherwise; 0 disables)"
+    )
+    parser.add_argument(
+        "--hedge_requests",
+        action="store_true",
+        default=False,
+        help="Send a duplicate of a generation or validation request that runs past the p95 latency of its kind; the first valid response wins"
+    )
+    parser.add_argument(
+        "--max_hedge_ratio",
+        type=float,
+        default=0.1,
+        help="Most duplicate requests hedging may send, as a share of the requests (default: 0.1)"
+    )
+    parser.add_argument(
+        "--circuit_breaker_threshold",
+        type=float,
+        default=0.5,
+        help="Share of recent model requests failing with backend errors that opens the circuit breaker "
+             "and pauses all requests; 0 turns it off (default: 0.5)"
+    )
+    parser.add_argument(
+        "--circuit_open_seconds",
+        type=float,
+        default=30.0,
+        help="Seconds the open circuit breaker holds requests back before probing the backend (default: 30)"
+    )
+    parser.add_argument(
+        "--max_requeues",
+        type=int,
+        default=2,
+        help="Times a variant, or a PDF failed before its variants, is put back at the end of the queue after a model backend failure (default: 2)"
+    )
+    parser.add_argument(
+        "--render_workers",
+        type=int,
+        default=None,
+        help="Processes shared by all samples for rendering PDF pages (default: CPU count, 1 renders in-process)"
+    )
+    parser.add_argument(
+        "--image_dpi",
+        type=int,
+        default=300,
+        help="Resolution of the page images rendered for each sample (default: 300)"
+    )
+    parser.add_argument(
+        "--image_format",
+        type=str,
+        default="jpg",
+        choices=["jpg", "png", "webp"],
+        help="Format of the page images rendered for each sample (default: jpg)"
+    )
+    parser.add_argument(
+        "--image_quality",
+        type=int,
+        default=95,
+        help="JPEG/WebP quality of the page images rendered for each sample (default: 95)"
+    )
+    parser.add_argument(
+        "--validation_escalation_confidence",
+        type=float,
+        default=0.8,
+        help="Repeat the low detail validation pass at high detail when it reports issues or a lower confidence (default: 0.8)"
+    )
+    parser.add_argument(
+        "--full_detail_validation",
+        action="store_true",
+        default=False,
+        help="Validate at high detail straight away instead of starting with a low detail pass"
+    )
+    parser.add_argument(
+        "--image_token_budget",
+        type=int,
+        default=None,
+        help="Image tokens allowed per vision request; images are shrunk or sent at low detail to fit (default: no limit)"
+    )
+    parser.add_argument(
+        "--vision_image_format",
+        type=str,
+        default="jpg",
+        choices=["jpg", "webp", "png"],
+        help="Format the images are re-encoded in for vision requests (default: jpg)"
+    )
+    parser.add_argument(
+        "--vision_image_quality",
+        type=int,
+        default=85,
+        help="JPEG/WebP quality of the images sent in vision requests (default: 85)"
+    )
+    parser.add_argument(
+        "--image_cache_mb",
+        type=int,
+        default=256,
+        help="Memory for encoded images shared by all model calls of the run, 0 disables it (default: 256)"
+    )
+    parser.add_argument(
+        "--response_cache_dir",
+        type=str,
+        default=None,
+        help="Directory caching the responses of the label and validation model calls across runs "
+             "(default: <output_directory>/response_cache)"
+    )
+    parser.add_argument(
+        "--response_cache_mb",
+        type=int,
+        default=512,
+        help="Disk space of the response cache, least recently used responses are dropped beyond it; "
+             "0 disables it (default: 512)"
+    )
+    parser.add_argument(
+        "--response_cache_ttl_hours",
+        type=float,
+        default=168,
+        help="Hours a cached response is served for (default: 168)"
+    )
+    parser.add_argument(
+        "--crop_field_images",
+        action="store_true",
+        default=False,
+        help="Send the model only the rows of the pages around the fields in question instead of whole pages"
+    )
+    parser.add_argument(
+        "--local_label_confidence",
+        type=float,
+        default=0.7,
+        help="Minimum confidence of a label inferred from tooltips or captions to skip the model for that field (default: 0.7, above 1 sends every field to the model)"
+    )
     args = parser.parse_args()
     return args
 
@@ -97,8 +281,8 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
 
     output_directory = os.path.join(os.path.abspath(args.output_directory))
 
-    # Generate field-name-overlaid images for the input PDF
-    fieldname_images = fill_pdf_fields_with_names_and_render_images(
+    # Generate field-name-overlaid images for the input PDF (reused while the PDF is unchanged)
+    fieldname_images, fieldname_image_data, fieldname_analysis = load_fieldname_images(
         pdf_path,
         output_directory,
         os.path.basename(pdf_path),
@@ -112,15 +296,36 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
         logger.error("Cannot proceed - AI model needs fieldname images for mapping")
         raise Exception("Failed to generate fieldname images - this will break AI field mapping")
         
-    # Additional validation for image quality
-    from utils.pdf_utils import validate_fieldname_images
-    if not validate_fieldname_images(fieldname_images, logger):
+    # Additional validation for image quality, analyzed when the images were rendered
+    if not fieldname_analysis["passed"]:
         logger.warning("WARNING: Fieldname images may not contain visible field names")
         logger.warning("This could result in poor AI model performance for field mapping")
         logger.warning("The AI needs to see field names overlaid on the form to work properly")
-    
-    # Encode PNGs as base64 for model input
-    fieldname_image_data = encode_images_to_base64(fieldname_images)
+
+        # Stop sending blank pages and pages whose field names cannot be seen to the model
+        usable_images = {page["image"] for page in fieldname_analysis["pages"] if page["usable"]}
+        if usable_images:
+            skipped_images = [
+                image_path
+                for image_path in fieldname_images
+                if os.path.basename(image_path) not in usable_images
+            ]
+            fieldname_images = [
+                image_path
+                for image_path in fieldname_images
+                if os.path.basename(image_path) in usable_images
+            ]
+            fieldname_image_data = {
+                name: data
+                for name, data in fieldname_image_data.items()
+                if name in usable_images
+            }
+            logger.warning(
+                f"Skipping {len(skipped_images)} unusable fieldname images: "
+                f"{', '.join(os.path.basename(path) for path in skipped_images)}"
+            )
+        else:
+            logger.warning("No fieldname image shows field names - sending all pages anyway")
 
     make_directory(directory=output_directory)
     output_directory = os.path.join(output_directory, document_type)
@@ -157,17 +362,34 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
     )
 
     # Extract or load field mappings
+    field_mappings = None
     if os.path.exists(field_mappings_path):
         print("Field mappings already exist!")
         logger.info("Field mappings already exist!")
         with open(field_mappings_path, "r", encoding='utf-8') as json_file:
-            field_mappings_json = json_file.read()
-        print("Field mappings were read from JSON file successfully!")
-        logger.info("Field mappings were read from JSON file successfully!")
-    else:
+            field_mappings = json.load(json_file)
+        if has_field_geometry(field_mappings):
+            field_mappings_json = json.dumps(prompt_field_mappings(field_mappings), indent=4)
+            print("Field mappings were read from JSON file successfully!")
+            logger.info("Field mappings were read from JSON file successfully!")
+        else:
+            logger.info("Field mappings were written without widget geometry, extracting them again")
+            field_mappings = None
+    if field_mappings is None:
         field_mappings_json = extract_pdf_fields(
             pdf_path=pdf_path_abs, output_path=field_mappings_path, logger=logger
         )
+        with open(field_mappings_path, "r", encoding='utf-8') as json_file:
+            field_mappings = json.load(json_file)
+
+    # Label candidates from tooltips and the captions printed next to each field,
+    # found with a spatial index over the page text. Confident ones replace model
+    # labels; the rest are passed to the label prompts as hints.
+    local_label_candidates = infer_local_labels(pdf_path_abs, field_mappings, logger)
+    label_priors = {
+        field_name: candidate["label"]
+        for field_name, candidate in local_label_candidates.items()
+    }
 
     # Generate or load human readable labels
     if os.path.exists(human_readable_labels_path):
@@ -186,14 +408,47 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
             document_type=document_type
         )
 
+        # Only the fields without a confident local label are sent to the model
+        local_labels = confident_labels(
+            local_label_candidates, min_confidence=args.local_label_confidence
+        )
+        save_local_label_report(
+            candidates=local_label_candidates,
+            local_labels=local_labels,
+            field_mappings=field_mappings,
+            document_type=document_type,
+            output_path=os.path.join(data_directory, f"{document_type}_local_labels.json"),
+            logger=logger,
+        )
+
+        label_image_data = fieldname_image_data
+        if args.crop_field_images:
+            # Send only the rows of the fields the model still has to label
+            label_image_data, _ = crop_field_regions(
+                fieldname_image_data,
+                field_rects_by_page(
+                    field_mappings,
+                    [
+                        field_name
+                        for field_name, info in field_mappings.items()
+                        if info.get("field_type") and field_name not in local_labels
+                    ],
+                ),
+                pdf_page_sizes(pdf_path_abs),
+                logger,
+                "human readable labels",
+            )
+
         human_readable_labels = generate_human_readable_labels(
             client=client,
-            image_data=fieldname_image_data,
+            image_data=label_image_data,
             document_type=document_type,
             human_readable_prompt=human_readable_prompt,
             output_path=human_readable_labels_path,
             logger=logger,
             field_mappings_json=field_mappings_json,
+            local_labels=local_labels,
+            label_priors=label_priors,
         )
 
     total_samples = args.number_of_variants
@@ -209,8 +464,13 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
     else:
         logger.info("Validation disabled via --disable_validation flag")
 
-    # Generate synthetic data variants
-    for idx in range(1, total_samples + 1):
+    # Guards the shared labels file and the validation reporter when variants
+    # run concurrently
+    variant_lock = threading.Lock()
+
+    def generate_variant(idx, client, sample_directories):
+        """Generate, fill, validate and render variant idx."""
+        nonlocal human_readable_labels
         
         persona_dir = os.path.join(args.output_directory, "persona_variants")
         os.makedirs(persona_dir, exist_ok=True)
@@ -253,6 +513,7 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
         output_pdf_directory = os.path.join(pdf_directory, sample_id)
         output_image_directory = os.path.join(image_directory, sample_id)
 
+        sample_directories.extend([output_json_directory, output_pdf_directory, output_image_directory])
         make_directory(directory=output_json_directory)
         make_directory(directory=output_pdf_directory)
         make_directory(directory=output_image_directory)
@@ -285,13 +546,22 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
             data_flag=sample_flag,
             logger=logger,
         )
-        fill_pdf_fields(
-            input_pdf=pdf_path_abs,
-            output_pdf_path=output_pdf_path,
-            data=output_json,
-            data_flag=sample_flag,
-            logger=logger,
-        )
+        filled_pdf_bytes = None
+        if args.in_memory:
+            filled_pdf_bytes = fill_pdf_fields_to_bytes(
+                input_pdf=pdf_path_abs,
+                data=output_json,
+                data_flag=sample_flag,
+                logger=logger,
+            )
+        else:
+            fill_pdf_fields(
+                input_pdf=pdf_path_abs,
+                output_pdf_path=output_pdf_path,
+                data=output_json,
+                data_flag=sample_flag,
+                logger=logger,
+            )
         
         # ========== NEW: VALIDATION AND CORRECTION LOGIC ==========
         # Only run validation if not disabled
@@ -300,8 +570,8 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
             
             # Load current mappings for validation
             with open(field_mappings_path, "r", encoding='utf-8') as f:
-                current_field_mappings = json.load(f)
-            with open(human_readable_labels_path, "r", encoding='utf-8') as f:
+                current_field_mappings = prompt_field_mappings(json.load(f))
+            with variant_lock, open(human_readable_labels_path, "r", encoding='utf-8') as f:
                 current_human_readable_labels = json.load(f)
             
             # Extract current persona for consistency
@@ -311,6 +581,7 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
                 filled_pdf_path=output_pdf_path,
                 original_pdf_path=pdf_path_abs,  # Pass the original PDF path
                 fieldname_images=fieldname_images,
+                fieldname_image_data=fieldname_image_data,
                 field_mappings=current_field_mappings,
                 human_readable_labels=current_human_readable_labels,
                 synthetic_data=output_json,
@@ -320,7 +591,13 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
                 document_type=document_type,
                 data_generation_prompt=data_generation_prompt,
                 logger=logger,
-                max_retries=2
+                max_retries=2,
+                filled_pdf_bytes=filled_pdf_bytes,
+                label_priors=label_priors,
+                field_geometry=field_mappings if args.crop_field_images else None,
+                escalation_confidence=(
+                    None if args.full_detail_validation else args.validation_escalation_confidence
+                )
             )
             
             # Add to validation reporter if it exists
@@ -349,13 +626,21 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
                 
                 # CRITICAL FIX: Refill PDF with regenerated data
                 logger.info(f"Refilling PDF with regenerated data for {sample_flag}")
-                fill_pdf_fields(
-                    input_pdf=pdf_path_abs,
-                    output_pdf_path=output_pdf_path,
-                    data=regenerated_data,
-                    data_flag=f"{sample_flag} (regenerated)",
-                    logger=logger,
-                )
+                if args.in_memory:
+                    filled_pdf_bytes = fill_pdf_fields_to_bytes(
+                        input_pdf=pdf_path_abs,
+                        data=regenerated_data,
+                        data_flag=f"{sample_flag} (regenerated)",
+                        logger=logger,
+                    )
+                else:
+                    fill_pdf_fields(
+                        input_pdf=pdf_path_abs,
+                        output_pdf_path=output_pdf_path,
+                        data=regenerated_data,
+                        data_flag=f"{sample_flag} (regenerated)",
+                        logger=logger,
+                    )
             elif regenerated_data == output_json:
                 logger.info(f"Regenerated data identical to original - no changes needed for {sample_flag}")
             else:
@@ -365,31 +650,32 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
             
             # Update human readable labels if corrected (for future samples)
             if corrected_labels != current_human_readable_labels:
-                logger.info(f"Updating human readable labels based on validation feedback")
-                human_readable_labels = json.dumps(corrected_labels, indent=4)
+                with variant_lock:
+                    logger.info(f"Updating human readable labels based on validation feedback")
+                    human_readable_labels = json.dumps(corrected_labels, indent=4)
                 
-                # Save updated labels for future use
-                corrected_labels_path = human_readable_labels_path.replace('.json', '_validated.json')
-                save_json(
-                    data=corrected_labels,
-                    json_path=corrected_labels_path,
-                    data_flag="Validated human readable labels",
-                    logger=logger,
-                )
+                    # Save updated labels for future use
+                    corrected_labels_path = human_readable_labels_path.replace('.json', '_validated.json')
+                    save_json(
+                        data=corrected_labels,
+                        json_path=corrected_labels_path,
+                        data_flag="Validated human readable labels",
+                        logger=logger,
+                    )
                 
-                # Also update the main file so subsequent samples use corrected labels
-                logger.info(f"Updating main human readable labels file for future samples")
-                save_json(
-                    data=corrected_labels,
-                    json_path=human_readable_labels_path,
-                    data_flag="Updated human readable labels",
-                    logger=logger,
-                )
+                    # Also update the main file so subsequent samples use corrected labels
+                    logger.info(f"Updating main human readable labels file for future samples")
+                    save_json(
+                        data=corrected_labels,
+                        json_path=human_readable_labels_path,
+                        data_flag="Updated human readable labels",
+                        logger=logger,
+                    )
                 
-                corrections_made.append({
-                    "type": "label_correction", 
-                    "description": "Corrected human-readable field labels"
-                })
+                    corrections_made.append({
+                        "type": "label_correction", 
+                        "description": "Corrected human-readable field labels"
+                    })
             
             # Save regenerated data if different from original
             if data_was_regenerated:
@@ -412,11 +698,12 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
             
             # Add to validation reporter
             if validation_reporter is not None:
-                validation_reporter.add_sample_report(
-                    sample_id=sample_id,
-                    validation_result=validation_result,
-                    corrections_made=corrections_made
-                )
+                with variant_lock:
+                    validation_reporter.add_sample_report(
+                        sample_id=sample_id,
+                        validation_result=validation_result,
+                        corrections_made=corrections_made
+                    )
             
             # Update files if corrections were made
             if not validation_successful:
@@ -426,12 +713,21 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
         else:
             logger.info(f"Validation disabled - skipping recheck for {sample_flag}")
         
+        # In-memory mode: the final, validated PDF is the first thing written to disk
+        if args.in_memory:
+            with open(output_pdf_path, "wb") as pdf_file:
+                pdf_file.write(filled_pdf_bytes)
+            logger.info(f"Final PDF written to: {output_pdf_path}")
+        
         # Move image generation to the end of the loop to ensure it captures the final, validated PDF state.
         pdf_to_images(
-            pdf_path=output_pdf_path,
+            pdf_path=filled_pdf_bytes if args.in_memory else output_pdf_path,
             image_directory=output_image_directory,
             data_flag=sample_flag,
             logger=logger,
+            dpi=args.image_dpi,
+            image_format=args.image_format,
+            quality=args.image_quality,
         )
         
         # Copy filled PDF to consolidated folder
@@ -443,7 +739,11 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
         consolidated_pdf_path = os.path.join(consolidated_dir, consolidated_filename)
         
         try:
-            shutil.copy2(output_pdf_path, consolidated_pdf_path)
+            if args.in_memory:
+                with open(consolidated_pdf_path, "wb") as pdf_file:
+                    pdf_file.write(filled_pdf_bytes)
+            else:
+                shutil.copy2(output_pdf_path, consolidated_pdf_path)
             logger.info(f"Copied filled PDF to consolidated folder: {consolidated_filename}")
         except Exception as e:
             logger.warning(f"Failed to copy PDF to consolidated folder: {str(e)}")
@@ -451,6 +751,56 @@ def process_single_pdf(pdf_path, args, logger, client, prompts):
         print(f"{sample_flag} has been generated successfully!")
         logger.info(f"{sample_flag} has been generated successfully!")
 
+    def run_variant(idx, client):
+        """
+        Generate variant idx; if it fails, its sample directories are removed so
+        that a requeued attempt leaves no partial output next to the others.
+        """
+        sample_directories = []
+        try:
+            return generate_variant(idx, client, sample_directories)
+        except Exception:
+            for directory in sample_directories:
+                shutil.rmtree(directory, ignore_errors=True)
+            raise
+
+    def run_variants(indices):
+        """Run the variants in indices and return the result or error of each."""
+        if args.concurrency > 1:
+            # Variants overlap; labels corrected by one variant reach the variants
+            # started after it, and each variant keeps its own persona file
+            logger.info(f"Generating {len(indices)} variants, {args.concurrency} at a time")
+            return run_concurrently(
+                run_variant,
+                indices,
+                args.concurrency,
+                logger,
+                async_client=client if isinstance(client, ClientPool) else None,
+                raise_errors=False,
+            )
+        results = []
+        for idx in indices:
+            try:
+                results.append(run_variant(idx, client))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    # Generate synthetic data variants; only the variants failed by the model
+    # backend run again, so the completed ones are not regenerated
+    failed_variants, _ = run_with_requeue(
+        run_variants, range(1, total_samples + 1), args.max_requeues, logger, name="variant"
+    )
+    for idx, error in failed_variants:
+        print(f"Error while generating variant {idx} of {document_type}: {error}")
+        logger.error(f"Error while generating variant {idx} of {document_type}: {error}")
+    if failed_variants:
+        # Not a backend error, so that the PDF is not requeued and its
+        # completed variants stay as they are
+        raise RuntimeError(
+            f"{len(failed_variants)} of {total_samples} variants of {document_type} failed"
+        ) from failed_variants[0][1]
+
     # Generate and save validation report
     if validation_reporter is not None:
         try:
@@ -470,19 +820,46 @@ if __name__ == "__main__":
 
     logger = CustomLogger(logger_name="SyntheticData", log_prefix="SyntheticData")
     args = get_args()
+    configure_render_pool(args.render_workers)
+    configure_vision_images(
+        token_budget=args.image_token_budget,
+        image_format=args.vision_image_format,
+        quality=args.vision_image_quality,
+    )
+    configure_payload_cache(args.image_cache_mb * 1024 * 1024)
+    configure_scheduler(
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+    )
+    configure_retries(max_retries=args.llm_max_retries)
+    configure_hedging(
+        enabled=args.hedge_requests,
+        max_hedge_ratio=args.max_hedge_ratio,
+        # Every variant makes up to CHUNK_CONCURRENCY hedged calls at once
+        max_in_flight=max(1, args.concurrency) * CHUNK_CONCURRENCY,
+    )
+    configure_response_cache(
+        directory=args.response_cache_dir or os.path.join(os.path.abspath(args.output_directory), "response_cache"),
+        max_bytes=args.response_cache_mb * 1024 * 1024,
+        ttl_seconds=args.response_cache_ttl_hours * 3600,
+    )
+    configure_circuit_breaker(
+        enabled=args.circuit_breaker_threshold > 0,
+        error_threshold=args.circuit_breaker_threshold,
+        open_seconds=args.circuit_open_seconds,
+    )
 
     # Initialize OpenAI client
-    client = AzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
-        api_key=os.getenv("AZURE_OPENAI_API_KEY", ""),
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION", ""),
-    )
+    client = create_client(args.deployments_config)
 
     # Load prompts
     prompt_filepath = os.path.abspath(args.prompt_filepath)
     with open(prompt_filepath, "r", encoding="utf-8") as json_file:
         prompts = json.load(json_file)
 
+    # Raised once the run statistics below are logged
+    run_error = None
+
     if args.batch_directory:
         # Batch processing mode
         batch_dir = os.path.abspath(args.batch_directory)
@@ -513,24 +890,31 @@ if __name__ == "__main__":
         logger.info(f"Output directory: {args.output_directory}")
         logger.info(f"====================================")
 
-        successful_count = 0
-        failed_count = 0
-
-        for pdf_file in pdf_files:
-            pdf_path = os.path.join(batch_dir, pdf_file)
-            print(f"\n[{successful_count + failed_count + 1}/{len(pdf_files)}] Processing: {pdf_file}")
-            try:
-                process_single_pdf(pdf_path, args, logger, client, prompts)
-                successful_count += 1
-            except Exception as e:
-                failed_count += 1
-                print(f"✗ Failed to process {pdf_file}: {e}")
-                logger.error(f"Failed to process {pdf_file}: {e}", exc_info=True)
+        def run_pdfs(batch):
+            """Process the PDFs in batch and return the result or error of each."""
+            results = []
+            for pdf_file in batch:
+                print(f"\n[{pdf_files.index(pdf_file) + 1}/{len(pdf_files)}] Processing: {pdf_file}")
+                try:
+                    results.append(process_single_pdf(os.path.join(batch_dir, pdf_file), args, logger, client, prompts))
+                except Exception as e:
+                    results.append(e)
+            return results
+
+        # A PDF goes back to the queue only when the model backend failed it
+        # before its variants; failed variants are requeued on their own
+        failed_pdfs, requeued_count = run_with_requeue(run_pdfs, pdf_files, args.max_requeues, logger, name="PDF")
+        for pdf_file, e in failed_pdfs:
+            print(f"✗ Failed to process {pdf_file}: {e}")
+            logger.error(f"Failed to process {pdf_file}: {e}", exc_info=e)
+        failed_count = len(failed_pdfs)
+        successful_count = len(pdf_files) - failed_count
 
         print(f"\n====================================")
         print(f"BATCH PROCESSING COMPLETE")
         print(f"Successfully processed: {successful_count}")
         print(f"Failed: {failed_count}")
+        print(f"Re-queued: {requeued_count}")
         print(f"Total: {len(pdf_files)}")
         print(f"====================================")
 
@@ -538,6 +922,7 @@ if __name__ == "__main__":
         logger.info(f"BATCH PROCESSING COMPLETE")
         logger.info(f"Successfully processed: {successful_count}")
         logger.info(f"Failed: {failed_count}")
+        logger.info(f"Re-queued: {requeued_count}")
         logger.info(f"Total: {len(pdf_files)}")
         logger.info(f"====================================")
 
@@ -548,10 +933,63 @@ if __name__ == "__main__":
             logger.error("Error: --input_pdf is required when not using batch mode")
             exit(1)
             
-        process_single_pdf(
-            pdf_path=args.input_pdf,
-            args=args,
-            logger=logger,
-            client=client,
-            prompts=prompts
+        def run_pdf(batch):
+            """Process the one input PDF and return its result or error."""
+            try:
+                return [process_single_pdf(pdf_path=batch[0], args=args, logger=logger, client=client, prompts=prompts)]
+            except Exception as e:
+                return [e]
+
+        # Same requeueing as in batch mode
+        failed_pdfs, _ = run_with_requeue(run_pdf, [args.input_pdf], args.max_requeues, logger, name="PDF")
+        if failed_pdfs:
+            run_error = failed_pdfs[0][1]
+
+    cache_stats = payload_cache_stats()
+    logger.info(
+        f"Image payload cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+        f"{cache_stats['evictions']} evictions, {cache_stats['bytes'] / 1024 / 1024:.1f} MiB held"
+    )
+    request_stats = scheduler_stats()
+    logger.info(
+        f"Request scheduler: {request_stats['requests']} requests, {request_stats['waits']} waited "
+        f"{request_stats['wait_seconds']:.1f}s in total for quota, {request_stats['tokens_used']} tokens used "
+        f"of {request_stats['tokens_charged']} charged up front"
+    )
+    request_retries = retry_stats()
+    logger.info(
+        f"Model request retries: {request_retries['retried_calls']} of {request_retries['calls']} calls retried "
+        f"{request_retries['retries']}, {request_retries['backoff_seconds']:.1f}s backing off, "
+        f"{request_retries['failed_calls']} failed"
+    )
+    for hedge_key, hedges in hedging_stats().items():
+        logger.info(
+            f"Hedged {hedge_key} requests: {hedges['hedges']} hedges for {hedges['calls']} calls, "
+            f"{hedges['hedge_wins']} won; p50 {hedges['p50_seconds']}s, p95 {hedges['p95_seconds']}s, "
+            f"p99 {hedges['p99_seconds']}s, "
+            f"{'at least ' if hedges['aborted_primaries'] else ''}{hedges['p99_reduction_seconds']}s lower p99 "
+            f"than the first requests"
         )
+    responses = response_cache_stats()
+    if responses is not None:
+        logger.info(
+            f"Response cache: {responses['hits']} hits, {responses['misses']} misses "
+            f"({responses['expired']} expired), {responses['stores']} stored, {responses['evictions']} evicted, "
+            f"{responses['tokens_saved']} tokens saved"
+        )
+    breaker_stats = circuit_breaker_stats()
+    if breaker_stats is not None:
+        logger.info(
+            f"Circuit breaker: opened {breaker_stats['opened']} times, {breaker_stats['probes']} probes, "
+            f"{breaker_stats['held_requests']} requests held back {breaker_stats['held_seconds']:.1f}s in total, "
+            f"now {breaker_stats['state']}"
+        )
+    if isinstance(client, ClientPool):
+        for name, member in client.stats().items():
+            logger.info(
+                f"Deployment {name}: {member['requests']} requests, {member['errors']} errors, "
+                f"ejected {member['ejections']} times" + (" (ejected now)" if member["ejected"] else "")
+            )
+
+    if run_error is not None:
+        raise run_error
@@ -1,74 +1,266 @@
 import base64
-import cv2
+import atexit
+import hashlib
+import io
 import json
 import fitz
+import math
+import multiprocessing
 import os
+import re
+import threading
+import time
+from collections import OrderedDict
 
 import numpy as np
 
-from pypdf import PdfReader as PyPDFReader
-from pdfrw import PdfReader, PdfWriter, PdfDict, PdfName
-from pdf2image import convert_from_path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image
+except ImportError:  # Pages are then encoded with PyMuPDF's own, slower JPEG writer
+    Image = None
+from pdfrw import PdfReader, PdfWriter, PdfDict, PdfName, PdfArray, PdfString
+from pdfrw.objects.pdfindirect import PdfIndirect
 import os
 from .general_utils import save_json
 
-def validate_fieldname_images(image_paths, logger=None):
+# Field names are drawn in pure blue so they can be told apart from the form's own
+# (black, grey or pale tinted) printing when checking the rendered images
+FIELDNAME_OVERLAY_COLOR = (0, 0, 1)
+
+
+def _fieldname_widget_boxes(input_pdf):
+    """
+    Return [(field_names, boxes, page_width, page_height), ...] per page of
+    input_pdf, where boxes is an (n, 4) array of the widget rectangles in the
+    coordinates of the rendered (rotated) page.
+    """
+    pages = []
+    with fitz.open(input_pdf) as doc:
+        for page in doc:
+            names, boxes = [], []
+            for widget in page.widgets():
+                rect = widget.rect * page.rotation_matrix
+                names.append(widget.field_name)
+                boxes.append((rect.x0, rect.y0, rect.x1, rect.y1))
+            pages.append(
+                (
+                    names,
+                    np.array(boxes, dtype=np.float64).reshape(-1, 4),
+                    page.rect.width,
+                    page.rect.height,
+                )
+            )
+    return pages
+
+
+def _load_downsampled_rgb(img_path, shrink):
+    """
+    Decode img_path with PyMuPDF, average it down by 2**shrink in each
+    direction and return it as an (h, w, 3) uint8 array. The samples buffer
+    belongs to the pixmap, so the (small) downsampled image is copied out
+    before the pixmap is freed.
+    """
+    pix = fitz.Pixmap(img_path)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    if pix.n != 3:
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    if shrink:
+        pix.shrink(shrink)
+    rows = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.stride)
+    return rows[:, : pix.width * 3].reshape(pix.height, pix.width, 3).copy()
+
+
+def analyze_fieldname_images(
+    image_paths,
+    input_pdf=None,
+    logger=None,
+    shrink=2,
+    ink_threshold=200,
+    overlay_margin=48,
+    min_page_ink=0.0005,
+    min_field_pixels=2,
+):
+    """
+    Check the rendered field name images pixel by pixel.
+
+    Each image is averaged down by 2**shrink (4x at the default, about 50 DPI
+    for the 200 DPI overlay images) and checked with NumPy in a few
+    milliseconds:
+    - ink density: share of pixels darker than ink_threshold in any channel.
+      A page under min_page_ink is blank.
+    - overlay pixels: pixels whose blue channel exceeds red and green by
+      overlay_margin, i.e. field name text drawn in FIELDNAME_OVERLAY_COLOR.
+      They are counted inside every widget rectangle of input_pdf with an
+      integral image. A field is visible with at least min_field_pixels.
+
+    image_paths must be in page order. Without input_pdf only the ink density
+    is checked.
+
+    Returns:
+        {
+            "passed": bool,
+            "pages": [{"image", "page_number", "ink_density", "overlay_density",
+                       "blank", "fields_total", "fields_visible", "usable",
+                       "milliseconds"}, ...],
+            "fields": {field_name: {"page_number", "visible", "overlay_pixels",
+                                    "overlay_density"}, ...},
+        }
+        A page is usable unless it is missing, blank, or has widgets none of
+        which show their name.
+    """
+    widget_pages = _fieldname_widget_boxes(input_pdf) if input_pdf else []
+    pages = []
+    fields = {}
+    for idx, img_path in enumerate(image_paths):
+        start = time.perf_counter()
+        page_result = {
+            "image": os.path.basename(img_path),
+            "page_number": idx + 1,
+            "ink_density": 0.0,
+            "overlay_density": 0.0,
+            "blank": True,
+            "fields_total": 0,
+            "fields_visible": 0,
+            "usable": False,
+        }
+        pages.append(page_result)
+        if not os.path.exists(img_path):
+            if logger:
+                logger.error(f"Image file does not exist: {img_path}")
+            page_result["milliseconds"] = 0.0
+            continue
+
+        rgb = _load_downsampled_rgb(img_path, shrink)
+        red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+        red_green = np.maximum(red, green)
+        ink = np.minimum(np.minimum(red, green), blue) < ink_threshold
+        # Compare before subtracting so the uint8 difference cannot wrap around
+        overlay = (blue > red_green) & ((blue - red_green) > overlay_margin)
+        page_result["ink_density"] = float(ink.mean())
+        page_result["overlay_density"] = float(overlay.mean())
+        page_result["blank"] = page_result["ink_density"] < min_page_ink
+
+        if idx < len(widget_pages) and len(widget_pages[idx][0]):
+            names, boxes, page_width, page_height = widget_pages[idx]
+            height, width = overlay.shape
+            # Summed-area table, padded so that box sums need no bounds checks
+            integral = np.zeros((height + 1, width + 1), dtype=np.int32)
+            integral[1:, 1:] = overlay.cumsum(axis=0, dtype=np.int32).cumsum(axis=1)
+            scale = np.array([width / page_width, height / page_height] * 2)
+            pixel_boxes = boxes * scale
+            x0 = np.clip(np.floor(pixel_boxes[:, 0]).astype(np.int64), 0, width)
+            y0 = np.clip(np.floor(pixel_boxes[:, 1]).astype(np.int64), 0, height)
+            x1 = np.clip(np.ceil(pixel_boxes[:, 2]).astype(np.int64), 0, width)
+            y1 = np.clip(np.ceil(pixel_boxes[:, 3]).astype(np.int64), 0, height)
+            counts = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+            areas = np.maximum((x1 - x0) * (y1 - y0), 1)
+            visible = counts >= min_field_pixels
+
+            # Fields with several widgets (radio groups, repeated fields) are
+            # visible if any of their widgets is
+            for name, count, area, is_visible in zip(names, counts, areas, visible):
+                field = fields.get(name)
+                if field is None or count > field["overlay_pixels"]:
+                    fields[name] = {
+                        "page_number": idx + 1,
+                        "visible": bool(is_visible),
+                        "overlay_pixels": int(count),
+                        "overlay_density": float(count / area),
+                    }
+            page_result["fields_total"] = len(names)
+            page_result["fields_visible"] = int(visible.sum())
+
+        page_result["usable"] = not page_result["blank"] and (
+            page_result["fields_total"] == 0 or page_result["fields_visible"] > 0
+        )
+        page_result["milliseconds"] = (time.perf_counter() - start) * 1000
+
+    return {
+        "passed": bool(pages) and all(page["usable"] for page in pages),
+        "pages": pages,
+        "fields": fields,
+    }
+
+
+def validate_fieldname_images(image_paths, logger=None, input_pdf=None):
     """
-    Validate that fieldname images contain visible text by checking file sizes and basic image properties.
-    This is a simple check to ensure the images aren't blank.
+    Validate that fieldname images contain visible field names with
+    analyze_fieldname_images, logging a line per page and the fields whose
+    names cannot be seen.
+
+    Returns:
+        dict: The analysis of analyze_fieldname_images; without images, or if
+            they cannot be analyzed, one that did not pass and has no pages
     """
+    failed = {"passed": False, "pages": [], "fields": {}}
     if not image_paths:
         if logger:
             logger.error("CRITICAL: No fieldname images were generated!")
-        return False
-        
-    validation_passed = True
-    for img_path in image_paths:
-        try:
-            # Check if file exists and has reasonable size
-            if not os.path.exists(img_path):
-                if logger:
-                    logger.error(f"Image file does not exist: {img_path}")
-                validation_passed = False
-                continue
-                
-            file_size = os.path.getsize(img_path)
-            if file_size < 10000:  # Less than 10KB is probably too small for a form with field names
-                if logger:
-                    logger.warning(f"Image file suspiciously small ({file_size} bytes): {img_path}")
-                    logger.warning("This may indicate field names are not visible in the image")
-                validation_passed = False
-                
-        except Exception as e:
-            if logger:
-                logger.error(f"Error validating image {img_path}: {e}")
-            validation_passed = False
-            
-    return validation_passed
+        return failed
+
+    try:
+        analysis = analyze_fieldname_images(image_paths, input_pdf=input_pdf, logger=logger)
+    except Exception as e:
+        if logger:
+            logger.error(f"Error validating fieldname images: {e}")
+        return failed
+
+    if logger:
+        for page in analysis["pages"]:
+            message = (
+                f"{page['image']}: ink {page['ink_density']:.2%}, "
+                f"{page['fields_visible']}/{page['fields_total']} field names visible "
+                f"({page['milliseconds']:.1f}ms)"
+            )
+            if page["usable"]:
+                logger.info(message)
+            else:
+                logger.warning(f"{message} - page is blank or shows no field names")
+        hidden = [name for name, field in analysis["fields"].items() if not field["visible"]]
+        if hidden:
+            logger.warning(
+                f"{len(hidden)} field names are not visible in the images: {', '.join(hidden[:20])}"
+                + (" ..." if len(hidden) > 20 else "")
+            )
+    return analysis
+
+
 def fill_pdf_fields_with_names_and_render_images(
     input_pdf,
     output_folder,
     pdf_name,
     logger,
     font_size=6,
+    dpi=200,
 ):
     """
-    Fills all AcroForm fields in the PDF with their field names using a bold and italic font,
-    saves a new PDF, and renders each page as a PNG image.
-    
+    Fills all AcroForm fields in the PDF with their field names, saves a new PDF,
+    and renders each page as a PNG image one page at a time.
+
+    Text fields get their name as value with a regenerated appearance stream so
+    the name is drawn whatever appearance the template shipped with. Check boxes,
+    radio buttons and choice fields cannot display arbitrary text, so their name
+    is added as a free text annotation at the top left of the widget. Names are
+    drawn in FIELDNAME_OVERLAY_COLOR so analyze_fieldname_images can find them.
+
+    Returns:
+        tuple: (image_paths, analysis), analysis as validate_fieldname_images
+            returns it
+
     Args:
         input_pdf: Path to input PDF
         output_folder: Output directory for filled PDF and images
         pdf_name: Name of the PDF
         logger: Logger instance
         font_size: Font size for the field name text.
+        dpi: Render resolution of the PNG images
     """
     # Prepare output paths
-    base_pdf_name = os.path.splitext(os.path.basename(input_pdf))[0]
-    filled_pdf_path = os.path.join(
-        output_folder, f"{base_pdf_name}_filled_with_field_names.pdf"
-    )
-    image_dir = os.path.join(output_folder, f"{base_pdf_name}_fieldname_images")
+    filled_pdf_path, image_dir = _fieldname_output_paths(input_pdf, output_folder)
     os.makedirs(image_dir, exist_ok=True)
 
     # Diagnostic counters
@@ -76,110 +268,363 @@ def fill_pdf_fields_with_names_and_render_images(
     processed_fields = 0
     failed_fields = 0
 
-    # Fill PDF fields with their names using a Default Appearance string
-    pdf = PdfReader(input_pdf)
-    for page in pdf.pages:
-        if "/Annots" in page:
-            for annotation in page["/Annots"]:
-                if annotation["/Subtype"] == "/Widget" and annotation.get("/T"):
-                    total_fields += 1
-                    try:
-                        field_name = annotation["/T"].to_unicode()
-
-                        # Use a reliable visual marker that will render in the final PNG.
-                        display_value = f"{{{field_name}}}"
-                        
-                        # Set a default appearance string for font size and color.
-                        # This helps with consistency but the visual marker is the primary identifier.
-                        da_string = f"/Helv {font_size} Tf 0 g"
-
-                        annotation.update(
-                            PdfDict(
-                                V=display_value,
-                                Ff=1,  # Make field read-only
-                                DA=da_string,
-                                AP=None,  # Clear existing appearance to force regeneration
-                            )
+    doc = fitz.open(input_pdf)
+    try:
+        for page in doc:
+            for widget in page.widgets():
+                total_fields += 1
+                try:
+                    field_name = widget.field_name.split(".")[-1]
+
+                    # Use a reliable visual marker that will render in the final PNG.
+                    display_value = f"{{{field_name}}}"
+
+                    if widget.field_type == fitz.PDF_WIDGET_TYPE_TEXT:
+                        widget.field_value = display_value
+                        widget.field_flags |= fitz.PDF_FIELD_IS_READ_ONLY
+                        widget.text_font = "Helv"
+                        widget.text_fontsize = font_size
+                        widget.text_color = FIELDNAME_OVERLAY_COLOR
+                        widget.text_maxlen = 0
+                        widget.update()
+                    else:
+                        rect = widget.rect
+                        width = fitz.get_text_length(display_value, "helv", font_size)
+                        page.add_freetext_annot(
+                            fitz.Rect(
+                                rect.x0,
+                                rect.y0,
+                                rect.x0 + width + 4,
+                                rect.y0 + font_size * 1.5 + 2,
+                            ),
+                            display_value,
+                            fontsize=font_size,
+                            fontname="helv",
+                            text_color=FIELDNAME_OVERLAY_COLOR,
                         )
-                        processed_fields += 1
-
-                        if logger:
-                            logger.debug(
-                                f"Processed field: {field_name} -> {display_value}"
-                            )
-
-                    except Exception as e:
-                        failed_fields += 1
-                        if logger:
-                            logger.warning(f"Failed to process field: {e}")
-                        
-    # Log field processing summary
-    if logger:
-        logger.info(f"Field processing summary: {processed_fields}/{total_fields} successful, {failed_fields} failed")
-        if failed_fields > 0:
-            logger.warning(f"{failed_fields} fields could not be processed - this may affect AI mapping quality")
-    
-    PdfWriter(filled_pdf_path, trailer=pdf).write()
-    if logger:
-        logger.info(f"PDF with field names written to: {filled_pdf_path}")
+                    processed_fields += 1
 
-    # Render each page as PNG
-    try:
-        images = convert_from_path(filled_pdf_path, dpi=200)
-        image_paths = []
-        for i, img in enumerate(images):
-            img_path = os.path.join(image_dir, f"page_{i+1}.png")
-            img.save(img_path, 'PNG')
-            image_paths.append(img_path)
-            if logger:
-                logger.info(f"Image saved to: {img_path}")
-                
-        # Validation check: Verify images contain visible field names
-        validation_passed = validate_fieldname_images(image_paths, logger)
+                    if logger:
+                        logger.debug(
+                            f"Processed field: {field_name} -> {display_value}"
+                        )
+
+                except Exception as e:
+                    failed_fields += 1
+                    if logger:
+                        logger.warning(f"Failed to process field: {e}")
+
+        # Log field processing summary
         if logger:
-            if validation_passed:
-                logger.info("SUCCESS: Fieldname image validation PASSED")
-                logger.info("AI model should be able to map field names correctly")
-            else:
-                logger.error("FAILED: Fieldname image validation FAILED")
-                logger.error("CRITICAL: Field names may not be visible in images!")
-                logger.error("AI model will NOT be able to map field names correctly!")
-                logger.error("This means the AI cannot see field locations on the form")
+            logger.info(f"Field processing summary: {processed_fields}/{total_fields} successful, {failed_fields} failed")
+            if failed_fields > 0:
+                logger.warning(f"{failed_fields} fields could not be processed - this may affect AI mapping quality")
+
+        doc.save(filled_pdf_path)
+        if logger:
+            logger.info(f"PDF with field names written to: {filled_pdf_path}")
+
+        # Render each page as PNG, writing it out before the next page is rendered
+        try:
+            image_paths = []
+            for page_number, image in iter_pdf_page_images(doc, dpi, "png"):
+                img_path = os.path.join(image_dir, f"page_{page_number}.png")
+                with open(img_path, "wb") as image_file:
+                    image_file.write(image)
+                image_paths.append(img_path)
+                if logger:
+                    logger.info(f"Image saved to: {img_path}")
                 
-            logger.info(f"Check fieldname images in: {image_dir}")
-            logger.info("Manually verify that field names are visible as blue/black text overlays")
+            # Validation check: Verify images contain visible field names
+            analysis = validate_fieldname_images(image_paths, logger, input_pdf)
+            if logger:
+                if analysis["passed"]:
+                    logger.info("SUCCESS: Fieldname image validation PASSED")
+                    logger.info("AI model should be able to map field names correctly")
+                else:
+                    logger.error("FAILED: Fieldname image validation FAILED")
+                    logger.error("CRITICAL: Field names may not be visible in images!")
+                    logger.error("AI model will NOT be able to map field names correctly!")
+                    logger.error("This means the AI cannot see field locations on the form")
+                
+                logger.info(f"Check fieldname images in: {image_dir}")
+                logger.info("Manually verify that field names are visible as blue text overlays")
             
-        return image_paths
+            return image_paths, analysis
         
-    except Exception as e:
-        if logger:
-            logger.error(f"Failed to convert PDF to images: {e}")
-            logger.error("This will prevent proper field name mapping by the AI model")
-        raise
+        except Exception as e:
+            if logger:
+                logger.error(f"Failed to convert PDF to images: {e}")
+                logger.error("This will prevent proper field name mapping by the AI model")
+            raise
+    finally:
+        doc.close()
+
+
+# Bump whenever the field name overlay or its rendering changes so that cached
+# field name images from older versions are rebuilt
+FIELDNAME_RENDERER_VERSION = 2
+
+
+def _fieldname_output_paths(input_pdf, output_folder):
+    base_pdf_name = os.path.splitext(os.path.basename(input_pdf))[0]
+    filled_pdf_path = os.path.join(
+        output_folder, f"{base_pdf_name}_filled_with_field_names.pdf"
+    )
+    image_dir = os.path.join(output_folder, f"{base_pdf_name}_fieldname_images")
+    return filled_pdf_path, image_dir
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _fieldname_cache_key(input_pdf, font_size, dpi):
+    return {
+        "pdf_sha256": _file_sha256(input_pdf),
+        "font_size": font_size,
+        "dpi": dpi,
+        "renderer_version": FIELDNAME_RENDERER_VERSION,
+        "pymupdf_version": fitz.VersionBind,
+    }
+
+
+def _read_fieldname_cache(cache_path, cache_key, filled_pdf_path, logger):
+    """
+    Return the cached (image file names, analysis) if cache_path was written
+    for cache_key and all of its files are still on disk, else None.
+    """
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, "r", encoding="utf-8") as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError) as error:
+        logger.warning(f"Ignoring unreadable field name image cache {cache_path}: {error}")
+        return None
+    if cache.get("key") != cache_key or not os.path.exists(filled_pdf_path):
+        return None
+    image_dir = os.path.dirname(cache_path)
+    image_names = cache.get("images") or []
+    analysis = cache.get("analysis")
+    if not isinstance(image_names, list) or not image_names or analysis is None or not all(
+        os.path.exists(os.path.join(image_dir, file_name)) for file_name in image_names
+    ):
+        return None
+    return image_names, analysis
+
+
+def _encode_image_files(image_paths):
+    image_data = {}
+    for img_path in image_paths:
+        with open(img_path, "rb") as img_file:
+            image_data[os.path.basename(img_path)] = base64.b64encode(
+                img_file.read()
+            ).decode("utf-8")
+    return image_data
+
+
+def load_fieldname_images(
+    input_pdf,
+    output_folder,
+    pdf_name,
+    logger,
+    font_size=6,
+    dpi=200,
+):
+    """
+    Return the field name overlay of input_pdf as (image_paths, image_data,
+    analysis), where image_data is {"page_1.png": base64_string, ...} as
+    encode_images_to_base64 would return it and analysis is the visibility
+    analysis of validate_fieldname_images.
+
+    The overlay PDF and its page images are kept next to the images with a
+    cache file holding their names and visibility analysis, keyed by the PDF's
+    content hash, font size, DPI and renderer version. Reruns over an unchanged
+    template skip the overlay, render and analysis stage and only read the
+    images back.
+    """
+    filled_pdf_path, image_dir = _fieldname_output_paths(input_pdf, output_folder)
+    cache_path = os.path.join(image_dir, "fieldname_cache.json")
+    cache_key = _fieldname_cache_key(input_pdf, font_size, dpi)
+
+    cached = _read_fieldname_cache(cache_path, cache_key, filled_pdf_path, logger)
+    if cached is not None:
+        image_names, analysis = cached
+        image_paths = [os.path.join(image_dir, file_name) for file_name in image_names]
+        logger.info(
+            f"Field name images for {pdf_name} are up to date, reusing {len(image_paths)} cached pages"
+        )
+        return image_paths, _encode_image_files(image_paths), analysis
+
+    image_paths, analysis = fill_pdf_fields_with_names_and_render_images(
+        input_pdf,
+        output_folder,
+        pdf_name,
+        logger=logger,
+        font_size=font_size,
+        dpi=dpi,
+    )
+    if not analysis["pages"]:
+        # The images could not be analyzed; try again on the next run
+        return image_paths, _encode_image_files(image_paths), analysis
+    save_json(
+        {
+            "key": cache_key,
+            "images": [os.path.basename(img_path) for img_path in image_paths],
+            "analysis": analysis,
+        },
+        cache_path,
+        "Cached field name images",
+        logger,
+    )
+    return image_paths, _encode_image_files(image_paths), analysis
+
+
+# Field flag bits (/Ff) of text fields, PDF 32000-1 table 228
+_FIELD_FLAG_MULTILINE = 1 << 12
+_FIELD_FLAG_COMB = 1 << 24
+
+# Keys of a field mapping entry that are sent to the model; the geometry and
+# metadata kept next to them are for local use only
+PROMPT_FIELD_KEYS = ("field_type", "possible_values")
+
+
+def _decode_text_string(pdf_string):
+    try:
+        return pdf_string.to_unicode()
+    except Exception:
+        return str(pdf_string)
+
+
+def _inherited_attribute(field, name):
+    node = field
+    while node is not None:
+        value = getattr(node, name)
+        if value is not None:
+            return value
+        node = node.Parent
+    return None
+
+
+def _widget_rect(widget, page):
+    """
+    Return the widget's /Rect as [x0, y0, x1, y1] in points with the origin at
+    the top left of the page as it is rendered, i.e. after the page's /Rotate,
+    like _fieldname_widget_boxes.
+    """
+    box = page.inheritable.CropBox or page.inheritable.MediaBox
+    box = [float(value) for value in box]
+    rect = [float(value) for value in widget.Rect]
+    left, right = sorted((rect[0], rect[2]))
+    bottom, top = sorted((rect[1], rect[3]))
+    origin_x, origin_y = min(box[0], box[2]), max(box[1], box[3])
+    x0, y0, x1, y1 = left - origin_x, origin_y - top, right - origin_x, origin_y - bottom
+    width, height = abs(box[2] - box[0]), abs(box[3] - box[1])
+    # /Rotate turns the page clockwise when it is displayed
+    rotation = int(page.inheritable.Rotate or 0) % 360
+    if rotation == 90:
+        x0, y0, x1, y1 = height - y1, x0, height - y0, x1
+    elif rotation == 180:
+        x0, y0, x1, y1 = width - x1, height - y1, width - x0, height - y0
+    elif rotation == 270:
+        x0, y0, x1, y1 = y0, width - x1, y1, width - x0
+    return [round(x0, 2), round(y0, 2), round(x1, 2), round(y1, 2)]
+
+
+def _choice_options(field):
+    options = []
+    for option in _inherited_attribute(field, "Opt") or []:
+        if isinstance(option, PdfArray) and len(option) == 2:
+            value, label = option
+        else:
+            value = label = option
+        options.append(
+            {"value": _decode_text_string(value), "label": _decode_text_string(label)}
+        )
+    return options
+
+
+def _field_mapping_entry(template, entry):
+    """
+    Describe one field of template.widget_index for _field_mappings.json.
+    """
+    field = entry["field"]
+    field_type = entry["field_type"]
+    result = {"field_type": str(field_type) if field_type else None}
+    if field_type == PdfName.Btn and entry["states"]:
+        result["possible_values"] = ["/" + state for state in entry["states"]] + ["/Off"]
+    elif field_type == PdfName.Ch:
+        result["options"] = _choice_options(field)
+        result["possible_values"] = [option["value"] for option in result["options"]]
+
+    if field.TU:
+        result["tooltip"] = _decode_text_string(field.TU)
+    if field_type in (PdfName.Tx, PdfName.Ch):
+        alignment = _inherited_attribute(field, "Q")
+        if alignment is None and template.pdf.Root.AcroForm:
+            alignment = template.pdf.Root.AcroForm.Q
+        result["alignment"] = int(alignment or 0)
+    if field_type == PdfName.Tx:
+        flags = int(_inherited_attribute(field, "Ff") or 0)
+        max_length = _inherited_attribute(field, "MaxLen")
+        if max_length is not None:
+            result["max_length"] = int(max_length)
+        result["multiline"] = bool(flags & _FIELD_FLAG_MULTILINE)
+        result["comb"] = bool(flags & _FIELD_FLAG_COMB)
+
+    result["widgets"] = [
+        {
+            "page_index": page_index,
+            "rect": _widget_rect(widget, template.pdf.pages[page_index]),
+        }
+        for widget, page_index in zip(entry["widgets"], entry["widget_pages"])
+    ]
+    return result
+
+
+def prompt_field_mappings(field_mappings):
+    """
+    Reduce field mappings read from _field_mappings.json to the keys in
+    PROMPT_FIELD_KEYS, the part of the mappings sent to the model.
+    """
+    return {
+        field_name: {key: info[key] for key in PROMPT_FIELD_KEYS if key in info}
+        for field_name, info in field_mappings.items()
+    }
+
+
+def has_field_geometry(field_mappings):
+    """
+    True if field_mappings were written by the current extract_pdf_fields, False
+    for older _field_mappings.json files that lack widget geometry.
+    """
+    return bool(field_mappings) and all("widgets" in info for info in field_mappings.values())
 
 
 def extract_pdf_fields(pdf_path, output_path, logger):
+    """
+    Extract every AcroForm field of pdf_path in a single pass over the page
+    widgets of the cached template, and save them to output_path as
+    {full_name: {"field_type", "possible_values", "options", "tooltip",
+    "max_length", "multiline", "comb", "alignment",
+    "widgets": [{"page_index", "rect"}, ...]}}, with the keys that do not apply
+    to a field type left out. Rects are in points with a top left origin on
+    the rendered (rotated) page.
+
+    Returns:
+        JSON string of prompt_field_mappings(field_mappings), the part sent to the model
+    """
     try:
-        reader = PyPDFReader(pdf_path)
-        fields = reader.get_fields()
-        # print(fields)
-        field_mappings = {}
-        for field_name, field in fields.items():
-            field_type = field.get("/FT")
-            result = {}
-            result["field_type"] = field_type
-            if field_type == "/Btn":
-                widgets = field.get("/Kids", [field])
-                valid_states = set()
-                for widget in widgets:
-                    widget_obj = widget.get_object()
-                    states = widget_obj.get("/_States_")
-                    if states:
-                        for s in states:
-                            valid_states.add(str(s))
-                if valid_states:
-                    result["possible_values"] = list(valid_states)
-            field_mappings[field_name] = result
+        template = load_pdf_template(pdf_path)
+        field_mappings = {
+            field_name: _field_mapping_entry(template, entry)
+            for field_name, entry in template.widget_index.items()
+        }
         print("PDF AcroForm fields were extracted successfully!")
         logger.info("PDF AcroForm fields were extracted successfully!")
         save_json(
@@ -188,7 +633,7 @@ def extract_pdf_fields(pdf_path, output_path, logger):
             data_flag="PDF AcroForm fields",
             logger=logger,
         )
-        field_mappings_json = json.dumps(field_mappings, indent=4)
+        field_mappings_json = json.dumps(prompt_field_mappings(field_mappings), indent=4)
         return field_mappings_json
     except Exception as error:
         print("Error while extracting PDF AcroForm fields!")
@@ -198,46 +643,457 @@ def extract_pdf_fields(pdf_path, output_path, logger):
         raise
 
 
-def fill_pdf_fields(input_pdf, output_pdf_path, data, data_flag, logger):
+_MISSING = object()
+
+
+def _decode_field_name(pdf_string):
+    """
+    Decode a /T string, falling back to UTF-16 for names pdfrw cannot decode.
+    """
     try:
-        field_map = {
-            info["field_name"].split(".")[-1]: {
-                "type": info["field_type"],
-                "value": info["field_value"],
-            }
-            for info in data.values()
+        return pdf_string.to_unicode().strip("()")
+    except Exception:
+        return str(pdf_string).encode("latin1").decode("utf-16").strip("()")
+
+
+def _qualified_field_name(field):
+    """
+    Build the fully qualified field name from the /T chain of the field and its parents.
+    """
+    parts = []
+    node = field
+    while node is not None:
+        if node.T:
+            parts.append(_decode_field_name(node.T))
+        node = node.Parent
+    return ".".join(reversed(parts))
+
+
+def _inherited_field_type(field):
+    node = field
+    while node is not None:
+        if node.FT:
+            return node.FT
+        node = node.Parent
+    return None
+
+
+def _widget_states(widget):
+    """
+    Return the on-states of a /Btn widget from its normal appearance dictionary.
+    """
+    appearance = widget.AP
+    normal = appearance.N if appearance else None
+    if not isinstance(normal, PdfDict):
+        return []
+    return [key.lstrip("/") for key in normal.keys() if key != "/Off"]
+
+# Parsed templates, least recently used first; a batch moves on from one
+# template to the next, so only the last few are worth keeping in memory
+_TEMPLATE_CACHE = OrderedDict()
+_TEMPLATE_CACHE_LOCK = threading.Lock()
+TEMPLATE_CACHE_SIZE = 4
+
+
+def _format_pdf_object(obj, object_numbers):
+    """
+    Serialize a pdfrw object for an incremental update. Indirect objects of the
+    template are written as references using their original object numbers.
+    """
+    if isinstance(obj, PdfIndirect):
+        return "%d %d R" % obj
+    key = object_numbers.get(id(obj))
+    if key is not None:
+        return "%d %d R" % key
+    if isinstance(obj, PdfDict):
+        if obj.indirect or obj.stream is not None:
+            raise ValueError("New indirect objects are not supported in incremental updates")
+        items = []
+        for name, value in obj.iteritems():
+            items.append(str(getattr(name, "encoded", None) or name))
+            items.append(_format_pdf_object(value, object_numbers))
+        return "<<%s>>" % " ".join(items)
+    if isinstance(obj, list):
+        return "[%s]" % " ".join(_format_pdf_object(value, object_numbers) for value in obj)
+    if hasattr(obj, "indirect"):
+        # PdfName, PdfString and PdfObject already know their PDF representation
+        return str(getattr(obj, "encoded", None) or obj)
+    if isinstance(obj, str):
+        return PdfString.encode(obj)
+    if isinstance(obj, bool):
+        return "true" if obj else "false"
+    if isinstance(obj, float):
+        return ("%.9f" % obj).rstrip("0").rstrip(".")
+    return str(obj)
+
+
+class FieldNameTrie:
+    """
+    Trie over the dot-separated segments of fully qualified field names, stored
+    last segment first. Walking a (possibly partial) name from its last segment
+    yields every full name that ends with it, so suffix lookups cost one step per
+    segment instead of a scan over all fields.
+    """
+
+    def __init__(self, full_names=()):
+        self.root = {"children": {}, "full_names": []}
+        for full_name in full_names:
+            self.add(full_name)
+
+    def add(self, full_name):
+        node = self.root
+        for part in reversed(full_name.split(".")):
+            node = node["children"].setdefault(part, {"children": {}, "full_names": []})
+            node["full_names"].append(full_name)
+
+    def match(self, field_name):
+        """
+        Return every full name that ends with the segments of field_name.
+        """
+        node = self.root
+        for part in reversed(field_name.split(".")):
+            node = node["children"].get(part)
+            if node is None:
+                return []
+        return node["full_names"]
+
+
+class PdfTemplate:
+    """
+    A fillable PDF parsed once with pdfrw and shared by every sample filled from it.
+
+    The parsed object graph is never modified permanently. Each sample gets a
+    PdfTemplateClone that records its own field updates (copy-on-write); writing
+    a clone appends only the updated field objects to the unchanged template bytes.
+    """
+
+    def __init__(self, input_pdf):
+        self.input_pdf = input_pdf
+        with open(input_pdf, "rb") as pdf_file:
+            self.source_bytes = pdf_file.read()
+        self.pdf = PdfReader(fdata=self.source_bytes)
+        self._write_lock = threading.Lock()
+        self.widget_index = self._build_widget_index()
+        self.field_name_trie = FieldNameTrie(self.widget_index)
+        self._prepare_incremental_update()
+
+    def _prepare_incremental_update(self):
+        """
+        Load every object once and record what is needed to append per-sample
+        incremental updates to the unchanged template bytes: the original object
+        numbers, the last xref offset and whether that xref is a stream.
+        """
+        self.supports_incremental_update = False
+        if self.pdf.Encrypt is not None:
+            return
+        self.pdf.read_all()
+        self.object_numbers = {
+            id(obj): key
+            for key, obj in self.pdf.indirect_objects.items()
+            if not isinstance(obj, PdfIndirect)
         }
+        startxref = re.findall(rb"startxref\s+(\d+)", self.source_bytes[-2048:])
+        if not startxref:
+            return
+        self.startxref = int(startxref[-1])
+        self.xref_is_stream = not self.source_bytes[self.startxref:self.startxref + 4] == b"xref"
+        self.size = max(
+            int(self.pdf.Size or 0),
+            max((key[0] for key in self.pdf.indirect_objects), default=0) + 1,
+        )
+        self.supports_incremental_update = True
+
+    def incremental_update(self, overrides):
+        """
+        Build the bytes to append to source_bytes so that the field and widget
+        dictionaries in overrides replace their originals. Fonts, page content
+        streams and resources are left untouched in the shared template bytes.
+
+        Returns:
+            Update bytes, or None if the template needs a full rewrite instead.
+        """
+        if not self.supports_incremental_update:
+            return None
+        updated_objects = []
+        try:
+            for obj, updates in overrides.values():
+                key = self.object_numbers.get(id(obj))
+                if key is None:
+                    # Direct widget dictionaries cannot be replaced on their own
+                    return None
+                merged = PdfDict()
+                for name, value in obj.iteritems():
+                    dict.__setitem__(merged, name, value)
+                for name, value in updates.items():
+                    dict.__setitem__(merged, name, value)
+                updated_objects.append(
+                    (key, _format_pdf_object(merged, self.object_numbers))
+                )
+        except ValueError:
+            return None
+
+        offset = len(self.source_bytes)
+        parts = []
+        if not self.source_bytes.endswith(b"\n"):
+            parts.append(b"\n")
+            offset += 1
+        xref_entries = []
+        for (objnum, gennum), formatted in sorted(updated_objects):
+            chunk = ("%d %d obj\n%s\nendobj\n" % (objnum, gennum, formatted)).encode("latin-1")
+            xref_entries.append((objnum, gennum, offset))
+            parts.append(chunk)
+            offset += len(chunk)
+
+        trailer_items = ["/Prev %d" % self.startxref]
+        for name in ("/Root", "/Info", "/ID"):
+            value = dict.get(self.pdf, name)
+            if value is not None:
+                trailer_items.append("%s %s" % (name, _format_pdf_object(value, self.object_numbers)))
+
+        if self.xref_is_stream:
+            # The update's xref must also be a stream; it takes the next free object number
+            xref_objnum = self.size
+            xref_entries.append((xref_objnum, 0, offset))
+            stream = b"".join(
+                b"\x01" + entry_offset.to_bytes(4, "big") + gennum.to_bytes(2, "big")
+                for _, gennum, entry_offset in xref_entries
+            )
+            index = " ".join("%d 1" % objnum for objnum, _, _ in xref_entries)
+            header = "%d 0 obj\n<</Type /XRef /Size %d /W [1 4 2] /Index [%s] /Length %d %s>>\nstream\n" % (
+                xref_objnum, xref_objnum + 1, index, len(stream), " ".join(trailer_items)
+            )
+            parts.append(header.encode("latin-1"))
+            parts.append(stream)
+            parts.append(("\nendstream\nendobj\nstartxref\n%d\n%%%%EOF\n" % offset).encode("latin-1"))
+        else:
+            lines = ["xref"]
+            for objnum, gennum, entry_offset in xref_entries:
+                lines.append("%d 1" % objnum)
+                lines.append("%010d %05d n\r" % (entry_offset, gennum))
+            lines.append("trailer")
+            lines.append("<</Size %d %s>>" % (self.size, " ".join(trailer_items)))
+            lines.append("startxref")
+            lines.append("%d" % offset)
+            lines.append("%%EOF\n")
+            parts.append("\n".join(lines).encode("latin-1"))
+        return b"".join(parts)
+
+    def _build_widget_index(self):
+        """
+        Walk every page's /Annots once and index the widgets by fully qualified
+        field name (the parent /T chain joined with ".").
+
+        Returns:
+            {full_name: {"field", "widgets", "widget_pages", "page_numbers",
+                         "field_type", "states"}}
+            where widget_pages holds the 0-based page index of each widget
+        """
+        widget_index = {}
+        for page_number, page in enumerate(self.pdf.pages, 1):
+            for annotation in page.Annots or []:
+                if annotation.Subtype != PdfName.Widget:
+                    continue
+                # Widgets without /T are kids of a field that holds the name and value
+                field = annotation if annotation.T else annotation.Parent
+                if field is None or not field.T:
+                    continue
+                full_name = _qualified_field_name(field)
+                entry = widget_index.get(full_name)
+                if entry is None:
+                    entry = widget_index[full_name] = {
+                        "field": field,
+                        "widgets": [],
+                        "widget_pages": [],
+                        "page_numbers": [],
+                        "field_type": _inherited_field_type(field),
+                        "states": [],
+                    }
+                entry["widgets"].append(annotation)
+                entry["widget_pages"].append(page_number - 1)
+                if page_number not in entry["page_numbers"]:
+                    entry["page_numbers"].append(page_number)
+                for state in _widget_states(annotation):
+                    if state not in entry["states"]:
+                        entry["states"].append(state)
+        return widget_index
+
+    def resolve_field_name(self, field_name):
+        """
+        Resolve a field name from the generated data to a fully qualified name.
+
+        Full names resolve directly. Partial names (e.g. "f1_01[0]" or
+        "Page1[0].f1_01[0]") resolve only when exactly one field ends with them.
+
+        Returns:
+            Tuple of (full_name or None, list of candidate full names)
+        """
+        if field_name in self.widget_index:
+            return field_name, [field_name]
+        candidates = self.field_name_trie.match(field_name)
+        if len(candidates) == 1:
+            return candidates[0], candidates
+        return None, candidates
+
+    def clone(self):
+        """
+        Return a cheap copy-on-write view of the template for a single sample.
+        """
+        return PdfTemplateClone(self)
+
+
+class PdfTemplateClone:
+    """
+    Per-sample view of a PdfTemplate. Field updates are stored per field or widget
+    dictionary and never touch the shared template outside of a full rewrite.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.overrides = {}
+
+    def update_object(self, obj, updates):
+        """
+        Record updates (a PdfDict) for one field or widget dictionary of the template.
+        """
+        _, pending = self.overrides.setdefault(id(obj), (obj, PdfDict()))
+        for key, value in updates.iteritems():
+            dict.__setitem__(pending, key, value)
+
+    def write(self, output_pdf_path):
+        """
+        Write the template with this clone's field updates applied. The template
+        bytes are copied unchanged and only the updated field objects are appended
+        as an incremental update; templates that cannot take one are rewritten.
+        """
+        update = self.template.incremental_update(self.overrides)
+        if update is None:
+            self._write_full(output_pdf_path)
+            return
+        with open(output_pdf_path, "wb") as output_file:
+            output_file.write(self.template.source_bytes)
+            output_file.write(update)
+
+    def to_bytes(self):
+        """
+        Return the filled PDF as bytes without touching the disk.
+        """
+        update = self.template.incremental_update(self.overrides)
+        if update is None:
+            buffer = io.BytesIO()
+            self._write_full(buffer)
+            return buffer.getvalue()
+        return self.template.source_bytes + update
+
+    def _write_full(self, output_pdf_path):
+        """
+        Rewrite the whole template with pdfrw, applying this clone's updates to the
+        shared graph for the duration of the write. output_pdf_path may also be a
+        binary file object.
+        """
+        with self.template._write_lock:
+            saved = []
+            try:
+                for obj, updates in self.overrides.values():
+                    saved.append(
+                        (obj, {key: dict.get(obj, key, _MISSING) for key in updates})
+                    )
+                    for key, value in updates.items():
+                        if value is None:
+                            dict.pop(obj, key, None)
+                        else:
+                            dict.__setitem__(obj, key, value)
+                PdfWriter().write(output_pdf_path, self.template.pdf)
+            finally:
+                # Restore the shared graph so other samples see the pristine template
+                for obj, original in saved:
+                    for key, value in original.items():
+                        if value is _MISSING:
+                            dict.pop(obj, key, None)
+                        else:
+                            dict.__setitem__(obj, key, value)
+
+
+def load_pdf_template(input_pdf):
+    """
+    Return the parsed PdfTemplate for input_pdf, parsing it only on first use.
+    The cache key includes the file's size and modification time, so an edited
+    template is parsed again. At most TEMPLATE_CACHE_SIZE templates are kept,
+    dropping the least recently used one.
+    """
+    input_pdf = os.path.abspath(input_pdf)
+    stat = os.stat(input_pdf)
+    cache_key = (input_pdf, stat.st_mtime_ns, stat.st_size)
+    with _TEMPLATE_CACHE_LOCK:
+        template = _TEMPLATE_CACHE.get(cache_key)
+        if template is None:
+            # Drop stale entries for the same file
+            for key in [k for k in _TEMPLATE_CACHE if k[0] == input_pdf]:
+                del _TEMPLATE_CACHE[key]
+            template = PdfTemplate(input_pdf)
+            _TEMPLATE_CACHE[cache_key] = template
+            while len(_TEMPLATE_CACHE) > TEMPLATE_CACHE_SIZE:
+                _TEMPLATE_CACHE.popitem(last=False)
+        else:
+            _TEMPLATE_CACHE.move_to_end(cache_key)
+    return template
+
+
+def _fill_index_entry(filled_pdf, entry, field_type, value):
+    """
+    Record the updates that fill one indexed field with value.
+    """
+    if field_type == "/Tx":
+        filled_pdf.update_object(entry["field"], PdfDict(V=str(value), AP=None))
+    elif field_type == "/Btn":
+        data_value = str(value).lstrip("/")
+        filled_pdf.update_object(entry["field"], PdfDict(V=PdfName(data_value)))
+        for widget in entry["widgets"]:
+            states = _widget_states(widget)
+            # Radio kids each own one on-state; the others must show /Off
+            state = data_value if not states or data_value in states else "Off"
+            filled_pdf.update_object(widget, PdfDict(AS=PdfName(state)))
+
+
+def _fill_template_clone(template, data, logger):
+    """
+    Resolve every data entry against the template's widget index and record its
+    value on a fresh clone of the template.
+    """
+    filled_pdf = template.clone()
+    filled_by = {}
+    for label, info in data.items():
+        field_name = info["field_name"]
+        full_name, candidates = template.resolve_field_name(field_name)
+        if full_name is None:
+            if candidates:
+                logger.warning(
+                    f"Field name '{field_name}' for '{label}' is ambiguous "
+                    f"({len(candidates)} fields end with it), skipping: {candidates}"
+                )
+            else:
+                logger.warning(f"Field name '{field_name}' for '{label}' not found in PDF, skipping")
+            continue
+        if full_name in filled_by:
+            logger.warning(
+                f"Field '{full_name}' is filled by both '{filled_by[full_name]}' and '{label}'; "
+                f"keeping the value of '{label}'"
+            )
+        filled_by[full_name] = label
+        entry = template.widget_index[full_name]
+        _fill_index_entry(
+            filled_pdf,
+            entry,
+            entry["field_type"] or info["field_type"],
+            info["field_value"],
+        )
+    return filled_pdf
 
-        template = PdfReader(input_pdf)
-        for page in template.pages:
-            annotations = page.Annots
-            if annotations:
-                for annotation in annotations:
-                    if annotation.Subtype == PdfName.Widget and annotation.T:
-                        try:
-                            field_name = annotation.T.to_unicode().strip("()")
-                        except Exception:
-                            field_name = (
-                                str(annotation.T)
-                                .encode("latin1")
-                                .decode("utf-16")
-                                .strip("()")
-                            )
-
-                        if field_name in field_map:
-                            entry = field_map[field_name]
-                            value = entry["value"]
-                            field_type = entry["type"]
-                            if field_type == "/Tx":
-                                annotation.update(PdfDict(V=str(value), AP=None))
-                            elif field_type == "/Btn":
-                                data_value = value.lstrip("/")
-                                annotation.update(
-                                    PdfDict(
-                                        V=PdfName(data_value), AS=PdfName(data_value)
-                                    )
-                                )
-        PdfWriter().write(output_pdf_path, template)
+
+def fill_pdf_fields(input_pdf, output_pdf_path, data, data_flag, logger):
+    try:
+        template = load_pdf_template(input_pdf)
+        filled_pdf = _fill_template_clone(template, data, logger)
+        filled_pdf.write(output_pdf_path)
         print("PDF was filled successfully for {}!".format(data_flag))
         logger.info("PDF was filled successfully for {}!".format(data_flag))
     except Exception as error:
@@ -248,20 +1104,276 @@ def fill_pdf_fields(input_pdf, output_pdf_path, data, data_flag, logger):
         raise
 
 
-def pdf_to_images(pdf_path, image_directory, data_flag, logger):
+def fill_pdf_fields_to_bytes(input_pdf, data, data_flag, logger):
+    """
+    Fill the PDF like fill_pdf_fields, but return the filled PDF as bytes so it
+    can go straight to pdf_to_images or validation without a disk round-trip.
+    """
     try:
-        doc = fitz.open(pdf_path)
-        for idx, page in enumerate(doc):
-            image_filepath = os.path.join(
-                image_directory, "Page{}.jpg".format(str(idx + 1))
+        template = load_pdf_template(input_pdf)
+        pdf_bytes = _fill_template_clone(template, data, logger).to_bytes()
+        print("PDF was filled in memory successfully for {}!".format(data_flag))
+        logger.info("PDF was filled in memory successfully for {}!".format(data_flag))
+        return pdf_bytes
+    except Exception as error:
+        print("Error while filling PDF for {}!".format(data_flag))
+        print("{}".format(error))
+        logger.error("Error while filling PDF for {}!".format(data_flag))
+        logger.error("{}".format(error))
+        raise
+
+
+def fill_pdf_fields_batch(input_pdf, variants, data_flag, logger):
+    """
+    Fill several variants of the same template in one pass.
+
+    The template is parsed once; every output shares its unchanged object graph
+    (fonts, page content streams, resources) and only the per-variant field
+    objects are written after it.
+
+    Args:
+        input_pdf: Path to the fillable PDF template
+        variants: List of (output_pdf_path, data) tuples, data shaped like fill_pdf_fields
+        data_flag: Label used in log messages
+        logger: Logger instance
+
+    Returns:
+        List of per-variant timing dicts with output_pdf_path, fill_seconds and write_seconds
+    """
+    try:
+        start = time.perf_counter()
+        template = load_pdf_template(input_pdf)
+        load_seconds = time.perf_counter() - start
+
+        timings = []
+        for idx, (output_pdf_path, data) in enumerate(variants, 1):
+            start = time.perf_counter()
+            filled_pdf = _fill_template_clone(template, data, logger)
+            filled_at = time.perf_counter()
+            filled_pdf.write(output_pdf_path)
+            written_at = time.perf_counter()
+            timing = {
+                "output_pdf_path": output_pdf_path,
+                "fill_seconds": filled_at - start,
+                "write_seconds": written_at - filled_at,
+            }
+            timings.append(timing)
+            logger.info(
+                f"{data_flag} - Variant [ {idx} / {len(variants)} ] filled in "
+                f"{timing['fill_seconds']:.4f}s, written in {timing['write_seconds']:.4f}s"
             )
-            pix = page.get_pixmap(matrix=fitz.Matrix(300 / 72, 300 / 72))
-            image = np.frombuffer(pix.samples, dtype=np.uint8).reshape(
-                pix.height, pix.width, pix.n
+
+        total_seconds = sum(t["fill_seconds"] + t["write_seconds"] for t in timings)
+        print("{} PDFs were filled successfully for {}!".format(len(timings), data_flag))
+        logger.info(
+            f"{len(timings)} PDFs were filled successfully for {data_flag} "
+            f"(template load {load_seconds:.4f}s, fill and write {total_seconds:.4f}s)"
+        )
+        return timings
+    except Exception as error:
+        print("Error while batch filling PDFs for {}!".format(data_flag))
+        print("{}".format(error))
+        logger.error("Error while batch filling PDFs for {}!".format(data_flag))
+        logger.error("{}".format(error))
+        raise
+
+
+def _open_pdf_document(pdf):
+    """
+    Open pdf with PyMuPDF. pdf may be a file path, PDF bytes or an open fitz.Document.
+
+    Returns:
+        Tuple of (document, owned) where owned is True if the caller must close it
+    """
+    if isinstance(pdf, fitz.Document):
+        return pdf, False
+    if isinstance(pdf, (bytes, bytearray)):
+        return fitz.open(stream=pdf, filetype="pdf"), True
+    return fitz.open(pdf), True
+
+
+def pdf_page_sizes(pdf):
+    """
+    Return [(width, height), ...] in points of every page of pdf (path, bytes or
+    open document), as the pages are rendered.
+    """
+    doc, owned = _open_pdf_document(pdf)
+    try:
+        return [(page.rect.width, page.rect.height) for page in doc]
+    finally:
+        if owned:
+            doc.close()
+
+
+_RENDER_POOL = None
+_RENDER_POOL_WORKERS = os.cpu_count() or 1
+_RENDER_POOL_LOCK = threading.Lock()
+
+
+def configure_render_pool(workers=None):
+    """
+    Set the number of processes used to render PDF pages (default: CPU count).
+
+    The pool is shared by every render call in the process, so samples processed
+    concurrently queue their pages on the same workers instead of each starting
+    their own and oversubscribing the cores. workers=1 renders in-process.
+    """
+    global _RENDER_POOL, _RENDER_POOL_WORKERS
+    with _RENDER_POOL_LOCK:
+        if _RENDER_POOL is not None:
+            _RENDER_POOL.shutdown()
+            _RENDER_POOL = None
+        _RENDER_POOL_WORKERS = max(1, workers or os.cpu_count() or 1)
+
+
+def _get_render_pool():
+    global _RENDER_POOL
+    with _RENDER_POOL_LOCK:
+        if _RENDER_POOL_WORKERS <= 1:
+            return None, 1
+        if _RENDER_POOL is None:
+            # Spawned rather than forked: by now the process runs threads (the
+            # model request executors, the asyncio loop) whose locks a fork
+            # could copy while held
+            _RENDER_POOL = ProcessPoolExecutor(
+                max_workers=_RENDER_POOL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
             )
-            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-            cv2.imwrite(image_filepath, image)
+        return _RENDER_POOL, _RENDER_POOL_WORKERS
+
+
+def _shutdown_render_pool():
+    global _RENDER_POOL
+    with _RENDER_POOL_LOCK:
+        if _RENDER_POOL is not None:
+            _RENDER_POOL.shutdown()
+            _RENDER_POOL = None
+
+
+atexit.register(_shutdown_render_pool)
+
+
+def _image_extension(image_format):
+    image_format = image_format.lower().lstrip(".")
+    return "jpg" if image_format == "jpeg" else image_format
+
+
+def encode_pixmap(pix, image_format="jpg", quality=95):
+    """
+    Encode a PyMuPDF pixmap without copying its samples. Pillow reads the samples
+    buffer in place for JPEG and WebP; PNG, and JPEG without Pillow, use
+    PyMuPDF's own writers.
+    """
+    image_format = _image_extension(image_format)
+    if image_format == "png":
+        return pix.tobytes(output="png")
+    if image_format not in ("jpg", "webp"):
+        raise ValueError(f"Unsupported image format: {image_format}")
+    if Image is None:
+        if image_format == "jpg":
+            return pix.tobytes(output="jpg", jpg_quality=quality)
+        raise ValueError("WebP output requires Pillow to be installed")
+    image = Image.frombuffer(
+        "RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", pix.stride, 1
+    )
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG" if image_format == "jpg" else "WEBP", quality=quality)
+    return buffer.getvalue()
+
+
+def _render_page(page, dpi=300, image_format="jpg", quality=95):
+    pix = page.get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72))
+    return encode_pixmap(pix, image_format, quality)
+
+
+def _render_page_range(pdf, start, stop, dpi=300, image_format="jpg", quality=95):
+    """
+    Render pool entry point: open pdf (path or bytes) in the worker and return the
+    encoded images of pages start to stop - 1.
+    """
+    doc, _ = _open_pdf_document(pdf)
+    try:
+        return [
+            _render_page(doc[idx], dpi, image_format, quality) for idx in range(start, stop)
+        ]
+    finally:
         doc.close()
+
+
+def iter_pdf_page_images(pdf, dpi=300, image_format="jpg", quality=95):
+    """
+    Yield (page_number, encoded image bytes) for every page of pdf (path, bytes
+    or open document), rendering in-process one page at a time so only a single
+    page image is held in memory.
+    """
+    doc, owned = _open_pdf_document(pdf)
+    try:
+        for page in doc:
+            yield page.number + 1, _render_page(page, dpi, image_format, quality)
+    finally:
+        if owned:
+            doc.close()
+
+
+def _render_pdf_pages(pdf, logger, dpi=300, image_format="jpg", quality=95):
+    """
+    Render every page of pdf to encoded image bytes in page order. Multi-page
+    paths and PDF bytes are split into contiguous page ranges over the shared
+    render pool; already open documents cannot be sent to workers and render
+    in-process.
+    """
+    doc, owned = _open_pdf_document(pdf)
+    try:
+        page_count = doc.page_count
+        pool, workers = _get_render_pool() if owned else (None, 1)
+        if pool is None or page_count < 2:
+            return [_render_page(page, dpi, image_format, quality) for page in doc]
+    finally:
+        if owned:
+            doc.close()
+
+    chunk_size = math.ceil(page_count / min(workers, page_count))
+    try:
+        futures = [
+            pool.submit(
+                _render_page_range,
+                pdf,
+                start,
+                min(start + chunk_size, page_count),
+                dpi,
+                image_format,
+                quality,
+            )
+            for start in range(0, page_count, chunk_size)
+        ]
+        return [image for future in futures for image in future.result()]
+    except BrokenProcessPool as error:
+        logger.warning(f"Render pool failed ({error}), rendering pages in-process")
+        configure_render_pool(_RENDER_POOL_WORKERS)
+        return _render_page_range(pdf, 0, page_count, dpi, image_format, quality)
+
+
+def pdf_to_images(
+    pdf_path, image_directory, data_flag, logger, dpi=300, image_format="jpg", quality=95
+):
+    """
+    Render every page of pdf_path (path, bytes or open document) to
+    image_directory as Page<n>.<image_format>.
+
+    Args:
+        dpi: Render resolution
+        image_format: "jpg", "png" or "webp"
+        quality: JPEG/WebP quality (ignored for PNG)
+    """
+    try:
+        extension = _image_extension(image_format)
+        images = _render_pdf_pages(pdf_path, logger, dpi, image_format, quality)
+        for idx, image in enumerate(images):
+            image_filepath = os.path.join(
+                image_directory, "Page{}.{}".format(str(idx + 1), extension)
+            )
+            with open(image_filepath, "wb") as image_file:
+                image_file.write(image)
         print("PDF was converted to images successfully for {}!".format(data_flag))
         logger.info(
             "PDF was converted to images successfully for {}!".format(data_flag)
@@ -274,6 +1386,33 @@ def pdf_to_images(pdf_path, image_directory, data_flag, logger):
         raise
 
 
+def pdf_to_base64_images(pdf, data_flag, logger, dpi=300, image_format="jpg", quality=95):
+    """
+    Render every page of pdf (path, bytes or open document) in memory and return
+    {"Page1.jpg": base64_string, ...}, the same keys pdf_to_images would write
+    to disk.
+    """
+    try:
+        image_data = {}
+        extension = _image_extension(image_format)
+        images = _render_pdf_pages(pdf, logger, dpi, image_format, quality)
+        for idx, image in enumerate(images):
+            image_data["Page{}.{}".format(str(idx + 1), extension)] = base64.b64encode(
+                image
+            ).decode("utf-8")
+        print("PDF was converted to Base64 images in memory successfully for {}!".format(data_flag))
+        logger.info(
+            "PDF was converted to Base64 images in memory successfully for {}!".format(data_flag)
+        )
+        return image_data
+    except Exception as error:
+        print("Error while converting PDF to Base64 images for {}!".format(data_flag))
+        print("{}".format(error))
+        logger.error("Error while converting PDF to Base64 images for {}!".format(data_flag))
+        logger.error("{}".format(error))
+        raise
+
+
 def pdf_to_base64(data_directory, logger):
     try:
         image_data = {}
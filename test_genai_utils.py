@@ -0,0 +1,83 @@
+import json
+import logging
+import re
+import time
+
+import pytest
+
+from utils import genai_utils
+from utils.llm_utils import CircuitOpenError
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _field_mappings(count):
+    return json.dumps({f"field{i}": {"field_type": "text"} for i in range(count)})
+
+
+def _value(chunk_idx):
+    return {"field_name": f"field{chunk_idx}", "field_type": "text", "field_value": str(chunk_idx)}
+
+
+def _fake_generation(monkeypatch, respond):
+    calls = []
+
+    def generate(client, document_type, data_generation_prompt, **kwargs):
+        chunk_idx = int(re.search(r"\(chunk (\d+)\)", document_type).group(1))
+        calls.append(chunk_idx)
+        return respond(chunk_idx, calls.count(chunk_idx))
+
+    monkeypatch.setattr(genai_utils, "generate_synthetic_data_single", generate)
+    return calls
+
+
+def _generate(field_count):
+    return genai_utils.generate_synthetic_data_chunked(
+        client=None,
+        document_type="URLA",
+        data_generation_prompt="",
+        field_mappings_json=_field_mappings(field_count),
+        human_readable_labels="{}",
+        data_flag="URLA - Sample 1",
+        logger=LOGGER,
+    )
+
+
+def test_chunks_merge_in_chunk_order(monkeypatch):
+    def respond(chunk_idx, attempt):
+        # Chunk 2 finishes last but chunk 3 still wins the shared label
+        time.sleep(0.2 if chunk_idx == 2 else 0)
+        return {"Shared": _value(chunk_idx), f"Chunk {chunk_idx}": _value(chunk_idx)}
+
+    _fake_generation(monkeypatch, respond)
+
+    result = _generate(450)
+
+    assert list(result) == ["Shared", "Chunk 1", "Chunk 2", "Chunk 3"]
+    assert result["Shared"] == _value(3)
+
+
+def test_backend_error_fails_the_sample_without_chunk_retries(monkeypatch):
+    def respond(chunk_idx, attempt):
+        if chunk_idx == 2:
+            raise CircuitOpenError("circuit open")
+        return {f"Chunk {chunk_idx}": _value(chunk_idx)}
+
+    calls = _fake_generation(monkeypatch, respond)
+
+    with pytest.raises(CircuitOpenError):
+        _generate(300)
+    assert calls.count(2) == 1
+
+
+def test_unusable_chunk_is_retried_then_fails_the_sample(monkeypatch):
+    def respond(chunk_idx, attempt):
+        if chunk_idx == 2:
+            raise json.JSONDecodeError("Expecting value", "", 0)
+        return {f"Chunk {chunk_idx}": _value(chunk_idx)}
+
+    calls = _fake_generation(monkeypatch, respond)
+
+    with pytest.raises(json.JSONDecodeError):
+        _generate(300)
+    assert calls.count(2) == genai_utils.CHUNK_RETRIES + 1
@@ -0,0 +1,65 @@
+import base64
+import logging
+
+import fitz
+
+from utils.image_utils import (
+    _plan_image_sizes,
+    estimate_image_tokens,
+    estimate_prompt_tokens,
+    estimate_text_tokens,
+    prepare_image_blocks,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+# A letter page rendered at 200 DPI
+PAGE_SIZE = (1700, 2200)
+
+
+def test_image_tokens_follow_the_vision_tiling():
+    assert estimate_image_tokens(1024, 1024) == 85 + 170 * 4
+    # Fit into 2048x2048 (1024x2048), then the short side to 768 (768x1536)
+    assert estimate_image_tokens(2048, 4096) == 85 + 170 * 6
+    assert estimate_image_tokens(2048, 4096, detail="low") == 85
+
+
+def test_without_a_budget_images_are_only_reduced_to_the_vision_resolution():
+    plan = _plan_image_sizes([PAGE_SIZE], None)
+
+    assert plan == [(768, 994, "high", estimate_image_tokens(*PAGE_SIZE))]
+
+
+def test_over_budget_images_shrink_by_whole_tiles():
+    plan = _plan_image_sizes([PAGE_SIZE] * 3, 1600)
+
+    assert plan == [(512, 663, "high", 85 + 170 * 2)] * 3
+
+
+def test_the_largest_images_go_to_low_detail_when_one_tile_each_is_too_much():
+    plan = _plan_image_sizes([PAGE_SIZE, (400, 500), PAGE_SIZE], 500)
+
+    assert [detail for _, _, detail, _ in plan] == ["low", "high", "low"]
+    assert sum(tokens for *_, tokens in plan) <= 500
+    assert [(width, height) for width, height, *_ in plan] == [(396, 512), (400, 500), (396, 512)]
+
+
+def test_prepared_images_are_resized_to_their_plan():
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, *PAGE_SIZE), 0)
+    pix.clear_with(255)
+    image_data = {"page_1.png": base64.b64encode(pix.tobytes("png")).decode("utf-8")}
+
+    blocks, tokens = prepare_image_blocks(image_data, LOGGER, "test", token_budget=300)
+
+    assert tokens == 255
+    assert blocks[0]["image_url"]["detail"] == "high"
+    url = blocks[0]["image_url"]["url"]
+    assert url.startswith("data:image/jpeg;base64,")
+    sent = fitz.Pixmap(base64.b64decode(url.split(",", 1)[1]))
+    assert (sent.width, sent.height) == (396, 512)
+
+
+def test_prompt_tokens_add_message_framing_and_images():
+    messages = [{"role": "user", "content": [{"type": "text", "text": "Map these fields"}, {"type": "image_url"}]}]
+
+    assert estimate_prompt_tokens(messages, image_tokens=255) == 3 + 4 + estimate_text_tokens("Map these fields") + 255
@@ -0,0 +1,154 @@
+import json
+import logging
+
+import fitz
+
+from utils.label_utils import (
+    ADJACENT_CAPTION_CONFIDENCE,
+    DEFAULT_MIN_CONFIDENCE,
+    TOOLTIP_CONFIDENCE,
+    TRUNCATED_TOOLTIP_CONFIDENCE,
+    UNCHECKED_CAPTION_CONFIDENCE,
+    PageTextIndex,
+    _caption_label,
+    _tooltip_label,
+    confident_labels,
+    infer_local_labels,
+)
+from utils.pdf_utils import extract_pdf_fields
+
+LOGGER = logging.getLogger(__name__)
+
+
+def test_tooltip_keeps_the_first_sentence_that_stands_alone():
+    label, confidence = _tooltip_label("Line 1. Gross receipts or sales. Caution: see instructions.", "f1_01[0]")
+
+    assert label == "Line 1. Gross receipts or sales"
+    assert confidence == TOOLTIP_CONFIDENCE
+
+
+def test_generic_and_name_tooltips_are_ignored():
+    assert _tooltip_label("Text Field", "form.f1") == (None, 0.0)
+    assert _tooltip_label("f1_01[0]", "form.f1_01[0]") == (None, 0.0)
+    assert _tooltip_label("   ", "form.f1") == (None, 0.0)
+
+
+def test_long_tooltips_are_truncated_at_a_word_with_less_confidence():
+    label, confidence = _tooltip_label("Amount " * 30, "form.f1")
+
+    assert len(label) <= 100 and not label.endswith(" ")
+    assert confidence == TRUNCATED_TOOLTIP_CONFIDENCE
+
+
+def _candidate(label, page_number, confidence=0.9):
+    return {"label": label, "source": "caption", "confidence": confidence, "page_number": page_number}
+
+
+def test_confident_labels_tell_repeated_labels_apart_by_page():
+    labels = confident_labels({
+        "p1_name": _candidate("Name shown on return", 1),
+        "p2_name": _candidate("name shown on return", 2),
+        "ssn": _candidate("SSN", 1),
+        "guess": _candidate("Total", 1, confidence=DEFAULT_MIN_CONFIDENCE - 0.1),
+    })
+
+    assert labels == {
+        "p1_name": "Name shown on return (Page 1)",
+        "p2_name": "name shown on return (Page 2)",
+        "ssn": "SSN",
+    }
+
+
+def test_labels_repeated_on_one_page_go_to_the_model():
+    labels = confident_labels({
+        "amount_1": _candidate("Amount", 1),
+        "amount_2": _candidate("Amount", 1),
+        "date": _candidate("Date", 1),
+    })
+
+    assert labels == {"date": "Date"}
+
+
+def test_tooltips_win_over_captions(tmp_path):
+    pdf_path = str(tmp_path / "form.pdf")
+    mappings_path = str(tmp_path / "_field_mappings.json")
+    doc = fitz.open()
+    page = doc.new_page(width=612, height=792)
+    page.insert_text((72, 100), "Name:")
+    page.insert_text((72, 140), "City:")
+    for name, top, tooltip in (("name", 88, "Borrower legal name"), ("city", 128, None)):
+        widget = fitz.Widget()
+        widget.field_name = name
+        widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+        widget.rect = fitz.Rect(110, top, 300, top + 16)
+        if tooltip:
+            widget.field_label = tooltip
+        page.add_widget(widget)
+    doc.save(pdf_path)
+    doc.close()
+    extract_pdf_fields(pdf_path, mappings_path, LOGGER)
+    with open(mappings_path, "r", encoding="utf-8") as mappings_file:
+        field_mappings = json.load(mappings_file)
+
+    candidates = infer_local_labels(pdf_path, field_mappings, LOGGER)
+
+    assert candidates["name"] == {
+        "label": "Borrower legal name", "source": "tooltip", "confidence": TOOLTIP_CONFIDENCE, "page_number": 1
+    }
+    assert candidates["city"] == {
+        "label": "City", "source": "caption", "confidence": ADJACENT_CAPTION_CONFIDENCE, "page_number": 1
+    }
+
+
+def _words(*runs):
+    """Words of one text line each run, as (x0, text) pairs 10pt high at y=100."""
+    words = []
+    for line, run in enumerate(runs):
+        for position, (x0, text) in enumerate(run):
+            words.append((x0, 100 + 20 * line, x0 + 6 * len(text), 110 + 20 * line, text, 0, line, position))
+    return words
+
+
+def test_text_index_finds_only_the_words_that_intersect():
+    index = PageTextIndex(_words([(10, "First"), (200, "Last")], [(10, "Below")]), cell_size=16)
+
+    assert [word[4] for word in index.query((0, 95, 100, 112))] == ["First"]
+    assert [word[4] for word in index.query((0, 95, 300, 135))] == ["First", "Last", "Below"]
+    assert index.query((500, 500, 600, 600)) == []
+
+
+def test_caption_words_stop_at_wide_gaps_and_the_neighbouring_widget():
+    words = _words([(10, "Phone"), (60, "Last"), (88, "name")])
+    index = PageTextIndex(words)
+    name = words[2]
+
+    assert [word[4] for word in index.caption_words((0, 0), name, True, float("-inf"))] == ["Last", "name"]
+    assert [word[4] for word in index.caption_words((0, 0), name, True, 86)] == ["name"]
+
+
+def test_captions_of_a_row_end_at_the_previous_field():
+    words = _words([(10, "First"), (46, "name"), (200, "Last"), (230, "name")])
+    index = PageTextIndex(words)
+    first_field = (80, 98, 190, 112)
+    last_field = (260, 98, 400, 112)
+
+    assert _caption_label(index, last_field, False, widget_rects=[first_field, last_field]) == (
+        "Last name", ADJACENT_CAPTION_CONFIDENCE
+    )
+    assert _caption_label(index, first_field, False, widget_rects=[first_field, last_field]) == (
+        "First name", ADJACENT_CAPTION_CONFIDENCE
+    )
+
+
+def test_long_instructions_next_to_a_field_are_left_to_the_model():
+    text = "Enter the amount from line 7 of your worksheet here"
+    run, x0 = [], 10
+    for word in text.split():
+        run.append((x0, word))
+        x0 += 6 * len(word) + 4
+    index = PageTextIndex(_words(run))
+
+    label, confidence = _caption_label(index, (x0 + 10, 98, x0 + 100, 112), False)
+
+    assert label == text
+    assert confidence == UNCHECKED_CAPTION_CONFIDENCE < DEFAULT_MIN_CONFIDENCE
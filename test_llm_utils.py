@@ -0,0 +1,383 @@
+import logging
+import random
+import time
+from types import SimpleNamespace
+
+import openai
+import pytest
+from openai.types.chat import ChatCompletion
+
+from utils.llm_utils import (
+    CircuitBreaker,
+    CircuitOpenError,
+    ClientPool,
+    HedgePolicy,
+    PoolMember,
+    RequestScheduler,
+    ResponseCache,
+    RetryPolicy,
+    TokenBucket,
+    chat_completion,
+    configure_circuit_breaker,
+    configure_response_cache,
+    configure_retries,
+    configure_scheduler,
+    is_backend_error,
+    response_cache_stats,
+    _retry_after,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+
+@pytest.fixture(autouse=True)
+def default_engine():
+    """Every test starts with no quotas, breaker or response cache and the default retries."""
+    configure_scheduler()
+    configure_circuit_breaker(enabled=False)
+    configure_retries()
+    configure_response_cache()
+    yield
+    configure_scheduler()
+    configure_circuit_breaker(enabled=False)
+    configure_retries()
+    configure_response_cache()
+    configure_circuit_breaker()
+
+
+def _bucket(per_minute):
+    bucket = TokenBucket(per_minute)
+    bucket.updated = 0.0
+    return bucket
+
+
+def test_token_bucket_refills_at_its_rate_up_to_its_burst():
+    bucket = _bucket(600)
+    assert bucket.capacity == 100
+
+    bucket.take(100)
+
+    assert bucket.wait_time(10, 0.0) == pytest.approx(1.0)
+    assert bucket.wait_time(10, 0.5) == pytest.approx(0.5)
+    assert bucket.wait_time(10, 60.0) == 0.0
+    assert bucket.level == 100
+
+
+def test_requests_larger_than_the_bucket_wait_only_for_a_full_bucket():
+    bucket = _bucket(600)
+    bucket.take(100)
+
+    assert bucket.wait_time(1000, 0.0) == pytest.approx(10.0)
+
+
+def test_unused_tokens_go_back_to_the_deployment():
+    scheduler = RequestScheduler(tokens_per_minute=6000)
+
+    scheduler.acquire("gpt-4o", 800)
+    requests, wait = scheduler.headroom("gpt-4o", 400)
+    assert requests == 0.0 and wait == pytest.approx(2.0, abs=0.1)
+
+    scheduler.reconcile("gpt-4o", 800, 300)
+    requests, wait = scheduler.headroom("gpt-4o", 400)
+    assert wait == 0.0 and requests == pytest.approx(1.75, abs=0.05)
+    assert scheduler.stats["tokens_charged"] == 800
+    assert scheduler.stats["tokens_used"] == 300
+
+
+def test_a_paused_deployment_admits_nothing_until_the_pause_ends():
+    scheduler = RequestScheduler()
+
+    scheduler.pause("gpt-4o", 0.2)
+
+    assert scheduler.headroom("other", 1) == (float("inf"), 0.0)
+    assert scheduler.headroom("gpt-4o", 1)[1] > 0.1
+    assert scheduler.acquire("gpt-4o", 1) >= 0.15
+
+
+class FakeRateLimitError(openai.RateLimitError):
+    def __init__(self, headers=None):
+        Exception.__init__(self, "429 Too Many Requests")
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+class FakeTimeoutError(openai.APITimeoutError):
+    def __init__(self):
+        Exception.__init__(self, "Request timed out")
+
+
+class FakeCompletions:
+    """Stands in for client.chat.completions, raising the given errors first."""
+
+    def __init__(self, *errors, response=None):
+        self.errors = list(errors)
+        self.response = response or SimpleNamespace(usage=None, choices=[])
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.response
+
+
+def _complete(client, **kwargs):
+    return chat_completion(
+        client, LOGGER, "test", model="gpt-4o", messages=[{"role": "user", "content": "Hello"}], **kwargs
+    )
+
+
+def test_backoff_is_jittered_below_its_cap_and_never_under_retry_after():
+    policy = RetryPolicy(max_retries=6, base_delay=1.0, max_delay=8.0)
+    random.seed(7)
+
+    delays = [policy.delay(retry) for retry in range(10) for _ in range(20)]
+
+    assert all(0.0 <= delay <= min(8.0, 2 ** (index // 20)) for index, delay in enumerate(delays))
+    assert policy.delay(0, retry_after=5.0) == 5.0
+
+
+def test_retry_after_is_read_from_either_header():
+    assert _retry_after(FakeRateLimitError({"retry-after-ms": "250"})) == 0.25
+    assert _retry_after(FakeRateLimitError({"retry-after": "3"})) == 3.0
+    assert _retry_after(FakeRateLimitError({"retry-after": "Wed, 21 Oct 2026 07:28:00 GMT"})) is None
+    assert _retry_after(FakeRateLimitError()) is None
+
+
+def test_throttled_requests_wait_for_retry_after_and_succeed():
+    configure_retries(policies={"rate_limit": RetryPolicy(max_retries=6, base_delay=0.0, max_delay=0.0)})
+    client = FakeCompletions(FakeRateLimitError({"retry-after-ms": "100"}))
+    started = time.monotonic()
+
+    assert _complete(client) is client.response
+
+    assert client.calls == 2
+    assert time.monotonic() - started >= 0.1
+
+
+def test_errors_are_raised_once_their_retries_are_spent():
+    configure_retries(policies={"timeout": RetryPolicy(max_retries=2, base_delay=0.0, max_delay=0.0)})
+    client = FakeCompletions(FakeTimeoutError(), FakeTimeoutError(), FakeTimeoutError())
+
+    with pytest.raises(openai.APITimeoutError):
+        _complete(client)
+    assert client.calls == 3
+
+
+def test_other_errors_are_not_retried():
+    client = FakeCompletions(ValueError("bad request"))
+
+    with pytest.raises(ValueError):
+        _complete(client)
+    assert client.calls == 1
+
+
+def test_hedges_start_after_min_samples_at_the_latency_percentile():
+    policy = HedgePolicy(percentile=50, min_samples=3)
+
+    for latency in (1.0, 2.0):
+        assert policy.threshold("synthetic data") is None
+        policy.record("synthetic data", latency, hedge_won=False)
+    assert policy.threshold("synthetic data") is None
+    policy.record("synthetic data", 3.0, hedge_won=False)
+
+    assert policy.threshold("synthetic data") == 2.0
+    assert policy.threshold("validation") is None
+
+
+def test_hedges_stay_within_the_hedge_ratio():
+    policy = HedgePolicy(max_hedge_ratio=0.1)
+    allowed = 0
+
+    for _ in range(30):
+        policy.threshold("synthetic data")
+        allowed += policy.allow_hedge("synthetic data")
+
+    assert allowed == 3
+    assert policy.stats()["synthetic data"]["hedges"] == 3
+
+
+def test_hedge_stats_compare_against_the_first_requests():
+    policy = HedgePolicy()
+    for _ in range(99):
+        policy.record("synthetic data", 1.0, hedge_won=False)
+    policy.record("synthetic data", 1.5, hedge_won=True)
+    policy.record_unhedged("synthetic data", 6.0, aborted=True)
+
+    stats = policy.stats()["synthetic data"]
+
+    assert stats["hedge_wins"] == 1
+    assert stats["p99_seconds"] == 1.5
+    assert stats["p99_reduction_seconds"] == 4.5
+    assert stats["aborted_primaries"] == 1
+
+
+def _pool(**clients):
+    members = [PoolMember({"name": name, "endpoint": f"https://{name}.example", "api_key": "key"}) for name in clients]
+    return ClientPool(members, cooldown=30.0, clients=clients)
+
+
+def test_a_member_failing_three_times_in_a_row_is_ejected():
+    pool = _pool(east=FakeCompletions(), west=FakeCompletions())
+    east = pool.members[0]
+
+    for _ in range(3):
+        pool.report(east, True, LOGGER)
+
+    assert pool.stats()["east"] == {"requests": 3, "errors": 3, "ejections": 1, "ejected": True}
+    assert all(pool.select("gpt-4o", 100, RequestScheduler()).name == "west" for _ in range(20))
+
+
+def test_a_member_failing_half_of_its_requests_is_ejected():
+    pool = _pool(east=FakeCompletions(), west=FakeCompletions())
+    east = pool.members[0]
+
+    for failed in [False, True] * 4 + [False]:
+        pool.report(east, failed, LOGGER)
+    assert not pool.stats()["east"]["ejected"]
+    pool.report(east, True, LOGGER)
+
+    assert pool.stats()["east"]["ejected"]
+
+
+def test_with_every_member_ejected_the_one_back_soonest_is_used():
+    pool = _pool(east=FakeCompletions(), west=FakeCompletions())
+    for member, cooldown in zip(pool.members, (20.0, 10.0)):
+        member.ejected_until = time.monotonic() + cooldown
+
+    assert pool.select("gpt-4o", 100, RequestScheduler()).name == "west"
+    assert pool.wait_time("gpt-4o", 100, RequestScheduler()) == pytest.approx(10.0, abs=0.1)
+
+
+def test_throttled_requests_fail_over_without_waiting():
+    pool = _pool(
+        east=FakeCompletions(*[FakeRateLimitError({"retry-after": "5"}) for _ in range(10)]),
+        west=FakeCompletions(),
+    )
+    started = time.monotonic()
+
+    for _ in range(5):
+        _complete(pool)
+
+    assert time.monotonic() - started < 1.0
+    assert pool.clients["west"].calls == 5
+
+
+def _open_breaker(**kwargs):
+    breaker = CircuitBreaker(window=4, min_requests=4, **kwargs)
+    for _ in range(4):
+        breaker.record(breaker.before_request(LOGGER, "test"), True, LOGGER)
+    return breaker
+
+
+def test_the_breaker_opens_once_enough_requests_failed():
+    breaker = CircuitBreaker(window=4, min_requests=4)
+
+    for failed in (True, False, True):
+        breaker.record(False, failed, LOGGER)
+    assert breaker.state == "closed"
+    breaker.record(False, True, LOGGER)
+
+    assert breaker.state == "open"
+    assert breaker.stats["opened"] == 1
+
+
+def test_a_successful_probe_closes_the_breaker():
+    breaker = _open_breaker(open_seconds=0.1)
+    started = time.monotonic()
+
+    probe = breaker.before_request(LOGGER, "test")
+
+    assert probe and breaker.state == "half_open"
+    assert time.monotonic() - started >= 0.09
+    breaker.record(probe, False, LOGGER)
+    assert breaker.state == "closed"
+    assert breaker.before_request(LOGGER, "test") is False
+
+
+def test_a_failed_probe_opens_the_breaker_for_longer():
+    breaker = _open_breaker(open_seconds=0.05, max_open_seconds=0.15)
+
+    probe = breaker.before_request(LOGGER, "test")
+    breaker.record(probe, True, LOGGER)
+
+    assert breaker.state == "open"
+    assert breaker.opened_until - time.monotonic() == pytest.approx(0.1, abs=0.02)
+    assert breaker.next_open_seconds == 0.15
+
+
+def test_requests_held_back_too_long_raise_a_backend_error():
+    breaker = _open_breaker(open_seconds=10.0, max_wait=0.05)
+
+    with pytest.raises(CircuitOpenError) as raised:
+        breaker.before_request(LOGGER, "test")
+
+    assert is_backend_error(raised.value)
+    assert breaker.stats["probes"] == 0
+
+
+def _completion(content, finish_reason="stop"):
+    return ChatCompletion.model_validate({
+        "id": "chatcmpl-1",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "gpt-4o",
+        "choices": [{
+            "index": 0,
+            "finish_reason": finish_reason,
+            "message": {"role": "assistant", "content": content},
+        }],
+        "usage": {"prompt_tokens": 90, "completion_tokens": 10, "total_tokens": 100},
+    })
+
+
+def test_cached_responses_expire_after_their_ttl(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    key = cache.key({"model": "gpt-4o", "messages": [{"role": "user", "content": "Hello"}]})
+    cache.put(key, _completion("Hi"))
+
+    assert cache.get(key).choices[0].message.content == "Hi"
+    cache.ttl_seconds = -1
+    assert cache.get(key) is None
+    assert cache.stats == {"hits": 1, "misses": 1, "stores": 1, "expired": 1, "evictions": 0, "tokens_saved": 100}
+
+
+def test_the_least_recently_used_responses_are_evicted(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    keys = [cache.key({"prompt": prompt}) for prompt in ("one", "two", "six")]
+    cache.put(keys[0], _completion("one"))
+    # Room for two of the equally sized entries
+    cache.max_bytes = cache._index()[keys[0]][0] * 5 // 2
+    time.sleep(0.01)
+    cache.put(keys[1], _completion("two"))
+    time.sleep(0.01)
+    cache.get(keys[0])
+    time.sleep(0.01)
+
+    cache.put(keys[2], _completion("six"))
+
+    assert cache.stats["evictions"] == 1
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+
+
+def test_complete_responses_are_served_from_the_cache(tmp_path):
+    configure_response_cache(str(tmp_path))
+    client = FakeCompletions(response=_completion("Hi"))
+
+    first = _complete(client, cache=True)
+    second = _complete(client, cache=True)
+
+    assert client.calls == 1
+    assert second.choices[0].message.content == first.choices[0].message.content == "Hi"
+    assert response_cache_stats()["hits"] == 1
+
+
+def test_truncated_responses_are_not_cached(tmp_path):
+    configure_response_cache(str(tmp_path))
+    client = FakeCompletions(response=_completion("Hi", finish_reason="length"))
+
+    _complete(client, cache=True)
+    _complete(client, cache=True)
+
+    assert client.calls == 2
@@ -0,0 +1,112 @@
+import json
+import logging
+
+import fitz
+import pytest
+
+from utils import pdf_utils
+from utils.label_utils import infer_local_labels
+from utils.pdf_utils import extract_pdf_fields, load_fieldname_images
+
+
+def _make_form(path, rotation):
+    """One page with a "Name:" caption left of a text field, turned by rotation."""
+    doc = fitz.open()
+    page = doc.new_page(width=612, height=792)
+    page.insert_text((100, 100), "Name:")
+    widget = fitz.Widget()
+    widget.field_name = "name"
+    widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+    widget.rect = fitz.Rect(140, 88, 300, 104)
+    page.add_widget(widget)
+    page.set_rotation(rotation)
+    doc.save(path)
+    doc.close()
+
+
+@pytest.mark.parametrize("rotation", [0, 90, 180, 270])
+def test_widget_rects_and_captions_on_rotated_pages(tmp_path, rotation):
+    pdf_path = str(tmp_path / f"form_{rotation}.pdf")
+    mappings_path = str(tmp_path / "_field_mappings.json")
+    _make_form(pdf_path, rotation)
+    logger = logging.getLogger(__name__)
+
+    extract_pdf_fields(pdf_path, mappings_path, logger)
+    with open(mappings_path, "r", encoding="utf-8") as mappings_file:
+        field_mappings = json.load(mappings_file)
+
+    with fitz.open(pdf_path) as doc:
+        page = doc[0]
+        rendered = next(page.widgets()).rect * page.rotation_matrix
+    assert field_mappings["name"]["widgets"][0]["rect"] == pytest.approx(list(rendered), abs=0.01)
+
+    labels = infer_local_labels(pdf_path, field_mappings, logger)
+    assert labels["name"]["label"] == "Name"
+    assert labels["name"]["source"] == "caption"
+
+
+def _make_form_with_blank_page(path):
+    """A captioned text field on page 1 and nothing on page 2."""
+    doc = fitz.open()
+    page = doc.new_page(width=612, height=792)
+    for line in range(20):
+        page.insert_text((72, 200 + line * 20), "Please complete every field of this form in block letters.")
+    page.insert_text((72, 100), "Borrower name:")
+    widget = fitz.Widget()
+    widget.field_name = "borrower_name"
+    widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+    widget.rect = fitz.Rect(160, 86, 400, 106)
+    page.add_widget(widget)
+    doc.new_page(width=612, height=792)
+    doc.save(path)
+    doc.close()
+
+
+def _count_analyses(monkeypatch):
+    calls = []
+    analyze = pdf_utils.analyze_fieldname_images
+
+    def counting_analyze(*args, **kwargs):
+        calls.append(args)
+        return analyze(*args, **kwargs)
+
+    monkeypatch.setattr(pdf_utils, "analyze_fieldname_images", counting_analyze)
+    return calls
+
+
+def test_fieldname_images_are_analyzed_once(tmp_path, monkeypatch):
+    pdf_path = str(tmp_path / "form.pdf")
+    _make_form_with_blank_page(pdf_path)
+    analyses = _count_analyses(monkeypatch)
+
+    image_paths, image_data, analysis = load_fieldname_images(
+        pdf_path, str(tmp_path), "form.pdf", logging.getLogger(__name__)
+    )
+
+    assert len(analyses) == 1
+    assert sorted(image_data) == ["page_1.png", "page_2.png"]
+    assert [page["usable"] for page in analysis["pages"]] == [True, False]
+    assert analysis["pages"][1]["blank"]
+    assert analysis["fields"]["borrower_name"]["visible"]
+    assert not analysis["passed"]
+
+
+def test_cached_fieldname_images_skip_rendering_and_analysis(tmp_path, monkeypatch):
+    pdf_path = str(tmp_path / "form.pdf")
+    _make_form_with_blank_page(pdf_path)
+    logger = logging.getLogger(__name__)
+    first = load_fieldname_images(pdf_path, str(tmp_path), "form.pdf", logger)
+    analyses = _count_analyses(monkeypatch)
+    monkeypatch.setattr(
+        pdf_utils,
+        "fill_pdf_fields_with_names_and_render_images",
+        lambda *args, **kwargs: pytest.fail("cached field name images were rendered again"),
+    )
+
+    second = load_fieldname_images(pdf_path, str(tmp_path), "form.pdf", logger)
+
+    assert analyses == []
+    assert second == first
+    with open(tmp_path / "form_fieldname_images" / "fieldname_cache.json", "r", encoding="utf-8") as cache_file:
+        cache = json.load(cache_file)
+    assert cache["images"] == ["page_1.png", "page_2.png"]
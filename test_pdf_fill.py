@@ -0,0 +1,175 @@
+import logging
+import os
+
+import fitz
+import pytest
+
+from utils import pdf_utils
+from utils.pdf_utils import (
+    FieldNameTrie,
+    fill_pdf_fields,
+    fill_pdf_fields_batch,
+    fill_pdf_fields_to_bytes,
+    load_pdf_template,
+    pdf_to_images,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _make_form(path):
+    """Two text fields sharing the terminal name "name", a check box and a second page."""
+    doc = fitz.open()
+    page = doc.new_page(width=612, height=792)
+    for name, top in (("borrower.name", 80), ("coborrower.name", 120)):
+        widget = fitz.Widget()
+        widget.field_name = name
+        widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+        widget.rect = fitz.Rect(100, top, 300, top + 20)
+        page.add_widget(widget)
+    widget = fitz.Widget()
+    widget.field_name = "agree"
+    widget.field_type = fitz.PDF_WIDGET_TYPE_CHECKBOX
+    widget.rect = fitz.Rect(100, 160, 115, 175)
+    page.add_widget(widget)
+    page = doc.new_page(width=612, height=792)
+    widget = fitz.Widget()
+    widget.field_name = "city"
+    widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+    widget.rect = fitz.Rect(100, 80, 300, 100)
+    page.add_widget(widget)
+    doc.save(path)
+    doc.close()
+
+
+def _entry(field_name, value, field_type="/Tx"):
+    return {"field_name": field_name, "field_type": field_type, "field_value": value}
+
+
+def _field_values(pdf):
+    with fitz.open(stream=pdf) if isinstance(pdf, bytes) else fitz.open(pdf) as doc:
+        return {widget.field_name: widget.field_value for page in doc for widget in page.widgets()}
+
+
+@pytest.fixture
+def form(tmp_path):
+    pdf_utils._TEMPLATE_CACHE.clear()
+    path = str(tmp_path / "form.pdf")
+    _make_form(path)
+    yield path
+    pdf_utils._TEMPLATE_CACHE.clear()
+
+
+def test_template_is_parsed_once_and_again_after_an_edit(form):
+    template = load_pdf_template(form)
+    assert load_pdf_template(form) is template
+
+    _make_form(form)
+    stat = os.stat(form)
+    os.utime(form, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+    assert load_pdf_template(form) is not template
+    assert len(pdf_utils._TEMPLATE_CACHE) == 1
+
+
+def test_template_cache_drops_the_least_recently_used(tmp_path, monkeypatch, form):
+    monkeypatch.setattr(pdf_utils, "TEMPLATE_CACHE_SIZE", 2)
+    paths = [form]
+    for name in ("second.pdf", "third.pdf"):
+        paths.append(str(tmp_path / name))
+        _make_form(paths[-1])
+
+    first = load_pdf_template(paths[0])
+    load_pdf_template(paths[1])
+    load_pdf_template(paths[0])
+    load_pdf_template(paths[2])
+
+    assert [key[0] for key in pdf_utils._TEMPLATE_CACHE] == [os.path.abspath(p) for p in (paths[0], paths[2])]
+    assert load_pdf_template(paths[0]) is first
+
+
+def test_clones_do_not_see_each_others_values(form):
+    first = fill_pdf_fields_to_bytes(form, {"Name": _entry("borrower.name", "Jane")}, "first", LOGGER)
+    second = fill_pdf_fields_to_bytes(form, {"Name": _entry("borrower.name", "John")}, "second", LOGGER)
+    empty = fill_pdf_fields_to_bytes(form, {}, "empty", LOGGER)
+
+    assert _field_values(first)["borrower.name"] == "Jane"
+    assert _field_values(second)["borrower.name"] == "John"
+    assert _field_values(empty)["borrower.name"] == ""
+    template = load_pdf_template(form)
+    assert empty.startswith(template.source_bytes)
+    assert template.widget_index["borrower.name"]["field"].V is None
+
+
+def test_widget_index_holds_pages_types_and_states(form):
+    index = load_pdf_template(form).widget_index
+
+    assert sorted(index) == ["agree", "borrower.name", "city", "coborrower.name"]
+    assert index["city"]["page_numbers"] == [2]
+    assert index["city"]["widget_pages"] == [1]
+    assert index["borrower.name"]["field_type"] == "/Tx"
+    assert index["agree"]["field_type"] == "/Btn"
+    assert index["agree"]["states"] == ["Yes"]
+
+
+def test_partial_field_names_resolve_only_when_unambiguous(form):
+    template = load_pdf_template(form)
+
+    assert template.resolve_field_name("borrower.name") == ("borrower.name", ["borrower.name"])
+    assert template.resolve_field_name("city") == ("city", ["city"])
+    full_name, candidates = template.resolve_field_name("name")
+    assert full_name is None
+    assert sorted(candidates) == ["borrower.name", "coborrower.name"]
+    assert template.resolve_field_name("missing") == (None, [])
+
+
+def test_trie_matches_whole_segments_only():
+    trie = FieldNameTrie(["form1.page1.name", "form1.page2.name", "form1.page1.surname"])
+
+    assert trie.match("page1.name") == ["form1.page1.name"]
+    assert sorted(trie.match("name")) == ["form1.page1.name", "form1.page2.name"]
+    assert trie.match("1.name") == []
+
+
+def test_ambiguous_names_are_left_empty(form):
+    values = _field_values(fill_pdf_fields_to_bytes(form, {"Name": _entry("name", "Jane")}, "ambiguous", LOGGER))
+
+    assert values["borrower.name"] == values["coborrower.name"] == ""
+
+
+def test_batch_fill_writes_every_variant_as_an_incremental_update(tmp_path, form):
+    variants = [
+        (str(tmp_path / f"variant_{idx}.pdf"), {
+            "Name": _entry("borrower.name", f"Borrower {idx}"),
+            "City": _entry("city", f"City {idx}"),
+            "Agree": _entry("agree", "Yes" if idx % 2 else "Off", "/Btn"),
+        })
+        for idx in range(1, 4)
+    ]
+
+    timings = fill_pdf_fields_batch(form, variants, "batch", LOGGER)
+
+    source_bytes = load_pdf_template(form).source_bytes
+    assert [timing["output_pdf_path"] for timing in timings] == [path for path, _ in variants]
+    for idx, (path, _) in enumerate(variants, 1):
+        with open(path, "rb") as pdf_file:
+            assert pdf_file.read().startswith(source_bytes)
+        values = _field_values(path)
+        assert values["borrower.name"] == f"Borrower {idx}"
+        assert values["city"] == f"City {idx}"
+        assert values["agree"] == ("Yes" if idx % 2 else "Off")
+
+
+def test_in_memory_fill_matches_the_file_written_to_disk(tmp_path, form):
+    data = {"Name": _entry("borrower.name", "Jane"), "Agree": _entry("agree", "Yes", "/Btn")}
+    output_pdf_path = str(tmp_path / "filled.pdf")
+    image_directory = tmp_path / "images"
+    image_directory.mkdir()
+
+    fill_pdf_fields(form, output_pdf_path, data, "on disk", LOGGER)
+    pdf_bytes = fill_pdf_fields_to_bytes(form, data, "in memory", LOGGER)
+    pdf_to_images(pdf_bytes, str(image_directory), "in memory", LOGGER, dpi=36, image_format="png")
+
+    with open(output_pdf_path, "rb") as pdf_file:
+        assert pdf_file.read() == pdf_bytes
+    assert sorted(os.listdir(image_directory)) == ["Page1.png", "Page2.png"]
@@ -0,0 +1,22 @@
+import json
+import re
+
+from utils.validation_utils import _compact_validation_prompt
+
+
+def _prompt_fields(prompt):
+    return json.loads(re.search(r"```json\s*(\{.*?\})\s*```", prompt, re.S).group(1))
+
+
+def test_compact_prompt_keeps_fields_with_the_same_terminal_name():
+    synthetic_data = {
+        "Borrower Name": {"field_name": "form1.borrower.name", "field_value": "Jane Doe"},
+        "Co-Borrower Name": {"field_name": "form1.coborrower.name", "field_value": "John Doe"},
+    }
+
+    fields = _prompt_fields(_compact_validation_prompt("URLA", synthetic_data))
+
+    assert fields == {
+        "form1.borrower.name": ["Borrower Name", "Jane Doe"],
+        "form1.coborrower.name": ["Co-Borrower Name", "John Doe"],
+    }
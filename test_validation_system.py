@@ -0,0 +1,48 @@
+import logging
+
+from utils.llm_utils import CircuitOpenError, run_with_requeue
+
+
+def _variant_runner(generated, failures):
+    """Run variants like main.py does, failing each variant failures[idx] times."""
+
+    def run_variants(indices):
+        results = []
+        for idx in indices:
+            generated.append(idx)
+            if failures.get(idx):
+                failures[idx] -= 1
+                results.append(CircuitOpenError("circuit open"))
+            else:
+                results.append(f"variant {idx}")
+        return results
+
+    return run_variants
+
+
+def test_requeue_regenerates_only_the_failed_variant():
+    generated = []
+
+    failed, requeued = run_with_requeue(
+        _variant_runner(generated, {2: 1}), range(1, 4), 2, logging.getLogger(__name__), name="variant"
+    )
+
+    assert generated == [1, 2, 3, 2]
+    assert failed == []
+    assert requeued == 1
+
+
+def test_requeue_gives_up_after_max_requeues_and_on_other_errors():
+    generated = []
+    run_backend_failures = _variant_runner(generated, {1: 5})
+
+    def run_variants(indices):
+        results = run_backend_failures(indices)
+        return [ValueError("bad data") if idx == 3 else result for idx, result in zip(indices, results)]
+
+    failed, requeued = run_with_requeue(run_variants, [1, 2, 3], 2, logging.getLogger(__name__), name="variant")
+
+    assert generated == [1, 2, 3, 1, 1]
+    assert [idx for idx, _ in failed] == [3, 1]
+    assert isinstance(failed[1][1], CircuitOpenError)
+    assert requeued == 2
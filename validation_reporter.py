@@ -23,6 +23,10 @@ class ValidationReporter:
                 "failed_validations": 0,
                 "corrections_applied": 0
             },
+            "tiered_validation": {
+                "tiers": {},
+                "escalations": 0
+            },
             "field_analysis": {},
             "common_issues": {},
             "sample_reports": []
@@ -58,6 +62,22 @@ class ValidationReporter:
         if corrections_made:
             self.report_data["validation_summary"]["corrections_applied"] += len(corrections_made)
         
+        # Latency and token use of the low/high detail validation passes
+        tiered = self.report_data["tiered_validation"]
+        for tier_pass in validation_result.get("tiers", []):
+            tier_totals = tiered["tiers"].setdefault(tier_pass["tier"], {
+                "passes": 0,
+                "latency_seconds": 0.0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0
+            })
+            tier_totals["passes"] += 1
+            tier_totals["latency_seconds"] += tier_pass.get("latency_seconds", 0.0)
+            tier_totals["prompt_tokens"] += tier_pass.get("prompt_tokens", 0)
+            tier_totals["completion_tokens"] += tier_pass.get("completion_tokens", 0)
+            if tier_pass.get("escalated"):
+                tiered["escalations"] += 1
+        
         # Analyze field-level issues
         for issue in validation_result.get("issues", []):
             field_name = issue.get("field_name", "unknown")
@@ -121,6 +141,7 @@ class ValidationReporter:
                 reverse=True
             )[:5],
             "most_problematic_fields": [(field, data["total_issues"]) for field, data in problematic_fields],
+            "validation_tiers": self._summarize_tiers(),
             "recommendations": self._generate_recommendations()
         }
         
@@ -137,6 +158,26 @@ class ValidationReporter:
         )
         return round(total_confidence / len(self.report_data["sample_reports"]), 3)
     
+    def _summarize_tiers(self) -> Dict[str, Any]:
+        """Average latency and tokens per validation tier, and how often the low tier escalated."""
+        tiered = self.report_data["tiered_validation"]
+        summary = {}
+        for tier, totals in tiered["tiers"].items():
+            passes = max(totals["passes"], 1)
+            summary[tier] = {
+                "passes": totals["passes"],
+                "average_latency_seconds": round(totals["latency_seconds"] / passes, 3),
+                "average_prompt_tokens": round(totals["prompt_tokens"] / passes),
+                "average_completion_tokens": round(totals["completion_tokens"] / passes),
+                "total_prompt_tokens": totals["prompt_tokens"]
+            }
+        low_passes = tiered["tiers"].get("low", {}).get("passes", 0)
+        summary["escalations"] = tiered["escalations"]
+        summary["escalation_rate"] = (
+            round(tiered["escalations"] / low_passes * 100, 2) if low_passes else 0.0
+        )
+        return summary
+    
     def _generate_recommendations(self) -> List[str]:
         """Generate recommendations based on validation results."""
         recommendations = []
@@ -220,6 +261,17 @@ class ValidationReporter:
         print(f"Average Confidence Score: {summary['average_confidence_score']}")
         print(f"Total Corrections Applied: {summary['total_corrections_applied']}")
         
+        tiers = summary['validation_tiers']
+        for tier in ("low", "high"):
+            if tier in tiers:
+                print(
+                    f"{tier.capitalize()} Detail Validation: {tiers[tier]['passes']} passes, "
+                    f"{tiers[tier]['average_latency_seconds']}s and "
+                    f"{tiers[tier]['average_prompt_tokens']} prompt tokens on average"
+                )
+        if "low" in tiers:
+            print(f"Escalated To High Detail: {tiers['escalations']} times ({tiers['escalation_rate']}%)")
+        
         print(f"\nMost Common Issues:")
         for issue_type, issue_data in summary['most_common_issues']:
             print(f"  - {issue_type}: {issue_data['count']} occurrences")
@@ -1,12 +1,30 @@
 import json
 import os
-from typing import Dict, List, Tuple, Any
+import time
+from typing import Dict, List, Tuple, Any, Optional
 
-from utils.image_utils import encode_images_to_base64
-from utils.pdf_utils import pdf_to_images
+import openai
+
+from utils.image_utils import (
+    crop_field_regions,
+    encode_images_to_base64,
+    field_rects_by_page,
+    filter_images_by_page,
+    prepare_image_blocks,
+)
+from utils.llm_utils import chat_completion, hedged_chat_completion, is_backend_error
+from utils.pdf_utils import pdf_page_sizes, pdf_to_images, pdf_to_base64_images
 from utils.general_utils import save_json
 
 
+# A low detail validation pass below this confidence is repeated at high detail
+# on the pages it flagged
+VALIDATION_ESCALATION_CONFIDENCE = 0.8
+
+# Times a validation pass whose answer could not be used is repeated
+VALIDATION_PASS_RETRIES = 1
+
+
 def validate_filled_pdf_mapping(
     filled_pdf_path: str,
     original_pdf_path: str,  # Add original PDF path parameter
@@ -20,13 +38,18 @@ def validate_filled_pdf_mapping(
     document_type: str,
     data_generation_prompt: str,
     logger,
-    max_retries: int = 2
+    max_retries: int = 2,
+    filled_pdf_bytes: Optional[bytes] = None,
+    label_priors: Optional[Dict[str, str]] = None,
+    field_geometry: Optional[Dict[str, Any]] = None,
+    escalation_confidence: Optional[float] = VALIDATION_ESCALATION_CONFIDENCE,
+    fieldname_image_data: Optional[Dict[str, str]] = None
 ) -> Tuple[bool, Dict[str, str], Dict[str, Any], Dict[str, Any]]:
     """
     Validates if the filled PDF makes logical sense and regenerates data if needed.
     
     Args:
-        filled_pdf_path: Path to the filled PDF
+        filled_pdf_path: Path to the filled PDF (unused when filled_pdf_bytes is given)
         original_pdf_path: Path to the original unfilled PDF template
         fieldname_images: List of paths to field name overlay images
         field_mappings: Original field mappings JSON
@@ -39,56 +62,111 @@ def validate_filled_pdf_mapping(
         data_generation_prompt: Original prompt used for data generation
         logger: Logger instance
         max_retries: Maximum number of correction attempts
+        filled_pdf_bytes: Filled PDF in memory. When given, pages are rendered and
+            re-filled in memory and nothing is written to filled_pdf_path.
+        label_priors: Captions printed next to each field (label_utils), given to
+            the label correction prompt for the fields with issues
+        field_geometry: Field mappings with widget geometry. When given, the
+            field name and filled page images are cropped to the bands around
+            the filled fields and pages without them are not sent.
+        escalation_confidence: Each attempt is first validated on low detail
+            images with a compact prompt, and repeated at high detail on the
+            pages its issues point at when it finds issues or reports a lower
+            confidence. None validates at high detail straight away. The
+            passes of all attempts are listed in validation_result["tiers"].
+        fieldname_image_data: The field name images already encoded as
+            {image_name: base64}; fieldname_images are encoded (once, through
+            the shared payload cache) when not given.
         
     Returns:
         Tuple of (is_valid, corrected_human_readable_labels, regenerated_synthetic_data, validation_result)
     """
     
     validation_result = None
+    tier_passes = []
+    if fieldname_image_data is None:
+        fieldname_image_data = encode_images_to_base64(fieldname_images)
+    page_sizes = pdf_page_sizes(original_pdf_path) if field_geometry else None
     
     for attempt in range(max_retries + 1):
         logger.info(f"Validation attempt {attempt + 1}/{max_retries + 1} for {document_type}")
         
-        # Generate images of the filled PDF
-        filled_pdf_image_dir = os.path.join(output_directory, "filled_pdf_validation_images")
-        os.makedirs(filled_pdf_image_dir, exist_ok=True)
-        
-        pdf_to_images(
-            pdf_path=filled_pdf_path,
-            image_directory=filled_pdf_image_dir,
-            data_flag=f"Validation attempt {attempt + 1}",
-            logger=logger
-        )
-        
-        # Get the generated image paths
-        filled_pdf_images = []
-        if os.path.exists(filled_pdf_image_dir):
-            for file_name in sorted(os.listdir(filled_pdf_image_dir)):
-                if file_name.endswith('.jpg'):
-                    filled_pdf_images.append(os.path.join(filled_pdf_image_dir, file_name))
-        
-        # Encode both sets of images
-        fieldname_image_data = encode_images_to_base64(fieldname_images)
-        
-        if filled_pdf_images:
-            filled_pdf_image_data = encode_images_to_base64(filled_pdf_images)
+        if filled_pdf_bytes is not None:
+            # Render the in-memory PDF straight to base64 without temp files
+            filled_pdf_image_data = pdf_to_base64_images(
+                pdf=filled_pdf_bytes,
+                data_flag=f"Validation attempt {attempt + 1}",
+                logger=logger
+            )
         else:
-            logger.error("Failed to generate filled PDF images")
-            filled_pdf_image_data = {}
+            # Generate images of the filled PDF
+            filled_pdf_image_dir = os.path.join(output_directory, "filled_pdf_validation_images")
+            os.makedirs(filled_pdf_image_dir, exist_ok=True)
+            
+            pdf_to_images(
+                pdf_path=filled_pdf_path,
+                image_directory=filled_pdf_image_dir,
+                data_flag=f"Validation attempt {attempt + 1}",
+                logger=logger
+            )
+            
+            # Get the generated image paths
+            filled_pdf_images = []
+            if os.path.exists(filled_pdf_image_dir):
+                for file_name in sorted(os.listdir(filled_pdf_image_dir)):
+                    if file_name.endswith('.jpg'):
+                        filled_pdf_images.append(os.path.join(filled_pdf_image_dir, file_name))
+            
+            if filled_pdf_images:
+                filled_pdf_image_data = encode_images_to_base64(filled_pdf_images)
+            else:
+                logger.error("Failed to generate filled PDF images")
+                filled_pdf_image_data = {}
+        
+        attempt_fieldname_image_data = fieldname_image_data
+        if field_geometry:
+            # Only the rows of the fields that were filled need checking
+            field_rects = field_rects_by_page(
+                field_geometry,
+                [
+                    info["field_name"]
+                    for info in synthetic_data.values()
+                    if isinstance(info, dict) and info.get("field_name")
+                ],
+            )
+            attempt_fieldname_image_data, _ = crop_field_regions(
+                fieldname_image_data, field_rects, page_sizes, logger,
+                f"validation attempt {attempt + 1} (field names)"
+            )
+            filled_pdf_image_data, _ = crop_field_regions(
+                filled_pdf_image_data, field_rects, page_sizes, logger,
+                f"validation attempt {attempt + 1} (filled pages)"
+            )
         
         # Combine all image data
-        all_image_data = {**fieldname_image_data, **filled_pdf_image_data}
+        all_image_data = {**attempt_fieldname_image_data, **filled_pdf_image_data}
         
         # Perform validation with AI
-        validation_result = _perform_ai_validation(
+        validation_result = _perform_tiered_validation(
             all_image_data=all_image_data,
             field_mappings=field_mappings,
             human_readable_labels=human_readable_labels,
             synthetic_data=synthetic_data,
             client=client,
             document_type=document_type,
-            logger=logger
+            logger=logger,
+            escalation_confidence=escalation_confidence,
+            field_geometry=field_geometry
         )
+        for tier_pass in validation_result["tiers"]:
+            tier_pass["attempt"] = attempt + 1
+        tier_passes.extend(validation_result["tiers"])
+        validation_result["tiers"] = tier_passes
+        
+        if validation_result.get("error"):
+            # Nothing to correct from when the validator's answer was unusable
+            logger.error(f"Validation attempt {attempt + 1} failed: {validation_result['error']}")
+            return False, human_readable_labels, synthetic_data, validation_result
         
         if validation_result["is_valid"]:
             logger.info(f"Validation successful after {attempt + 1} attempts")
@@ -107,7 +185,8 @@ def validate_filled_pdf_mapping(
                 data_generation_prompt=data_generation_prompt,
                 client=client,
                 document_type=document_type,
-                logger=logger
+                logger=logger,
+                label_priors=label_priors
             )
             
             # Save corrected files
@@ -137,14 +216,22 @@ def validate_filled_pdf_mapping(
             
             if is_valid_regenerated_data:
                 try:
-                    from utils.pdf_utils import fill_pdf_fields
-                    fill_pdf_fields(
-                        input_pdf=original_pdf_path,  # Use the original PDF path
-                        output_pdf_path=filled_pdf_path,
-                        data=regenerated_data,
-                        data_flag=f"Corrected attempt {attempt + 2}",
-                        logger=logger
-                    )
+                    from utils.pdf_utils import fill_pdf_fields, fill_pdf_fields_to_bytes
+                    if filled_pdf_bytes is not None:
+                        filled_pdf_bytes = fill_pdf_fields_to_bytes(
+                            input_pdf=original_pdf_path,
+                            data=regenerated_data,
+                            data_flag=f"Corrected attempt {attempt + 2}",
+                            logger=logger
+                        )
+                    else:
+                        fill_pdf_fields(
+                            input_pdf=original_pdf_path,  # Use the original PDF path
+                            output_pdf_path=filled_pdf_path,
+                            data=regenerated_data,
+                            data_flag=f"Corrected attempt {attempt + 2}",
+                            logger=logger
+                        )
                     logger.info(f"Successfully re-filled PDF with regenerated data (attempt {attempt + 2})")
                 except Exception as e:
                     logger.error(f"Failed to re-fill PDF with regenerated data (attempt {attempt + 2}): {str(e)}")
@@ -158,6 +245,119 @@ def validate_filled_pdf_mapping(
     return False, human_readable_labels, synthetic_data, validation_result or {}
 
 
+def _perform_tiered_validation(
+    all_image_data: Dict[str, str],
+    field_mappings: Dict[str, Any],
+    human_readable_labels: Dict[str, str],
+    synthetic_data: Dict[str, Any],
+    client,
+    document_type: str,
+    logger,
+    escalation_confidence: Optional[float] = VALIDATION_ESCALATION_CONFIDENCE,
+    field_geometry: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Validate with a cheap low detail pass first and escalate to a full
+    resolution pass only when it is not confident the form is correct.
+
+    The high detail pass gets only the pages the low detail pass flagged:
+    the page numbers of its issues, and the pages of the fields they name
+    when field_geometry is given. When it flagged none, its result stands.
+    A pass whose answer cannot be used is repeated VALIDATION_PASS_RETRIES
+    times and then returned with "error" set, never escalated. The result
+    is the last pass's, with the stats of every pass under "tiers".
+    """
+    tiers = []
+
+    def validation_pass(image_data, tier):
+        for retry in range(VALIDATION_PASS_RETRIES + 1):
+            result = _perform_ai_validation(
+                image_data, field_mappings, human_readable_labels, synthetic_data,
+                client, document_type, logger, tier=tier
+            )
+            tiers.append(result.pop("tier_stats"))
+            if not result.get("error"):
+                break
+            if retry < VALIDATION_PASS_RETRIES:
+                logger.warning(f"Repeating the {tier} detail validation pass: {result['error']}")
+        result["tiers"] = tiers
+        return result
+
+    if escalation_confidence is None:
+        return validation_pass(all_image_data, "high")
+
+    quick_result = validation_pass(all_image_data, "low")
+    if quick_result.get("error"):
+        return quick_result
+    confidence = quick_result.get("confidence_score") or 0.0
+    issues = quick_result.get("issues") or []
+    if quick_result.get("is_valid") and not issues and confidence >= escalation_confidence:
+        tiers[-1]["escalated"] = False
+        logger.info(f"Low detail validation passed with confidence {confidence}, not escalating")
+        return quick_result
+
+    pages = _flagged_pages(issues, field_geometry)
+    escalated_image_data = filter_images_by_page(all_image_data, pages) if pages else {}
+    if not escalated_image_data:
+        tiers[-1]["escalated"] = False
+        logger.info(
+            f"Low detail validation (confidence {confidence}, {len(issues)} issues) flagged no pages, "
+            "not escalating"
+        )
+        return quick_result
+    tiers[-1]["escalated"] = True
+    logger.info(
+        f"Escalating to high detail validation (confidence {confidence}, {len(issues)} issues) "
+        f"with {len(escalated_image_data)}/{len(all_image_data)} images of pages {sorted(pages)}"
+    )
+    return validation_pass(escalated_image_data, "high")
+
+
+def _flagged_pages(issues: List[Any], field_geometry: Optional[Dict[str, Any]]) -> set:
+    """
+    Page numbers the issues of a validation pass point at: their page_number,
+    or the pages of the widgets of the field they name.
+    """
+    pages = set()
+    for issue in issues:
+        if not isinstance(issue, dict):
+            continue
+        if isinstance(issue.get("page_number"), int):
+            pages.add(issue["page_number"])
+            continue
+        field_info = (field_geometry or {}).get(issue.get("field_name")) or {}
+        pages.update(widget["page_index"] + 1 for widget in field_info.get("widgets") or [])
+    return pages
+
+
+def _compact_validation_prompt(document_type: str, synthetic_data: Dict[str, Any]) -> str:
+    # Full field name -> [label, value]; the overlay images print only the last
+    # part of the name, which hierarchical forms reuse (borrower.name, coborrower.name)
+    filled_fields = {
+        info["field_name"]: [label, info.get("field_value")]
+        for label, info in synthetic_data.items()
+        if isinstance(info, dict) and info.get("field_name")
+    }
+    return f"""
+    Check this filled {document_type} form. The first images show the last part of each
+    field's name as "{{fieldname}}" where the field is; the others show the filled form.
+    Each entry below is full field name: [intended label, value written into it].
+
+    ```json
+    {json.dumps(filled_fields, separators=(",", ":"))}
+    ```
+
+    Report values in the wrong place, labels that do not fit the field's position and
+    values whose type does not match the label (dates, percentages, numbers, names).
+    Respond with a JSON object:
+    {{"is_valid": true/false, "confidence_score": 0.0-1.0, "issues": [{{"field_name": "...",
+    "issue_type": "wrong_location|wrong_label|wrong_value|missing_value", "description": "...",
+    "suggested_correct_label": "...", "page_number": 1}}], "summary": "..."}}
+    Only report is_valid true with a high confidence_score when you could read the values
+    well enough to be sure.
+    """
+
+
 def _perform_ai_validation(
     all_image_data: Dict[str, str],
     field_mappings: Dict[str, Any],
@@ -165,10 +365,19 @@ def _perform_ai_validation(
     synthetic_data: Dict[str, Any],
     client,
     document_type: str,
-    logger
+    logger,
+    tier: str = "high"
 ) -> Dict[str, Any]:
     """
     Uses AI to validate if the filled PDF makes logical sense.
+
+    tier="low" sends the images at low detail with a compact prompt. The
+    latency and token use of the call are returned under "tier_stats".
+
+    An unusable answer or a rejected request (content filter) is returned as
+    a result with "error" set; backend and transport errors are raised, so
+    that the retries, the circuit breaker and the requeueing of samples see
+    them.
     """
     
     system_prompt = f"""
@@ -265,42 +474,63 @@ def _perform_ai_validation(
     Set is_valid to false if there are significant mapping issues that affect form readability or logic.
     """
     
+    if tier == "low":
+        validation_prompt = _compact_validation_prompt(document_type, synthetic_data)
+
+    tier_stats = {
+        "tier": tier,
+        "images": len(all_image_data),
+        "latency_seconds": 0.0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+    }
+    started = time.perf_counter()
     try:
-        # Prepare image blocks
-        image_blocks = [
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/jpeg;base64,{image_data}"
-                },
-            }
-            for image_data in all_image_data.values()
-        ]
+        image_blocks, image_tokens = prepare_image_blocks(
+            all_image_data, logger, f"{tier} detail validation", detail=tier
+        )
         
         message_data = [{"type": "text", "text": validation_prompt}] + image_blocks
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": message_data}
+        ]
         
-        response = client.chat.completions.create(
+        response = hedged_chat_completion(
+            client,
+            logger,
+            f"{tier} detail validation",
+            f"{tier} detail validation",
+            image_tokens=image_tokens,
+            cache=True,
             model=os.getenv("AZURE_OPENAI_GPT4O_MODEL_DEPLOYMENT", "gpt-4o"),
             response_format={"type": "json_object"},
             temperature=0.1,
             max_tokens=8000,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": message_data}
-            ],
+            messages=messages,
         )
+        tier_stats["latency_seconds"] = round(time.perf_counter() - started, 3)
+        if getattr(response, "usage", None):
+            tier_stats["prompt_tokens"] = response.usage.prompt_tokens
+            tier_stats["completion_tokens"] = response.usage.completion_tokens
         
         result = json.loads(response.choices[0].message.content)
-        logger.info(f"Validation result: {result['summary']}")
+        logger.info(
+            f"Validation result ({tier} detail, {tier_stats['latency_seconds']}s): {result['summary']}"
+        )
+        result["tier_stats"] = tier_stats
         return result
         
-    except Exception as e:
+    except (ValueError, KeyError, TypeError, IndexError, openai.BadRequestError) as e:
         logger.error(f"Error during AI validation: {str(e)}")
+        tier_stats["latency_seconds"] = round(time.perf_counter() - started, 3)
         return {
             "is_valid": False,
             "confidence_score": 0.0,
             "issues": [{"field_name": "unknown", "issue_type": "validation_error", "description": str(e)}],
-            "summary": f"Validation failed due to error: {str(e)}"
+            "summary": f"Validation failed due to error: {str(e)}",
+            "error": str(e),
+            "tier_stats": tier_stats
         }
 
 
@@ -311,10 +541,13 @@ def _generate_corrected_labels(
     human_readable_labels: Dict[str, str],
     client,
     document_type: str,
-    logger
+    logger,
+    label_priors: Optional[Dict[str, str]] = None
 ) -> Dict[str, str]:
     """
     Generates corrected human-readable labels based on validation issues.
+    label_priors holds the captions printed next to the fields; the ones for
+    the fields with issues are included in the prompt.
     """
     
     system_prompt = f"""
@@ -362,30 +595,43 @@ def _generate_corrected_labels(
     
     Include ALL field names from the original mapping, not just the corrected ones.
     """
+
+    issue_fields = {issue.get("field_name") for issue in validation_result.get("issues", [])}
+    caption_hints = {
+        field_name: caption
+        for field_name, caption in (label_priors or {}).items()
+        if field_name in issue_fields
+    }
+    if caption_hints:
+        correction_prompt += f"""
+    ## PRINTED TEXT NEXT TO THE FIELDS WITH ISSUES
+    Captions found next to these fields in the form's text layer. Prefer them
+    over guesses when they fit the field's position on the images:
+    ```json
+    {json.dumps(caption_hints, indent=2)}
+    ```
+    """
     
     try:
-        # Prepare image blocks
-        image_blocks = [
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/jpeg;base64,{image_data}"
-                },
-            }
-            for image_data in all_image_data.values()
-        ]
+        image_blocks, image_tokens = prepare_image_blocks(all_image_data, logger, "label correction")
         
         message_data = [{"type": "text", "text": correction_prompt}] + image_blocks
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": message_data}
+        ]
         
-        response = client.chat.completions.create(
+        response = chat_completion(
+            client,
+            logger,
+            "label correction",
+            image_tokens=image_tokens,
+            cache=True,
             model=os.getenv("AZURE_OPENAI_GPT4O_MODEL_DEPLOYMENT", "gpt-4o"),
             response_format={"type": "json_object"},
             temperature=0.1,
             max_tokens=12000,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": message_data}
-            ],
+            messages=messages,
         )
         
         corrected_labels = json.loads(response.choices[0].message.content)
@@ -401,6 +647,8 @@ def _generate_corrected_labels(
         return corrected_labels
         
     except Exception as e:
+        if is_backend_error(e):
+            raise
         logger.error(f"Error during label correction generation: {str(e)}")
         return human_readable_labels
 
@@ -477,6 +725,8 @@ def _regenerate_synthetic_data_with_persona(
         return regenerated_data
         
     except Exception as e:
+        if is_backend_error(e):
+            raise
         logger.error(f"Error during data regeneration: {str(e)}")
         # Return empty dict as fallback
         return {}
@@ -491,7 +741,8 @@ def _generate_corrected_labels_and_regenerate_data(
     data_generation_prompt: str,
     client,
     document_type: str,
-    logger
+    logger,
+    label_priors: Optional[Dict[str, str]] = None
 ) -> Tuple[Dict[str, str], Dict[str, Any]]:
     """
     Generates corrected human-readable labels and regenerates synthetic data using existing pipeline.
@@ -505,7 +756,8 @@ def _generate_corrected_labels_and_regenerate_data(
         human_readable_labels=human_readable_labels,
         client=client,
         document_type=document_type,
-        logger=logger
+        logger=logger,
+        label_priors=label_priors
     )
     
     # Step 2: Regenerate synthetic data using existing pipeline with corrected labels